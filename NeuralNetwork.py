@@ -135,7 +135,12 @@ class NN:
         if self.conf.NORMALIZE_INPUTS:
             input = normalize_tensor(input, self.conf.state_norm_arr)
 
-        return NN(input, training=True)
+        # Outputs of mixed-precision NNs are cast back to float32
+        output = NN(input, training=True)
+        if output.dtype != tf.float32:
+            output = tf.cast(output, tf.float32)
+
+        return output
     
     def custom_logarithm(self,input):
         # Calculate the logarithms based on the non-zero condition
@@ -147,8 +152,8 @@ class NN:
 
         return result    
     
-    def compute_critic_grad(self, critic_model, target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch):
-        ''' Compute the gradient of the critic NN '''
+    def compute_critic_grad(self, critic_model, target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch, loss_scaler=None):
+        ''' Compute the gradient of the critic NN (and return the targets, critic and target-critic values and the loss). The loss is scaled by loss_scaler (LossScaleOptimizer of a mixed_float16 critic) if given: with Keras 2 the gradients are unscaled here, with Keras 3 (no get_scaled_loss) they are returned scaled and unscaled by the optimizer in apply_gradients '''
         with tf.GradientTape() as tape: 
             # Compute value function tail if TD(n) is used
             if self.conf.MC:
@@ -172,28 +177,25 @@ class NN:
                 critic_value = self.eval(critic_model, state_batch)
                 critic_loss = self.MSE(reward_to_go_batch, critic_value, sample_weight=weights_batch)
 
-        # Compute the gradients of the critic loss w.r.t. critic's parameters
-        critic_grad = tape.gradient(critic_loss, critic_model.trainable_variables)   
-
-        return critic_grad, reward_to_go_batch, critic_value, self.eval(target_critic, state_batch)
+            if loss_scaler is not None:
+                keras2_scaler = hasattr(loss_scaler, 'get_scaled_loss')
+                scaled_critic_loss = loss_scaler.get_scaled_loss(critic_loss) if keras2_scaler else loss_scaler.scale_loss(critic_loss)
 
-    def compute_actor_grad(self, actor_model, critic_model, state_batch, term_batch, batch_size):
-        ''' Compute the gradient of the actor NN '''
-        if batch_size == None:
-            batch_size = self.conf.BATCH_SIZE
+        # Compute the gradients of the critic loss w.r.t. critic's parameters
+        if loss_scaler is not None:
+            critic_grad = tape.gradient(scaled_critic_loss, critic_model.trainable_variables)
+            if keras2_scaler:
+                critic_grad = loss_scaler.get_unscaled_gradients(critic_grad)
+        else:
+            critic_grad = tape.gradient(critic_loss, critic_model.trainable_variables)   
 
-        actions = self.eval(actor_model, state_batch)
+        return critic_grad, reward_to_go_batch, critic_value, self.eval(target_critic, state_batch), critic_loss
 
+    def compute_actor_dynamics(self, state_batch, actions, term_batch):
+        ''' Compute the environment terms of the actor gradient: next states, gradient of the dynamics w.r.t. the actions (ds'_da) and gradient of the reward w.r.t. the actions (dr_da) '''
         # Both take into account normalization, ds_next_da is the gradient of the dynamics w.r.t. policy actions (ds'_da)
         state_next_tf, ds_next_da = self.env.simulate_batch(state_batch.numpy(), actions.numpy()) , self.env.derivative_batch(state_batch.numpy(), actions.numpy())
 
-        with tf.GradientTape() as tape:
-            tape.watch(state_next_tf)
-            critic_value_next = self.eval(critic_model,state_next_tf) 
-
-        # dV_ds' = gradient of V w.r.t. s', where s'=f(s,a) a=policy(s)                                           
-        dV_ds_next = tape.gradient(critic_value_next, state_next_tf)
-
         cost_weights_terminal_reshaped = np.reshape(self.conf.cost_weights_terminal,[1,len(self.conf.cost_weights_terminal)])
         cost_weights_running_reshaped = np.reshape(self.conf.cost_weights_running,[1,len(self.conf.cost_weights_running)])
         with tf.GradientTape() as tape1:
@@ -203,6 +205,25 @@ class NN:
         # dr_da = gradient of reward r(s,a) w.r.t. policy's action a
         dr_da = tape1.gradient(rewards_tf, actions, unconnected_gradients=tf.UnconnectedGradients.ZERO)
 
+        return state_next_tf, ds_next_da, dr_da
+
+    def compute_actor_grad(self, actor_model, critic_model, state_batch, term_batch, batch_size, dynamics=None):
+        ''' Compute the gradient of the actor NN (and return the surrogate loss it differentiates, mean of -(dQ/da)·a with dQ/da held constant, which is not the mean -Q). The environment terms (output of compute_actor_dynamics) can be given, e.g. when computed for several actors at once '''
+        if batch_size == None:
+            batch_size = self.conf.BATCH_SIZE
+
+        if dynamics is None:
+            actions = self.eval(actor_model, state_batch)
+            dynamics = self.compute_actor_dynamics(state_batch, actions, term_batch)
+        state_next_tf, ds_next_da, dr_da = dynamics
+
+        with tf.GradientTape() as tape:
+            tape.watch(state_next_tf)
+            critic_value_next = self.eval(critic_model,state_next_tf)
+
+        # dV_ds' = gradient of V w.r.t. s', where s'=f(s,a) a=policy(s)
+        dV_ds_next = tape.gradient(critic_value_next, state_next_tf)
+
         dr_da_reshaped = tf.reshape(dr_da, (batch_size, 1, self.conf.nb_action))
         
         # dr_ds' + dV_ds' (note: dr_ds' = 0)
@@ -230,4 +251,4 @@ class NN:
         # Gradients of the actor loss w.r.t. actor's parameters
         actor_grad = tape.gradient(mean_Qneg, actor_model.trainable_variables)
 
-        return actor_grad
\ No newline at end of file
+        return actor_grad, mean_Qneg
\ No newline at end of file
@@ -1,7 +1,72 @@
+import os
 import uuid
 import math
+import random
 import numpy as np
 import tensorflow as tf
+from utils import reverse_cumsum, discounted_reverse_cumsum
+from telemetry_utils import telemetry
+from metrics_utils import metrics
+from checkpoint_utils import checkpoints, load_checkpoint, load_training_state
+
+def large_batch_conf(conf):
+    '''
+    Return the configuration of the large-batch mode (conf.large_batch_factor = k > 1): mini-batches of k*BATCH_SIZE transitions
+    and k times fewer updates. The LR schedules (boundaries counted in updates, values scaled by k or sqrt(k)), the target-critic
+    update rate and the intervals counted in updates are scaled accordingly
+    '''
+    k = conf.large_batch_factor
+    if (conf.BATCH_SIZE*k) % conf.grad_accumulation_steps != 0:
+        raise ValueError('The mini-batch ({} transitions) cannot be split in {} micro-batches'.format(conf.BATCH_SIZE*k, conf.grad_accumulation_steps))
+    if k == 1:
+        return conf
+
+    LR_factor = k if conf.LR_scaling == 'linear' else math.sqrt(k)
+
+    def fewer(n):
+        ''' Number of large-batch updates corresponding to n updates '''
+        return n if not np.isfinite(n) else type(n)(max(1, math.ceil(n/k)))
+
+    changes = {'BATCH_SIZE': conf.BATCH_SIZE*k,
+               'UPDATE_LOOPS': np.maximum(1, np.ceil(conf.UPDATE_LOOPS/k)).astype(conf.UPDATE_LOOPS.dtype),
+               'NUPDATES': fewer(conf.NUPDATES),
+               'save_interval': fewer(conf.save_interval),
+               'plot_rollout_interval': fewer(conf.plot_rollout_interval),
+               'plot_rollout_interval_diff_loc': fewer(conf.plot_rollout_interval_diff_loc),
+               'metrics_log_interval': fewer(conf.metrics_log_interval),
+               'CRITIC_LEARNING_RATE': conf.CRITIC_LEARNING_RATE*LR_factor,
+               'ACTOR_LEARNING_RATE': conf.ACTOR_LEARNING_RATE*LR_factor,
+               'boundaries_schedule_LR_C': [b/k for b in conf.boundaries_schedule_LR_C],
+               'boundaries_schedule_LR_A': [b/k for b in conf.boundaries_schedule_LR_A],
+               'values_schedule_LR_C': [v*LR_factor for v in conf.values_schedule_LR_C],
+               'values_schedule_LR_A': [v*LR_factor for v in conf.values_schedule_LR_A]}
+
+    # Same time constant of the target critic with k times fewer soft updates
+    if not conf.MC:
+        changes['UPDATE_RATE'] = 1 - (1 - conf.UPDATE_RATE)**k
+
+    return conf.replace(**changes)
+
+def optimizer_variables(optimizer):
+    ''' Variables of an optimizer (iterations and slots), for both the legacy and the new Keras optimizers '''
+    variables = optimizer.variables
+
+    return list(variables() if callable(variables) else variables)
+
+def rng_state():
+    ''' RNG states of the process (random, numpy and TF global generator), shared by all the RL_AC instances '''
+    return {'random_state': random.getstate(),
+            'np_random_state': np.random.get_state(),
+            'tf_random_state': tf.random.get_global_generator().state.numpy()}
+
+def restore_rng_state(state):
+    '''
+    Restore the RNG states of the process saved with rng_state. The states of the TF ops with an op-level seed (their internal
+    counters) are not saved and the TO workers are reseeded by their pid, so a resumed training is not bit-exact
+    '''
+    random.setstate(state['random_state'])
+    np.random.set_state(state['np_random_state'])
+    tf.random.get_global_generator().reset(state['tf_random_state'])
 
 class RL_AC:
     def __init__(self, env, NN, conf, N_try):
@@ -11,6 +76,7 @@ class RL_AC:
         :input conf :                           (Configuration file)
 
             :parma critic_type :                (str) Activation function to use for the critic NN
+            :param critic_precision :           (str) Precision of the critic computations ('float32', 'mixed_bfloat16' or 'mixed_float16')
             :param LR_SCHEDULE :                (bool) Flag to use a scheduler for the learning rates
             :param boundaries_schedule_LR_C :   (list) Boudaries of critic LR
             :param values_schedule_LR_C :       (list) Values of critic LR
@@ -22,12 +88,17 @@ class RL_AC:
             :param prioritized_replay_alpha :   (float) α determines how much prioritization is used
             :param prioritized_replay_eps :     (float) It's a small positive constant that prevents the edge-case of transitions not being revisited once their error is zero
             :param UPDATE_LOOPS :               (int array) Number of updates of both critic and actor performed every EP_UPDATE episodes
+            :param grad_accumulation_steps :    (int) Number of micro-batches whose gradients are averaged before each optimizer step
             :param save_interval :              (int) save NNs interval
+            :param checkpoint_format :          (str) Format of the saved NNs ('h5' -> one file per NN, 'npz' -> single file per update step)
+            :param metrics_log_interval :       (int) Number of updates between two logs of the training metrics
+            :param init_states_sim :            (list of float arrays) Initial states of the policy evaluation rollouts
             :param env_RL :                     (bool) Flag RL environment
             :param nb_state :                   (int) State size (robot state size + 1)
             :param nb_action :                  (int) Action size (robot action size)
             :param MC :                         (bool) Flag to use MC or TD(n)
             :param nsteps_TD_N :                (int) Number of lookahed steps if TD(n) is used
+            :param TD_lambda :                  (float) λ of the λ-return if TD is used (0 -> n-step return)
             :param UPDATE_RATE :                (float) Homotopy rate to update the target critic network if TD(n) is used
             :param cost_weights_terminal :      (float array) Running cost weights vector
             :param cost_weights_running :       (float array) Terminal cost weights vector 
@@ -48,6 +119,11 @@ class RL_AC:
         self.target_critic = None
         self.actor_optimizer = None
         self.critic_optimizer = None
+        self.critic_loss_scaler = None
+        self.checkpoint_models = None
+        self.resume_ep = 0
+        self.resume_rng_state = None
+        self.resume_buffer_state = None
 
         self.init_rand_state = None
         self.NSTEPS_SH = 0
@@ -60,21 +136,10 @@ class RL_AC:
     
     def setup_model(self, recover_training=None):
         ''' Setup RL model '''
-        # Create actor, critic and target NNs
+        # Create actor, critic and target NNs (the critics in mixed precision if conf.critic_precision != 'float32': float32 variables, bfloat16/float16 computations)
         self.actor_model = self.NN.create_actor()
-
-        if self.conf.critic_type == 'elu':
-            self.critic_model = self.NN.create_critic_elu()
-            self.target_critic = self.NN.create_critic_elu()
-        elif self.conf.critic_type == 'sine':
-            self.critic_model = self.NN.create_critic_sine()
-            self.target_critic = self.NN.create_critic_sine()
-        elif self.conf.critic_type == 'sine-elu':
-            self.critic_model = self.NN.create_critic_sine_elu()
-            self.target_critic = self.NN.create_critic_sine_elu()
-        else:
-            self.critic_model = self.NN.create_critic_relu()
-            self.target_critic = self.NN.create_critic_relu()
+        self.critic_model = self.create_critic()
+        self.target_critic = self.create_critic()
 
         # Set optimizer specifying the learning rates
         if self.conf.LR_SCHEDULE:
@@ -87,29 +152,120 @@ class RL_AC:
             self.critic_optimizer   = tf.keras.optimizers.Adam(self.conf.CRITIC_LEARNING_RATE)
             self.actor_optimizer    = tf.keras.optimizers.Adam(self.conf.ACTOR_LEARNING_RATE)
 
-        # Set initial weights of the NNs
+        # Dynamic loss scaling of the float16 critic (avoids the underflow of small float16 gradients, not needed with the float32 exponent range of bfloat16)
+        if self.conf.critic_precision == 'mixed_float16':
+            self.critic_optimizer = tf.keras.mixed_precision.LossScaleOptimizer(self.critic_optimizer)
+            self.critic_loss_scaler = self.critic_optimizer
+
+        # Set initial weights of the NNs (from a .npz checkpoint if there is one, otherwise from the .h5 files)
         if recover_training is not None: 
             NNs_path_rec = str(recover_training[0])
             N_try = recover_training[1]
             update_step_counter = recover_training[2]
-            self.actor_model.load_weights("{}/N_try_{}/actor_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
-            self.critic_model.load_weights("{}/N_try_{}/critic_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
-            self.target_critic.load_weights("{}/N_try_{}/target_critic_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
+            checkpoint_path = "{}/N_try_{}/checkpoint_{}.npz".format(NNs_path_rec,N_try,update_step_counter)
+            if os.path.exists(checkpoint_path):
+                checkpoint = load_checkpoint(checkpoint_path)
+                self.actor_model.set_weights(checkpoint['actor'])
+                self.critic_model.set_weights(checkpoint['critic'])
+                self.target_critic.set_weights(checkpoint['target_critic'])
+            else:
+                self.actor_model.load_weights("{}/N_try_{}/actor_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
+                self.critic_model.load_weights("{}/N_try_{}/critic_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
+                self.target_critic.load_weights("{}/N_try_{}/target_critic_{}.h5".format(NNs_path_rec,N_try,update_step_counter))
+
+            # Resume optimizers and loop index (the RNG states are restored once per process by main) if the training state was saved with the NNs
+            training_state_path = "{}/N_try_{}/training_state_{}.pkl".format(NNs_path_rec,N_try,update_step_counter)
+            if os.path.exists(training_state_path):
+                self.restore_training_state(load_training_state(training_state_path))
+            else:
+                print('WARNING: no training state in {}/N_try_{}, only the NNs are recovered'.format(NNs_path_rec,N_try))
         else:
             self.target_critic.set_weights(self.critic_model.get_weights())   
 
+    def training_state(self, next_ep, rng_state=None, buffer=None):
+        ''' State needed to resume the training from the current NNs at the start of loop next_ep: optimizer variables (moments and iterations, which also drive the LR schedules), content of the replay buffer and, if given, the RNG states of the process (saved by a single instance) '''
+        return {'next_ep': next_ep,
+                'actor_optimizer': [v.numpy() for v in optimizer_variables(self.actor_optimizer)],
+                'critic_optimizer': [v.numpy() for v in optimizer_variables(self.critic_optimizer)],
+                'rng_state': rng_state,
+                'buffer': buffer.get_state() if buffer is not None else None}
+
+    def restore_training_state(self, training_state):
+        ''' Resume the optimizers from a training state (the loop to resume from is stored in self.resume_ep, the buffer content in self.resume_buffer_state and the RNG states, if saved, in self.resume_rng_state, to be restored once per process with restore_rng_state) '''
+        for name, optimizer, model in (('actor_optimizer', self.actor_optimizer, self.actor_model), ('critic_optimizer', self.critic_optimizer, self.critic_model)):
+            # Create the optimizer slots applying zero gradients (the NNs are not modified), then overwrite all the variables
+            optimizer.apply_gradients(zip([tf.zeros_like(v) for v in model.trainable_variables], model.trainable_variables))
+            variables = optimizer_variables(optimizer)
+            if len(variables) != len(training_state[name]):
+                raise ValueError('{} has {} variables, {} in the training state'.format(name, len(variables), len(training_state[name])))
+            for variable, value in zip(variables, training_state[name]):
+                variable.assign(value)
+
+        self.resume_ep = training_state['next_ep']
+        self.resume_rng_state = training_state.get('rng_state')
+        self.resume_buffer_state = training_state.get('buffer')
+
+    def create_critic(self):
+        ''' Create a critic NN of type conf.critic_type (in mixed precision if conf.critic_precision != 'float32': float32 variables, bfloat16/float16 computations) '''
+        tf.keras.mixed_precision.set_global_policy(self.conf.critic_precision)
+        if self.conf.critic_type == 'elu':
+            critic = self.NN.create_critic_elu()
+        elif self.conf.critic_type == 'sine':
+            critic = self.NN.create_critic_sine()
+        elif self.conf.critic_type == 'sine-elu':
+            critic = self.NN.create_critic_sine_elu()
+        else:
+            critic = self.NN.create_critic_relu()
+        tf.keras.mixed_precision.set_global_policy('float32')
+
+        return critic
+
     def update(self, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch, batch_size=None):
-        ''' Update both critic and actor '''
+        ''' Update both critic and actor. Return the critic targets, critic and target-critic values, critic loss and actor surrogate loss '''
+        if self.conf.grad_accumulation_steps > 1:
+            return self.update_accumulated(state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch)
+
         # Update the critic backpropagating the gradients
-        critic_grad, reward_to_go_batch, critic_value, target_critic_value = self.NN.compute_critic_grad(self.critic_model, self.target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch)
-        self.critic_optimizer.apply_gradients(zip(critic_grad, self.critic_model.trainable_variables))
+        with telemetry.phase('critic_step'):
+            critic_grad, reward_to_go_batch, critic_value, target_critic_value, critic_loss = self.NN.compute_critic_grad(self.critic_model, self.target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch, self.critic_loss_scaler)
+            self.critic_optimizer.apply_gradients(zip(critic_grad, self.critic_model.trainable_variables))
 
         # Update the actor backpropagating the gradients
-        actor_grad = self.NN.compute_actor_grad(self.actor_model, self.critic_model, state_batch, term_batch, batch_size)
-        self.actor_optimizer.apply_gradients(zip(actor_grad, self.actor_model.trainable_variables))
+        with telemetry.phase('actor_step'):
+            actor_grad, actor_surrogate_loss = self.NN.compute_actor_grad(self.actor_model, self.critic_model, state_batch, term_batch, batch_size)
+            self.actor_optimizer.apply_gradients(zip(actor_grad, self.actor_model.trainable_variables))
 
-        return reward_to_go_batch, critic_value, target_critic_value
+        return reward_to_go_batch, critic_value, target_critic_value, critic_loss, actor_surrogate_loss
     
+    def update_accumulated(self, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch):
+        ''' Update both critic and actor averaging the gradients of conf.grad_accumulation_steps equal micro-batches (same step as the whole mini-batch, smaller memory footprint) '''
+        m = self.conf.grad_accumulation_steps
+        micro_batch_size = state_batch.shape[0]//m
+        micro_batches = list(zip(*[tf.split(x, m) for x in (state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch)], np.split(term_batch, m)))
+
+        # Update the critic with the mean gradient of the micro-batches
+        with telemetry.phase('critic_step'):
+            critic_grads, reward_to_go_batch, critic_value, target_critic_value, critic_loss = [], [], [], [], 0
+            for state, state_next_rollout, partial_reward_to_go, dVdx, d, weights, term in micro_batches:
+                grad, reward_to_go, value, target_value, loss = self.NN.compute_critic_grad(self.critic_model, self.target_critic, state, state_next_rollout, partial_reward_to_go, dVdx, d, weights, self.critic_loss_scaler)
+                critic_grads.append(grad)
+                reward_to_go_batch.append(reward_to_go)
+                critic_value.append(value)
+                target_critic_value.append(target_value)
+                critic_loss += loss/m
+            self.critic_optimizer.apply_gradients(zip([tf.add_n(g)/m for g in zip(*critic_grads)], self.critic_model.trainable_variables))
+
+        # Update the actor with the mean gradient of the micro-batches
+        with telemetry.phase('actor_step'):
+            actor_grads, actor_surrogate_loss = [], 0
+            for state, _, _, _, _, _, term in micro_batches:
+                grad, surrogate_loss = self.NN.compute_actor_grad(self.actor_model, self.critic_model, state, term, micro_batch_size)
+                actor_grads.append(grad)
+                actor_surrogate_loss += surrogate_loss/m
+            self.actor_optimizer.apply_gradients(zip([tf.add_n(g)/m for g in zip(*actor_grads)], self.actor_model.trainable_variables))
+
+        return tf.concat(reward_to_go_batch, 0), tf.concat(critic_value, 0), tf.concat(target_critic_value, 0), critic_loss, actor_surrogate_loss
+
     @tf.function
     def update_target(self, target_weights, weights):
         ''' Update target critic NN '''
@@ -119,12 +275,15 @@ class RL_AC:
 
     def learn_and_update(self, update_step_counter, buffer, ep):
         ''' Sample experience and update buffer priorities and NNs '''
-        for i in range(int(self.conf.UPDATE_LOOPS[ep])):
+        start_step = update_step_counter
+        nb_updates = int(self.conf.UPDATE_LOOPS[ep])
+        for i in range(nb_updates):
             # Sample batch of transitions from the buffer
-            state_batch, partial_reward_to_go_batch, state_next_rollout_batch, dVdx_batch, d_batch, term_batch, weights_batch, batch_idxes = buffer.sample()
+            with telemetry.phase('sampling'):
+                state_batch, partial_reward_to_go_batch, state_next_rollout_batch, dVdx_batch, d_batch, term_batch, weights_batch, batch_idxes = buffer.sample()
 
             # Update both critic and actor
-            reward_to_go_batch, critic_value, target_critic_value = self.update(state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch)
+            reward_to_go_batch, critic_value, target_critic_value, critic_loss, actor_surrogate_loss = self.update(state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch)
 
             # Update buffer priorities
             if self.conf.prioritized_replay_alpha != 0:                                
@@ -132,23 +291,56 @@ class RL_AC:
 
             # Update target critic
             if not self.conf.MC:
-                self.update_target(self.target_critic.variables, self.critic_model.variables)
+                with telemetry.phase('target_update'):
+                    self.update_target(self.target_critic.variables, self.critic_model.variables)
 
             update_step_counter += 1
 
-            # Plot rollouts and save the NNs every conf.log_rollout_interval-training episodes
-            if update_step_counter%self.conf.save_interval == 0:
-                self.RL_save_weights(update_step_counter)
+            # Log the training metrics every conf.metrics_log_interval updates
+            if metrics.enabled and update_step_counter%self.conf.metrics_log_interval == 0:
+                self.log_metrics(update_step_counter, reward_to_go_batch, critic_value, critic_loss, actor_surrogate_loss)
+
+            # Plot rollouts and save the NNs every conf.log_rollout_interval-training episodes (at the end of the loop they are saved with the training state)
+            if update_step_counter%self.conf.save_interval == 0 and i < nb_updates-1:
+                with telemetry.phase('checkpoint'):
+                    self.RL_save_weights(update_step_counter)
+
+        # Resumable checkpoint (NNs and training state) at the end of a loop in which conf.save_interval updates were reached
+        if update_step_counter//self.conf.save_interval > start_step//self.conf.save_interval:
+            with telemetry.phase('checkpoint'):
+                self.RL_save_weights(update_step_counter, ep+1, rng_state(), buffer)
 
         return update_step_counter
     
+    def log_metrics(self, update_step_counter, reward_to_go_batch, critic_value, critic_loss, actor_surrogate_loss, logdir=None):
+        ''' Send the losses, TD errors and learning rates of an update to the metrics writer (run logdir, default the main one) '''
+        TD_errors = reward_to_go_batch.numpy() - critic_value.numpy()
+        if self.conf.LR_SCHEDULE:
+            critic_LR = self.CRITIC_LR_SCHEDULE(self.critic_optimizer.iterations).numpy()
+            actor_LR = self.ACTOR_LR_SCHEDULE(self.actor_optimizer.iterations).numpy()
+        else:
+            critic_LR, actor_LR = self.conf.CRITIC_LEARNING_RATE, self.conf.ACTOR_LEARNING_RATE
+
+        metrics.scalar('train/critic_loss', critic_loss.numpy(), update_step_counter, logdir)
+        metrics.scalar('train/actor_surrogate_loss', actor_surrogate_loss.numpy(), update_step_counter, logdir)
+        metrics.scalar('train/TD_error_abs_mean', np.mean(np.abs(TD_errors)), update_step_counter, logdir)
+        metrics.histogram('train/TD_errors', TD_errors, update_step_counter, logdir)
+        metrics.histogram('train/critic_value', critic_value.numpy(), update_step_counter, logdir)
+        metrics.scalar('train/critic_LR', critic_LR, update_step_counter, logdir)
+        metrics.scalar('train/actor_LR', actor_LR, update_step_counter, logdir)
+
+    def log_eval_metrics(self, update_step_counter, evaluator, logdir=None):
+        ''' Evaluate the actor from conf.init_states_sim with a PolicyEvaluator and send the returns to the metrics writer (run logdir, default the main one) '''
+        eval_returns = evaluator.evaluate(self.actor_model, self.conf.init_states_sim)[0]
+
+        metrics.scalar('eval/mean_return', np.mean(eval_returns), update_step_counter, logdir)
+        metrics.histogram('eval/returns', eval_returns, update_step_counter, logdir)
+
     def RL_Solve(self, TO_controls, TO_states, TO_step_cost):
         ''' Solve RL problem '''
         ep_return = 0                                                                 # Initialize the return
         rwrd_arr = np.empty(self.NSTEPS_SH+1)                                         # Reward array
         state_next_rollout_arr = np.zeros((self.NSTEPS_SH+1, self.conf.nb_state))     # Next state array
-        partial_reward_to_go_arr = np.empty(self.NSTEPS_SH+1)                         # Partial cost-to-go array
-        total_reward_to_go_arr = np.empty(self.NSTEPS_SH+1)                           # Total cost-to-go array
         term_arr = np.zeros(self.NSTEPS_SH+1)                                         # Episode-termination flag array
         term_arr[-1] = 1
         done_arr = np.zeros(self.NSTEPS_SH+1)                                         # Episode-MC-termination flag array
@@ -169,30 +361,40 @@ class RL_AC:
 
         ep_return = sum(rwrd_arr)
 
-        # Store transition after computing the (partial) cost-to go when using n-step TD (from 0 to Monte Carlo)
-        for i in range(self.NSTEPS_SH+1):
-            # set final lookahead step depending on whether Monte Cartlo or TD(n) is used
-            if self.conf.MC:
-                final_lookahead_step = self.NSTEPS_SH
-                done_arr[i] = 1 
-            else:
-                final_lookahead_step = min(i+self.conf.nsteps_TD_N, self.NSTEPS_SH)
-                if final_lookahead_step == self.NSTEPS_SH:
-                    done_arr[i] = 1 
-                else:
-                    state_next_rollout_arr[i,:] = self.state_arr[final_lookahead_step+1,:]
-            
-            # Compute the partial and total cost to go
-            partial_reward_to_go_arr[i] = np.float32(sum(rwrd_arr[i:final_lookahead_step+1]))
-            total_reward_to_go_arr[i] = np.float32(sum(rwrd_arr[i:self.NSTEPS_SH+1]))
+        # Compute the (partial) cost-to-go of each transition with reversed cumulative sums (n-step TD, from 0 to Monte Carlo, or λ-return)
+        idx_arr = np.arange(self.NSTEPS_SH+1)
+        reward_to_go_arr = np.append(reverse_cumsum(rwrd_arr), 0)                    # reward_to_go_arr[i] = sum(rwrd_arr[i:])
+        total_reward_to_go_arr = np.float32(reward_to_go_arr[:-1])
+
+        if self.conf.MC:
+            done_arr[:] = 1
+            partial_reward_to_go_arr = total_reward_to_go_arr
+        elif self.conf.TD_lambda > 0:
+            # λ-return bootstrapped with the target critic values of the next states: G_i = r_i + (1-λ)V(s_i+1) + λG_i+1 (already complete, so done = 1)
+            done_arr[:] = 1
+            next_values = self.NN.eval(self.target_critic, self.state_arr[1:]).numpy()[:,0]
+            partial_reward_to_go_arr = np.float32(discounted_reverse_cumsum(rwrd_arr + (1-self.conf.TD_lambda)*np.append(next_values, 0), self.conf.TD_lambda))
+        else:
+            # Final lookahead step of each transition, the ones reaching the end of the episode are done
+            final_lookahead_step_arr = np.minimum(idx_arr+self.conf.nsteps_TD_N, self.NSTEPS_SH)
+            done_arr[final_lookahead_step_arr == self.NSTEPS_SH] = 1
+            not_done = done_arr == 0
+            state_next_rollout_arr[not_done,:] = self.state_arr[final_lookahead_step_arr[not_done]+1,:]
+            partial_reward_to_go_arr = np.float32(reward_to_go_arr[idx_arr] - reward_to_go_arr[final_lookahead_step_arr+1])
 
         return self.state_arr, partial_reward_to_go_arr, total_reward_to_go_arr, state_next_rollout_arr, done_arr, rwrd_arr, term_arr, ep_return, self.ee_pos_arr
     
-    def RL_save_weights(self, update_step_counter='final'):
-        ''' Save NN weights '''
-        self.actor_model.save_weights(self.conf.NNs_path+"/N_try_{}/actor_{}.h5".format(self.N_try,update_step_counter))
-        self.critic_model.save_weights(self.conf.NNs_path+"/N_try_{}/critic_{}.h5".format(self.N_try,update_step_counter))
-        self.target_critic.save_weights(self.conf.NNs_path+"/N_try_{}/target_critic_{}.h5".format(self.N_try,update_step_counter))
+    def RL_save_weights(self, update_step_counter='final', next_ep=None, rng_state=None, buffer=None):
+        ''' Save NN weights (and, if next_ep is given, the training state to resume from loop next_ep, with the RNG states of the process rng_state and the content of buffer if given): the weights are copied and written in the background by the checkpoint writer (call checkpoints.close() before exiting) '''
+        snapshot = {'actor': self.actor_model.get_weights(), 'critic': self.critic_model.get_weights(), 'target_critic': self.target_critic.get_weights()}
+
+        # Models holding the snapshots while the .h5 files are written (the critic one is shared by critic and target critic)
+        if self.conf.checkpoint_format == 'h5' and self.checkpoint_models is None:
+            critic = self.create_critic()
+            self.checkpoint_models = {'actor': self.NN.create_actor(), 'critic': critic, 'target_critic': critic}
+
+        training_state = self.training_state(next_ep, rng_state, buffer) if next_ep is not None else None
+        checkpoints.submit(self.conf, self.conf.NNs_path+"/N_try_{}".format(self.N_try), update_step_counter, snapshot, self.checkpoint_models, training_state)
 
     def create_TO_init(self, ep, ICS):
         ''' Create initial state and initial controls for TO '''
@@ -230,4 +432,29 @@ class RL_AC:
                 success_init_flag = 0
                 return None, None, None, None, success_init_flag
 
-        return self.init_rand_state, init_TO_states, init_TO_controls, self.NSTEPS_SH, success_init_flag
\ No newline at end of file
+        return self.init_rand_state, init_TO_states, init_TO_controls, self.NSTEPS_SH, success_init_flag
+
+    def create_TO_shift_init(self, TO_states, TO_controls, k):
+        ''' Create initial state and initial controls for the TO sub-problem starting at node k of a solved TO trajectory (warm-started from the shifted solution) '''
+        NSTEPS_SH = TO_states.shape[0] - 1 - k
+        if NSTEPS_SH <= 0:
+            return None, None, None, None, 0
+
+        # Shifted solution, optionally perturbing the starting state (not the time) to get independent samples
+        init_TO_states = np.copy(TO_states[k:,:])
+        init_TO_controls = np.copy(TO_controls[k:,:])
+        init_TO_states[0,:-1] += self.conf.TO_shift_noise*(self.conf.x_init_max[:-1]-self.conf.x_init_min[:-1])*np.random.uniform(-1, 1, self.conf.nb_state-1)
+
+        self.init_rand_state = init_TO_states[0,:]
+        self.NSTEPS_SH = NSTEPS_SH
+
+        # Initialize array to store RL state, control, and end-effector trajectories
+        self.control_arr = np.empty((self.NSTEPS_SH, self.conf.nb_action))
+        self.state_arr = np.empty((self.NSTEPS_SH+1, self.conf.nb_state))
+        self.ee_pos_arr = np.empty((self.NSTEPS_SH+1,3))
+
+        # Set initial state and end-effector position
+        self.state_arr[0,:] = self.init_rand_state
+        self.ee_pos_arr[0,:] = self.env.get_end_effector_position(self.state_arr[0, :])
+
+        return self.init_rand_state, init_TO_states, init_TO_controls, self.NSTEPS_SH, 1
\ No newline at end of file
@@ -1,8 +1,10 @@
+import os
 import sys
 import math
 import casadi
 import numpy as np
 import pinocchio.casadi as cpin
+from telemetry_utils import telemetry
 
 class TO_Casadi:
     
@@ -18,6 +20,8 @@ class TO_Casadi:
             :param nb_state :                   (int) State size (robot state size + 1)
             :param nb_action :                  (int) Action size (robot action size)
             :param dt :                         (float) Timestep
+            :param TO_warm_start_duals :        (bool) Flag to warm-start the duals of the TO problems without given duals from the adjoint of their warm-start trajectory
+            :param TO_mu_init :                 (float) Initial ipopt barrier parameter used for warm-started solves
 
         :input system_id :                      (str) Id system
         
@@ -33,9 +37,15 @@ class TO_Casadi:
         self.w_S = w_S
 
         self.CAMS = env_TO
+
+        # Constraint multipliers of the last solve (shifted to warm-start the re-solves of the same episode)
+        self.TO_lam_g = None
+
+        # Cost and dynamics gradients of the adjoint of a warm-start trajectory (created on first use, mapped once per horizon length)
+        self.adjoint_funs = {}
     
-    def TO_System_Solve(self, ICS_state, init_TO_states, init_TO_controls, T):
-        ''' Create and solbe TO casadi problem '''
+    def TO_System_Solve(self, ICS_state, init_TO_states, init_TO_controls, T, init_TO_duals=None):
+        ''' Create and solbe TO casadi problem. If init_TO_duals is given (or estimated from the warm-start trajectory if conf.TO_warm_start_duals) ipopt is warm-started also in the duals '''
         ### PROBLEM
         opti = casadi.Opti()
 
@@ -70,12 +80,22 @@ class TO_Casadi:
         for x,xg in zip(xs,init_x_TO): opti.set_initial(x,xg)
         for u,ug in zip(us,init_u_TO): opti.set_initial(u,ug)
 
-        # Set solver options
+        # Multipliers of a previous solve or of the warm-start trajectory (the only constraints are the initial-state and shooting ones, there are no bound duals)
+        if init_TO_duals is None and self.conf.TO_warm_start_duals:
+            init_TO_duals = self.rollout_duals(init_TO_states, init_TO_controls, T)
+        warm_start_duals = init_TO_duals is not None and len(init_TO_duals) == opti.ng
+
+        # Set solver options (warm start of the primal-dual point and reduced bound pushes only with duals)
         opts = {'ipopt.linear_solver':'ma57', 'ipopt.sb': 'yes','ipopt.print_level': 0, 'print_time': 0} #, 'ipopt.max_iter': 500} 
+        if warm_start_duals:
+            opti.set_initial(opti.lam_g, init_TO_duals)
+            opts.update({'ipopt.warm_start_init_point': 'yes', 'ipopt.mu_init': self.conf.TO_mu_init,
+                         'ipopt.warm_start_bound_push': 1e-9, 'ipopt.warm_start_mult_bound_push': 1e-9})
         opti.solver("ipopt", opts) 
         
         try:
             opti.solve()
+            self.TO_lam_g = np.reshape(opti.value(opti.lam_g), -1)
             TO_states = np.array([ opti.value(x) for x in xs ])
             TO_controls = np.array([ opti.value(u) for u in us ])
             TO_total_cost = opti.value(total_cost)
@@ -94,19 +114,22 @@ class TO_Casadi:
             TO_total_cost = None
             TO_ee_pos_arr = None
             TO_step_cost = None
+            self.TO_lam_g = None
             success_flag = 0
 
         return success_flag, TO_controls, TO_states, TO_ee_pos_arr, TO_total_cost, TO_step_cost
     
-    def TO_Solve(self, ICS_state, init_TO_states, init_TO_controls, T):
+    def TO_Solve(self, ICS_state, init_TO_states, init_TO_controls, T, init_TO_duals=None):
         ''' Retrieve TO problem solution and compute the value function derviative with respect to the state '''
-        success_flag, TO_controls, TO_states, TO_ee_pos_arr, _, TO_step_cost = self.TO_System_Solve(ICS_state, init_TO_states, init_TO_controls, T)
+        with telemetry.phase('TO_solve'):
+            success_flag, TO_controls, TO_states, TO_ee_pos_arr, _, TO_step_cost = self.TO_System_Solve(ICS_state, init_TO_states, init_TO_controls, T, init_TO_duals)
         if success_flag == 0:
             return None, None, success_flag, None, None, None 
 
         if self.w_S != 0:
             # Compute V gradient w.r.t. x (no computation dV/dt)
-            dVdx = self.backward_pass(T+1, TO_states, TO_controls) 
+            with telemetry.phase('backward_pass'):
+                dVdx = self.backward_pass(T+1, TO_states, TO_controls) 
         else:
             dVdx = np.zeros((T+1, self.conf.nb_state))
 
@@ -115,6 +138,116 @@ class TO_Casadi:
             
         return TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx 
 
+    def TO_System_Solve_batch(self, ICS_states, init_TO_states, init_TO_controls, T):
+        ''' Create and solve k independent TO problems with the same horizon as a single (block-diagonal) casadi problem. If the joint solve fails, the problems are solved one by one '''
+        n_problems = len(ICS_states)
+
+        ### PROBLEM
+        opti = casadi.Opti()
+
+        self.runningSingleModel = self.CAMS('running_model', self.conf)
+        self.terminalModel = self.CAMS('terminal_model', self.conf)
+
+        # Dynamics and running cost mapped over the whole horizon (one constraint block per problem)
+        x_next_map = self.runningSingleModel.x_next.map(T)
+        cost_map = self.runningSingleModel.cost.map(T)
+
+        # Decision variables of each problem (state and control trajectories stored column-wise)
+        xs = [ opti.variable(self.runningSingleModel.nx, T+1) for _ in range(n_problems) ]
+        us = [ opti.variable(self.runningSingleModel.nu, T) for _ in range(n_problems) ]
+
+        # The total cost is the sum of the (independent) costs of each problem
+        total_cost = 0
+        for j in range(n_problems):
+            opti.subject_to(xs[j][:,0] == ICS_states[j][:-1])
+            opti.subject_to(xs[j][:,1:] == x_next_map(xs[j][:,:-1], us[j]))
+            total_cost += casadi.sum2(cost_map(xs[j][:,:-1], us[j])) + self.terminalModel.cost(xs[j][:,-1], us[j][:,-1])
+
+            # Create warmstart
+            opti.set_initial(xs[j], np.array(init_TO_states[j][:T+1,:-1]).T)
+            opti.set_initial(us[j], np.array(init_TO_controls[j][:T,:]).T)
+
+        ### SOLVE
+        opti.minimize(total_cost)
+
+        opts = {'ipopt.linear_solver':'ma57', 'ipopt.sb': 'yes','ipopt.print_level': 0, 'print_time': 0}
+        opti.solver("ipopt", opts)
+
+        try:
+            opti.solve()
+        except:
+            print('ERROR in convergence of the batched TO problem, solving the {} problems one by one'.format(n_problems))
+            return [self.TO_System_Solve(ICS_states[j], init_TO_states[j], init_TO_controls[j], T) for j in range(n_problems)]
+
+        results = []
+        for j in range(n_problems):
+            TO_states = np.reshape(opti.value(xs[j]), (self.runningSingleModel.nx, T+1)).T
+            TO_controls = np.reshape(opti.value(us[j]), (self.runningSingleModel.nu, T)).T
+            TO_ee_pos_arr = np.array(self.runningSingleModel.p_ee.map(T+1)(TO_states.T)).T
+            TO_step_cost = np.empty(T+1)
+            TO_step_cost[:-1] = np.reshape(cost_map(TO_states[:-1,:].T, TO_controls.T), -1)
+            TO_step_cost[-1] = self.terminalModel.cost(TO_states[-1,:], TO_controls[-1,:])
+            results.append((1, TO_controls, TO_states, TO_ee_pos_arr, np.sum(TO_step_cost), TO_step_cost))
+
+        return results
+
+    def TO_Solve_batch(self, ICS_states, init_TO_states, init_TO_controls, T):
+        ''' Retrieve the solutions of k TO problems with the same horizon solved in a single NLP and compute the value function derviatives with respect to the state '''
+        samples = []
+        with telemetry.phase('TO_solve'):
+            solutions = self.TO_System_Solve_batch(ICS_states, init_TO_states, init_TO_controls, T)
+        for j, (success_flag, TO_controls, TO_states, TO_ee_pos_arr, _, TO_step_cost) in enumerate(solutions):
+            if success_flag == 0:
+                samples.append((None, None, success_flag, None, None, None))
+                continue
+
+            if self.w_S != 0:
+                with telemetry.phase('backward_pass'):
+                    dVdx = self.backward_pass(T+1, TO_states, TO_controls)
+            else:
+                dVdx = np.zeros((T+1, self.conf.nb_state))
+
+            # Add the last state component (time)
+            TO_states = np.concatenate((TO_states, init_TO_states[j][0,-1] + np.transpose(self.conf.dt*np.array([range(T+1)]))), axis=1)
+
+            samples.append((TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx))
+
+        return samples
+
+    def rollout_duals(self, init_TO_states, init_TO_controls, T):
+        '''
+        Estimate of the multipliers of the TO problem from its warm-start trajectory (e.g. the actor rollout): the adjoint
+        p_t = l_x(x_t,u_t) + f_x(x_t,u_t)' p_t+1, p_T = l_f_x(x_T), i.e. the cost-to-go gradient along the trajectory. The multiplier
+        of the constraint fixing x_t is -p_t (exact at the optimum)
+        '''
+        if T not in self.adjoint_funs:
+            x = casadi.SX.sym('x',self.nx,1)
+            u = casadi.SX.sym('u',self.nu,1)
+            running_model, terminal_model = self.CAMS('running_model', self.conf), self.CAMS('terminal_model', self.conf)
+            fun_adjoint_running = casadi.Function('fun_adjoint_running', [x,u], [casadi.gradient(running_model.cost(x, u), x), casadi.jacobian(running_model.x_next(x, u), x)])
+            fun_adjoint_terminal = casadi.Function('fun_adjoint_terminal', [x,u], [casadi.gradient(terminal_model.cost(x, u), x)])
+            self.adjoint_funs[T] = (fun_adjoint_running.map(T), fun_adjoint_terminal)
+        fun_adjoint_running, fun_adjoint_terminal = self.adjoint_funs[T]
+
+        X = np.asarray(init_TO_states[:T+1,:-1], dtype=np.float64)
+        U = np.asarray(init_TO_controls[:T,:], dtype=np.float64)
+        l_x, f_x = fun_adjoint_running(X[:-1].T, U.T)
+        l_x, f_x = np.array(l_x), np.array(f_x).reshape(self.nx, T, self.nx)
+
+        p = np.zeros((T+1, self.nx))
+        p[T] = np.ravel(fun_adjoint_terminal(X[-1], U[-1]))
+        for t in range(T-1, -1, -1):
+            p[t] = l_x[:,t] + f_x[:,t,:].T @ p[t+1]
+
+        return -p.ravel()
+
+    def shift_duals(self, lam_g, k):
+        ''' Shift the constraint multipliers of a solve to the sub-problem starting at node k (the initial-state constraint takes the multiplier of the k-th shooting constraint) '''
+        if lam_g is None:
+            return None
+
+        return lam_g[k*self.nx:]
+
     def backward_pass(self, T, TO_states, TO_controls, mu=1e-9):
         ''' Perform the backward-pass of DDP to obtain the derivatives of the Value function w.r.t x '''
         n = self.conf.nb_state-1
@@ -198,4 +331,244 @@ class TO_Casadi:
             V_x[i,:-1]    = Q_x[i,:]  - Q_xu[i,:,:] @ Qbar_uu_pinv @ Q_u[i,:]
             V_xx[i,:]   = Q_xx[i,:] - Q_xu[i,:,:] @ Qbar_uu_pinv @ Q_xu[i,:,:].T
 
-        return V_x
\ No newline at end of file
+        return V_x
+
+class TO_DDP(TO_Casadi):
+
+    def __init__(self, env, conf, env_TO, w_S=0):
+        '''    
+        :input env :                            (Environment instance)
+
+        :input conf :                           (Configuration file)
+
+            :param nb_state :                   (int) State size (robot state size + 1)
+            :param nb_action :                  (int) Action size (robot action size)
+            :param dt :                         (float) Timestep
+            :param DDP_max_iter :               (int) Max number of iLQR iterations
+            :param DDP_tol :                    (float) Tolerance on the relative cost reduction to stop the iterations
+            :param DDP_mu_init :                (float) Initial regularization of Q_uu
+            :param DDP_mu_max :                 (float) Max regularization of Q_uu before declaring failure
+            :param cache_path :                 (str) Folder of the on-disk caches ('' -> the derivative functions are rebuilt at every start)
+
+        :input env_TO :                         (CAMS class of the selected system)
+        
+        :input w_S :                            (float) Sobolev-training weight
+        '''
+        super().__init__(env, conf, env_TO, w_S)
+
+        # The CAMS models are built once, the dynamics and cost derivatives are stored as casadi functions
+        self.runningSingleModel = self.CAMS('running_model', self.conf)
+        self.terminalModel = self.CAMS('terminal_model', self.conf)
+
+        # The symbolic derivatives (slow to build for the manipulators) are cached on disk, keyed by the configuration hash
+        cache_dir = self.conf.cache_dir('TO_DDP')
+        funs = self.load_functions(cache_dir) if cache_dir is not None else None
+        if funs is None:
+            funs = self.build_functions()
+            if cache_dir is not None:
+                self.save_functions(cache_dir, funs)
+        self.fun_running, self.fun_running_der, self.fun_terminal, self.fun_terminal_der = funs
+
+        # Horizon-mapped versions of the running functions (created once per horizon length)
+        self.map_cache = {}
+
+        # Value function gradient w.r.t. x (cost-to-go) of the last solve
+        self.V_x = None
+
+    def build_functions(self):
+        ''' Build the casadi functions of the running dynamics and cost (with their derivatives) and of the terminal cost (with its derivatives) '''
+        x = casadi.SX.sym('x',self.nx,1)
+        u = casadi.SX.sym('u',self.nu,1)
+
+        f = self.runningSingleModel.x_next(x, u)
+        l = self.runningSingleModel.cost(x, u)
+        l_xx, l_x = casadi.hessian(l, x)
+        l_uu, l_u = casadi.hessian(l, u)
+        l_ux = casadi.jacobian(l_u, x)
+        fun_running = casadi.Function('fun_running', [x,u], [f, l])
+        fun_running_der = casadi.Function('fun_running_der', [x,u], [casadi.jacobian(f,x), casadi.jacobian(f,u), l_x, l_u, l_xx, l_uu, l_ux])
+
+        l_f = self.terminalModel.cost(x, casadi.DM.zeros(self.nu))
+        l_f_xx, l_f_x = casadi.hessian(l_f, x)
+        fun_terminal = casadi.Function('fun_terminal', [x], [l_f])
+        fun_terminal_der = casadi.Function('fun_terminal_der', [x], [l_f_x, l_f_xx])
+
+        return fun_running, fun_running_der, fun_terminal, fun_terminal_der
+
+    def save_functions(self, cache_dir, funs):
+        ''' Serialize the casadi functions in cache_dir (temporary files renamed in place, runs sharing the cache may build them at the same time) '''
+        for fun in funs:
+            path = os.path.join(cache_dir, fun.name() + '.casadi')
+            fun.save(path + '.{}.tmp'.format(os.getpid()))
+            os.replace(path + '.{}.tmp'.format(os.getpid()), path)
+
+    def load_functions(self, cache_dir):
+        ''' Load the casadi functions serialized in cache_dir (None if any is missing) '''
+        paths = [os.path.join(cache_dir, name + '.casadi') for name in ['fun_running', 'fun_running_der', 'fun_terminal', 'fun_terminal_der']]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+
+        return tuple(casadi.Function.load(path) for path in paths)
+
+    def mapped_funs(self, T):
+        ''' Return the running functions evaluated on a whole horizon of length T in a single call '''
+        if T not in self.map_cache:
+            self.map_cache[T] = (self.fun_running.map(T), self.fun_running_der.map(T))
+
+        return self.map_cache[T]
+
+    def rollout(self, x0, X, U, K, k, alpha):
+        ''' Forward pass: simulate the closed-loop policy u = U + alpha*k + K(x-X) and return trajectories and total cost '''
+        T = U.shape[0]
+        X_new = np.empty_like(X)
+        U_new = np.empty_like(U)
+        step_cost = np.empty(T+1)
+
+        X_new[0,:] = x0
+        for t in range(T):
+            U_new[t,:] = U[t,:] + alpha*k[t,:] + K[t,:,:] @ (X_new[t,:] - X[t,:])
+            x_next, cost = self.fun_running(X_new[t,:], U_new[t,:])
+            X_new[t+1,:] = np.reshape(x_next, -1)
+            step_cost[t] = float(cost)
+            if not np.isfinite(X_new[t+1,:]).all():
+                return X_new, U_new, step_cost, np.inf
+        step_cost[-1] = float(self.fun_terminal(X_new[-1,:]))
+
+        return X_new, U_new, step_cost, np.sum(step_cost)
+
+    def backward_pass_iLQR(self, X, U, mu):
+        ''' Riccati backward pass (Gauss-Newton approximation of the dynamics) regularized with mu*I on Q_uu '''
+        T = U.shape[0]
+        f_x, f_u, l_x, l_u, l_xx, l_uu, l_ux = [np.array(d) for d in self.mapped_funs(T)[1](X[:-1,:].T, U.T)]
+
+        # Mapped outputs are horizontally concatenated: reshape them as (T, rows, cols)
+        f_x  = f_x.reshape(self.nx, T, self.nx).transpose(1,0,2)
+        f_u  = f_u.reshape(self.nx, T, self.nu).transpose(1,0,2)
+        l_x  = l_x.T
+        l_u  = l_u.T
+        l_xx = l_xx.reshape(self.nx, T, self.nx).transpose(1,0,2)
+        l_uu = l_uu.reshape(self.nu, T, self.nu).transpose(1,0,2)
+        l_ux = l_ux.reshape(self.nu, T, self.nx).transpose(1,0,2)
+
+        K = np.zeros((T, self.nu, self.nx))
+        k = np.zeros((T, self.nu))
+        V_x = np.zeros((T+1, self.nx))
+
+        V_x_f, V_xx_f = self.fun_terminal_der(X[-1,:])
+        V_x[-1,:] = np.reshape(V_x_f, -1)
+        V_xx = np.array(V_xx_f)
+        expected_reduction = 0
+
+        for t in range(T-1, -1, -1):
+            Q_x  = l_x[t,:] + f_x[t].T @ V_x[t+1,:]
+            Q_u  = l_u[t,:] + f_u[t].T @ V_x[t+1,:]
+            Q_xx = l_xx[t] + f_x[t].T @ V_xx @ f_x[t]
+            Q_uu = l_uu[t] + f_u[t].T @ V_xx @ f_u[t]
+            Q_ux = l_ux[t] + f_u[t].T @ V_xx @ f_x[t]
+
+            # Q_uu must be positive definite, otherwise the regularization is increased by the caller
+            Qbar_uu = Q_uu + mu*np.identity(self.nu)
+            try:
+                np.linalg.cholesky(Qbar_uu)
+            except np.linalg.LinAlgError:
+                return None, None, None, None
+
+            kK = -np.linalg.solve(Qbar_uu, np.column_stack((Q_u, Q_ux)))
+            k[t,:], K[t,:,:] = kK[:,0], kK[:,1:]
+
+            V_x[t,:] = Q_x + K[t].T @ Q_uu @ k[t,:] + K[t].T @ Q_u + Q_ux.T @ k[t,:]
+            V_xx = Q_xx + K[t].T @ Q_uu @ K[t] + K[t].T @ Q_ux + Q_ux.T @ K[t]
+            V_xx = 0.5*(V_xx + V_xx.T)
+
+            expected_reduction += k[t,:] @ Q_u
+
+        return K, k, V_x, expected_reduction
+
+    def TO_System_Solve(self, ICS_state, init_TO_states, init_TO_controls, T, init_TO_duals=None):
+        ''' Solve the TO problem with iLQR (forward rollout, regularized backward Riccati pass, backtracking line search) '''
+        x0 = np.array(ICS_state[:-1])
+        U = np.array(init_TO_controls[:T,:], dtype=float)
+        X = np.zeros((T+1, self.nx))
+        K0 = np.zeros((T, self.nu, self.nx))
+        k0 = np.zeros((T, self.nu))
+
+        X, U, step_cost, total_cost = self.rollout(x0, X, U, K0, k0, 0)
+
+        mu = self.conf.DDP_mu_init
+        success_flag = 0
+        self.V_x = None
+        if np.isfinite(total_cost):
+            for it in range(self.conf.DDP_max_iter):
+                K, k, V_x, expected_reduction = self.backward_pass_iLQR(X, U, mu)
+                if K is None:
+                    mu *= 10
+                    if mu > self.conf.DDP_mu_max:
+                        break
+                    continue
+                self.V_x = V_x
+
+                # Stop if the expected reduction is negligible
+                if abs(expected_reduction) < self.conf.DDP_tol*max(1.0, abs(total_cost)):
+                    success_flag = 1
+                    break
+
+                # Backtracking line search
+                accepted = 0
+                for alpha in 0.5**np.arange(10):
+                    X_new, U_new, step_cost_new, total_cost_new = self.rollout(x0, X, U, K, k, alpha)
+                    if total_cost_new < total_cost - 1e-4*alpha*abs(expected_reduction):
+                        accepted = 1
+                        break
+
+                if accepted:
+                    rel_improvement = (total_cost - total_cost_new)/max(1.0, abs(total_cost))
+                    X, U, step_cost, total_cost = X_new, U_new, step_cost_new, total_cost_new
+                    mu = max(self.conf.DDP_mu_init, mu/10)
+                    if rel_improvement < self.conf.DDP_tol:
+                        success_flag = 1
+                        break
+                else:
+                    mu *= 10
+                    if mu > self.conf.DDP_mu_max:
+                        break
+
+        if success_flag:
+            # Gradient of the cost-to-go at the converged trajectory
+            _, _, self.V_x, _ = self.backward_pass_iLQR(X, U, self.conf.DDP_mu_init)
+            if self.V_x is None:
+                success_flag = 0
+
+        if success_flag:
+            TO_ee_pos_arr = np.array([np.reshape(self.runningSingleModel.p_ee(X[n,:]),-1) for n in range(T+1)])
+            TO_step_cost = step_cost
+            TO_total_cost = total_cost
+        else:
+            print('ERROR in convergence (DDP), returning debug values')
+            TO_ee_pos_arr = None
+            TO_step_cost = None
+            TO_total_cost = None
+
+        self.TO_lam_g = None
+
+        return success_flag, U, X, TO_ee_pos_arr, TO_total_cost, TO_step_cost
+
+    def TO_Solve(self, ICS_state, init_TO_states, init_TO_controls, T, init_TO_duals=None):
+        ''' Retrieve TO problem solution, the value function derviative w.r.t. the state is given by the iLQR backward pass '''
+        with telemetry.phase('TO_solve'):
+            success_flag, TO_controls, TO_states, TO_ee_pos_arr, _, TO_step_cost = self.TO_System_Solve(ICS_state, init_TO_states, init_TO_controls, T)
+        if success_flag == 0:
+            return None, None, success_flag, None, None, None 
+
+        dVdx = np.zeros((T+1, self.conf.nb_state))
+        if self.w_S != 0:
+            # The critic learns the reward-to-go (-cost), no computation of dV/dt
+            dVdx[:,:-1] = -self.V_x
+
+        # Add the last state component (time)
+        TO_states = np.concatenate((TO_states, init_TO_states[0,-1] + np.transpose(self.conf.dt*np.array([range(T+1)]))), axis=1)
+            
+        return TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx
+
+    def TO_Solve_batch(self, ICS_states, init_TO_states, init_TO_controls, T):
+        ''' iLQR solves are not stacked: the k problems are solved one after the other '''
+        return [self.TO_Solve(ICS_states[j], init_TO_states[j], init_TO_controls[j], T) for j in range(len(ICS_states))]
\ No newline at end of file
@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import random
+import argparse
+import importlib
+import platform
+import subprocess
+import numpy as np
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # {'0' -> show all logs, '1' -> filter out info, '2' -> filter out warnings}
+import tensorflow as tf
+import casadi
+from RL import RL_AC, large_batch_conf
+from TO import TO_Casadi, TO_DDP
+from NeuralNetwork import NN
+from config_utils import Config, system_map, parse_overrides
+from parallel_utils import set_learner_execution
+from replay_buffer import PrioritizedReplayBuffer, ReplayBuffer, pack_record
+
+def parse_args():
+    ''' Parse the arguments for the CACTO benchmarks '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--system-id',                      type=str,   default=['all'], nargs='+',
+                        choices=['all'] + list(system_map),
+                        help="Systems to benchmark")
+
+    parser.add_argument('--seed',                           type=int,   default=0,
+                        help="random, np.random and tf.random seed")
+
+    parser.add_argument('--nb-TO',                          type=int,   default=10,
+                        help="Number of TO problems solved")
+
+    parser.add_argument('--repeats',                        type=int,   default=20,
+                        help="Number of timed calls of each benchmark (after one warm-up call)")
+
+    parser.add_argument('--batch-size',                     type=int,   default=0,
+                        help="Batch size of the dynamics, reward and NN benchmarks (0 -> conf.BATCH_SIZE)")
+
+    parser.add_argument('--set',                            type=str,   default=[], nargs='+', metavar='NAME=VALUE',
+                        help="Override configuration parameters, e.g. --set learner_intra_op_threads=4 critic_precision='mixed_bfloat16'")
+
+    parser.add_argument('--critic-sweep',                   action='store_true',
+                        help="Also benchmark the critic step of every critic architecture in every precision")
+
+    parser.add_argument('--out-dir',                        type=str,   default='./benchmarks',
+                        help="Folder where the JSON results (<system-id>_<commit>.json) are written")
+
+    parser.add_argument('--baseline',                       type=str,   default='',
+                        help="Commit whose results (in out-dir) are compared with the new ones")
+
+    args = parser.parse_args()
+    dict_args = vars(args)
+
+    return dict_args
+
+def git_commit():
+    ''' Return the current commit hash (with a '+' if the working tree is modified), None outside a git repository '''
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short=10', 'HEAD'], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + ('+' if dirty else '')
+
+def timing_stats(times, n_items=1):
+    ''' Summary of a list of call durations (s). Throughput is n_items processed per second at the median duration '''
+    times = np.asarray(times)
+
+    return {'calls': len(times), 'total_s': float(np.sum(times)), 'mean_s': float(np.mean(times)), 'median_s': float(np.median(times)),
+            'p95_s': float(np.percentile(times, 95)), 'min_s': float(np.min(times)), 'items_per_call': n_items,
+            'items_per_s': float(n_items/np.median(times)) if np.median(times) > 0 else None}
+
+def time_calls(fun, repeats, warmup=1):
+    ''' Call fun warmup+repeats times and return the durations of the last repeats calls '''
+    for _ in range(warmup):
+        fun()
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+
+    return times
+
+class Benchmark:
+    def __init__(self, system_id, seed=0, repeats=20, batch_size=0, overrides=None):
+        '''
+        Benchmarks of the hot paths of CACTO for one system, with the same instances (and configuration) used by main.py
+
+        :input system_id :                      (str) Id system
+        :input seed :                           (int) Seed of random, np.random and tf.random
+        :input repeats :                        (int) Number of timed calls of each benchmark
+        :input batch_size :                     (int) Batch size of the dynamics, reward and NN benchmarks (0 -> conf.BATCH_SIZE)
+        :input overrides :                      (dict) Configuration parameters to override (e.g. the execution profile of the learner)
+        '''
+        conf_module, env_class, env_TO_class = system_map[system_id]
+        self.system_id = system_id
+        self.seed = seed
+        self.repeats = repeats
+
+        self.conf = Config.from_module(importlib.import_module(conf_module))
+        if batch_size and batch_size != self.conf.BATCH_SIZE:
+            self.conf = self.conf.replace(BATCH_SIZE=batch_size)
+        if overrides:
+            self.conf = self.conf.replace(**overrides)
+        self.conf = large_batch_conf(self.conf)
+        self.batch_size = self.conf.BATCH_SIZE
+
+        # The thread pools can be set only by the first benchmark (before the TF runtime is initialized)
+        set_learner_execution(self.conf, 0)
+
+        self.set_seeds()
+        self.env_TO = getattr(importlib.import_module('environment_TO'), env_TO_class)
+        self.env = getattr(importlib.import_module('environment'), env_class)(self.conf)
+        self.NN = NN(self.env, self.conf)
+        self.TrOp = TO_DDP(self.env, self.conf, self.env_TO) if self.conf.TO_method == 'ddp' else TO_Casadi(self.env, self.conf, self.env_TO)
+        self.RLAC = RL_AC(self.env, self.NN, self.conf, 0)
+        self.RLAC.setup_model()
+
+        # Solutions of the TO benchmark, used by the backward-pass benchmark
+        self.TO_solutions = []
+
+    def set_seeds(self):
+        ''' Reset the seeds, so that every benchmark sees the same inputs '''
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        tf.random.set_seed(self.seed)
+
+    def sample_states_actions(self, n):
+        ''' Return n random initial states and n random-uniform actions within the control bounds '''
+        states = np.array([self.env.reset() for _ in range(n)])
+        actions = np.random.uniform(self.conf.u_min, self.conf.u_max, (n, self.conf.nb_action))
+
+        return states, actions
+
+    def new_buffer(self):
+        ''' Return an empty (prioritized) replay buffer '''
+        return ReplayBuffer(self.conf) if self.conf.prioritized_replay_alpha == 0 else PrioritizedReplayBuffer(self.conf)
+
+    def random_records(self, n):
+        ''' Return n trajectory records of random transitions of NSTEPS steps '''
+        T = self.conf.NSTEPS
+        records = []
+        for _ in range(n):
+            states = np.random.uniform(self.conf.x_init_min, self.conf.x_init_max, (T+1, self.conf.nb_state))
+            records.append(pack_record(self.conf, T, 0, states, np.random.randn(T+1), states, np.zeros((T+1, self.conf.nb_state)), np.zeros(T+1), np.zeros(T+1)))
+
+        return records
+
+    def bench_TO(self, nb_TO):
+        ''' TO solves (zero-control warm start as in the first loop of main.py): solves per second, median and p95 solve time, success rate '''
+        self.set_seeds()
+        self.TO_solutions = []
+        times = []
+        for _ in range(nb_TO):
+            init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH, success_init_flag = self.RLAC.create_TO_init(0, self.env.reset())
+            if success_init_flag == 0:
+                continue
+
+            start = time.perf_counter()
+            TO_controls, TO_states, success_flag, _, _, _ = self.TrOp.TO_Solve(init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH)
+            times.append(time.perf_counter() - start)
+
+            if success_flag:
+                self.TO_solutions.append((NSTEPS_SH, TO_states, TO_controls))
+
+        if len(times) == 0:
+            return None
+        stats = timing_stats(times)
+        stats['solves_per_s'] = len(times)/stats['total_s']
+        stats['success_rate'] = len(self.TO_solutions)/len(times)
+        stats['mean_horizon'] = float(np.mean([s[0] for s in self.TO_solutions])) if self.TO_solutions else None
+
+        return stats
+
+    def bench_backward_pass(self):
+        ''' DDP backward pass computing dV/dx along the solved TO trajectories (throughput in trajectory nodes per second) '''
+        if len(self.TO_solutions) == 0:
+            return None
+
+        times, nodes = [], 0
+        for NSTEPS_SH, TO_states, TO_controls in self.TO_solutions:
+            start = time.perf_counter()
+            self.TrOp.backward_pass(NSTEPS_SH+1, TO_states, TO_controls)
+            times.append(time.perf_counter() - start)
+            nodes += NSTEPS_SH+1
+
+        stats = timing_stats(times)
+        stats['nodes_per_s'] = nodes/stats['total_s']
+
+        return stats
+
+    def bench_dynamics(self):
+        ''' simulate_batch, derivative_batch and reward_batch on a batch of states (throughput in samples per second) '''
+        self.set_seeds()
+        states, actions = self.sample_states_actions(self.batch_size)
+        weights = np.tile(self.conf.cost_weights_running, (self.batch_size, 1))
+        actions_tf = tf.convert_to_tensor(actions, dtype=tf.float32)
+
+        return {'simulate_batch':   timing_stats(time_calls(lambda: self.env.simulate_batch(states, actions), self.repeats), self.batch_size),
+                'derivative_batch': timing_stats(time_calls(lambda: self.env.derivative_batch(states, actions), self.repeats), self.batch_size),
+                'reward_batch':     timing_stats(time_calls(lambda: self.env.reward_batch(weights, states, actions_tf), self.repeats), self.batch_size)}
+
+    def bench_replay(self):
+        ''' Replay buffer: add of EP_UPDATE episode records (transitions per second) and sample of a mini-batch '''
+        self.set_seeds()
+        records = self.random_records(min(self.conf.EP_UPDATE, max(1, self.conf.REPLAY_SIZE//(self.conf.NSTEPS+1))))
+        n_transitions = sum(self.conf.NSTEPS+1 for _ in records)
+        buffer = self.new_buffer()
+
+        add_times = time_calls(lambda: buffer.add_records(records), self.repeats)
+        sample_times = time_calls(buffer.sample, self.repeats)
+
+        return {'add': timing_stats(add_times, n_transitions), 'sample': timing_stats(sample_times, self.batch_size)}
+
+    def sample_batch(self):
+        ''' Return a mini-batch sampled from a buffer of random transitions '''
+        self.set_seeds()
+        buffer = self.new_buffer()
+        buffer.add_records(self.random_records(max(1, self.batch_size//(self.conf.NSTEPS+1) + 1)))
+
+        return buffer.sample()
+
+    def critic_step_fun(self, RLAC, batch):
+        ''' Return a function performing a critic step (gradient and Adam step) of RLAC on batch '''
+        state_batch, partial_reward_to_go_batch, state_next_rollout_batch, dVdx_batch, d_batch, term_batch, weights_batch, _ = batch
+
+        def critic_step():
+            critic_grad, _, _, _, _ = RLAC.NN.compute_critic_grad(RLAC.critic_model, RLAC.target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch, RLAC.critic_loss_scaler)
+            RLAC.critic_optimizer.apply_gradients(zip(critic_grad, RLAC.critic_model.trainable_variables))
+
+        return critic_step
+
+    def bench_updates(self):
+        ''' Critic step (gradient and Adam step), actor step and target-critic update on a fixed mini-batch (steps per second) '''
+        batch = self.sample_batch()
+        state_batch, _, _, _, _, term_batch, _, _ = batch
+        RLAC = self.RLAC
+        critic_step = self.critic_step_fun(RLAC, batch)
+
+        def actor_step():
+            actor_grad, _ = self.NN.compute_actor_grad(RLAC.actor_model, RLAC.critic_model, state_batch, term_batch, self.batch_size)
+            RLAC.actor_optimizer.apply_gradients(zip(actor_grad, RLAC.actor_model.trainable_variables))
+
+        def target_update():
+            RLAC.update_target(RLAC.target_critic.variables, RLAC.critic_model.variables)
+
+        results = {'critic_step': timing_stats(time_calls(critic_step, self.repeats)),
+                   'actor_step':  timing_stats(time_calls(actor_step, self.repeats)),
+                   'target_update': timing_stats(time_calls(target_update, self.repeats))}
+        for name in results:
+            results[name]['steps_per_s'] = results[name].pop('items_per_s')
+
+        return results
+
+    def bench_critic_sweep(self):
+        ''' Critic step of every critic architecture (NN.create_critic_*) in every precision, to choose the execution profile of the learner '''
+        batch = self.sample_batch()
+        results = {}
+        for critic_type in ['elu', 'sine', 'sine-elu', 'relu']:
+            for critic_precision in ['float32', 'mixed_bfloat16', 'mixed_float16']:
+                conf = self.conf.replace(critic_type=critic_type, critic_precision=critic_precision)
+                RLAC = RL_AC(self.env, NN(self.env, conf), conf, 0)
+                RLAC.setup_model()
+                stats = timing_stats(time_calls(self.critic_step_fun(RLAC, batch), self.repeats))
+                stats['steps_per_s'] = stats.pop('items_per_s')
+                results['{}/{}'.format(critic_type, critic_precision)] = stats
+
+        return results
+
+    def run(self, nb_TO, critic_sweep=False):
+        ''' Run all the benchmarks and return the results '''
+        results = {}
+        for name, bench in [('TO_solve', lambda: self.bench_TO(nb_TO)), ('backward_pass', self.bench_backward_pass), ('dynamics', self.bench_dynamics),
+                            ('replay', self.bench_replay), ('NN_updates', self.bench_updates)] + ([('critic_sweep', self.bench_critic_sweep)] if critic_sweep else []):
+            start = time.perf_counter()
+            results[name] = bench()
+            print('{:<20} {:<15} {:.2f} s'.format(self.system_id, name, time.perf_counter() - start))
+
+        return results
+
+def environment_info():
+    ''' Machine and library versions, to tell apart results obtained on different setups '''
+    return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'tensorflow': tf.__version__, 'casadi': casadi.__version__,
+            'TF_intra_op_threads': tf.config.threading.get_intra_op_parallelism_threads(),
+            'TF_inter_op_threads': tf.config.threading.get_inter_op_parallelism_threads()}
+
+def flatten_results(results, prefix=''):
+    ''' Flatten nested results into {'a/b/c': value} '''
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten_results(value, prefix + key + '/'))
+        else:
+            flat[prefix + key] = value
+
+    return flat
+
+def compare_results(baseline, results):
+    ''' Print the relative change of the throughputs and times of results w.r.t. baseline '''
+    old, new = flatten_results(baseline['results']), flatten_results(results['results'])
+    print('{} vs {} ({})'.format(results['commit'], baseline['commit'], results['system_id']))
+    for key in sorted(new):
+        if key in old and key.endswith(('_per_s', 'median_s', 'p95_s')) and old[key] and new[key] is not None:
+            print('    {:<45} {:>12.4g} -> {:>12.4g} ({:+.1%})'.format(key, old[key], new[key], new[key]/old[key] - 1))
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    system_ids = list(system_map) if 'all' in args['system_id'] else args['system_id']
+    commit = git_commit()
+    overrides = parse_overrides(args['set'])
+    os.makedirs(args['out_dir'], exist_ok=True)
+
+    for system_id in system_ids:
+        try:
+            bench = Benchmark(system_id, args['seed'], args['repeats'], args['batch_size'], overrides)
+        except ImportError as e:
+            print('System {} skipped: {}'.format(system_id, e))
+            continue
+
+        results = {'system_id': system_id, 'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'config_hash': bench.conf.hash(),
+                   'seed': args['seed'], 'repeats': args['repeats'], 'nb_TO': args['nb_TO'], 'batch_size': bench.batch_size, 'overrides': overrides,
+                   'environment': environment_info(), 'results': bench.run(args['nb_TO'], args['critic_sweep'])}
+
+        path = os.path.join(args['out_dir'], '{}_{}.json'.format(system_id, commit))
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written in {}'.format(path))
+
+        if args['baseline']:
+            baseline_path = os.path.join(args['out_dir'], '{}_{}.json'.format(system_id, args['baseline']))
+            if os.path.exists(baseline_path):
+                with open(baseline_path) as f:
+                    compare_results(json.load(f), results)
+            else:
+                print('No baseline results {}'.format(baseline_path))
@@ -0,0 +1,207 @@
+import os
+import re
+import atexit
+import queue
+import pickle
+import shutil
+import hashlib
+import threading
+import numpy as np
+
+# Files of a checkpoint: the .h5 file of each NN (format of RL_AC.RL_save_weights) or a single .npz file, and the training state
+CHECKPOINT_FILE = re.compile(r'^(?:(actor|critic|target_critic)_(\d+)\.h5|checkpoint_(\d+)\.npz|training_state_(\d+)\.pkl)$')
+
+# NNs saved in a checkpoint
+NETWORKS = ['actor', 'critic', 'target_critic']
+
+def checkpoint_files(folder):
+    ''' Files of the numbered checkpoints of a folder (update step -> list of file names), 'final' excluded '''
+    files = {}
+    if not os.path.isdir(folder):
+        return files
+
+    for file in os.listdir(folder):
+        match = CHECKPOINT_FILE.match(file)
+        if match:
+            files.setdefault(int(match.group(2) or match.group(3) or match.group(4)), []).append(file)
+
+    return files
+
+def complete_checkpoints(folder):
+    ''' Update steps of the complete checkpoints of a folder (.npz file, or .h5 files of all the NNs), sorted '''
+    steps = []
+    for step, files in checkpoint_files(folder).items():
+        if 'checkpoint_{}.npz'.format(step) in files or all('{}_{}.h5'.format(name, step) in files for name in NETWORKS):
+            steps.append(step)
+
+    return sorted(steps)
+
+def resumable_checkpoints(folder):
+    ''' Update steps of the complete checkpoints of a folder saved with a training state (end of a loop), sorted '''
+    files = checkpoint_files(folder)
+
+    return [step for step in complete_checkpoints(folder) if 'training_state_{}.pkl'.format(step) in files[step]]
+
+def weights_digest(content):
+    ''' Digest of the weights of a file (name -> list of arrays) '''
+    digest = hashlib.sha1()
+    for name, weights in content.items():
+        digest.update(name.encode())
+        for w in weights:
+            digest.update(str(w.shape).encode())
+            digest.update(np.ascontiguousarray(w).tobytes())
+
+    return digest.hexdigest()
+
+def save_npz(path, content):
+    ''' Write the weights of the NNs (name -> list of arrays) in a single uncompressed .npz file '''
+    np.savez(path, **{'{}_{}'.format(name, i): w for name, weights in content.items() for i, w in enumerate(weights)})
+
+def load_checkpoint(path):
+    ''' Read the weights of the NNs (name -> list of arrays) of a .npz checkpoint '''
+    content = {}
+    with np.load(path) as f:
+        for key in f.files:
+            name, i = key.rsplit('_', 1)
+            content.setdefault(name, {})[int(i)] = f[key]
+
+    return {name: [weights[i] for i in range(len(weights))] for name, weights in content.items()}
+
+def load_training_state(path):
+    ''' Read a training state written with a checkpoint '''
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+class CheckpointWriter:
+    def __init__(self):
+        '''
+        Background writer of the NNs checkpoints: the trainer submits snapshots of the weights (copied numpy arrays) and a
+        thread writes them, so that the update loop does not wait for the disk. A checkpoint is written either as the .h5 files
+        of RL_AC.RL_save_weights (through shadow models holding the snapshot) or as a single .npz file, always in a temporary
+        file renamed in place. A file with the same weights as the previous one of its folder is hard-linked instead of being
+        rewritten, and the old checkpoints are deleted according to the retention policy of the configuration
+        '''
+        self.thread = None
+        self.last_files = {}                    # (folder, file kind) -> (weights digest, path) of the last written file
+
+    def start(self):
+        ''' Start the writing thread (a few snapshots can wait in the queue, the trainer blocks if the disk falls behind). The queued checkpoints are also written if the process exits on an exception or SystemExit '''
+        self.queue = queue.Queue(maxsize=4)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, conf, folder, step, snapshot, shadow_models=None, training_state=None):
+        '''
+        Queue a checkpoint
+
+        :input conf :                           (Configuration file)
+
+            :param checkpoint_format :          (str) 'h5' -> one file per NN, 'npz' -> single file
+            :param checkpoint_keep_last :       (int) Number of most recent checkpoints kept (0 -> all)
+            :param checkpoint_keep_every :      (int) Also keep one checkpoint every checkpoint_keep_every (0 -> none)
+            :param save_interval :              (int) save NNs interval
+
+        :input folder :                         (str) Folder of the checkpoint
+
+        :input step :                           (int or str) Update step ('final' at the end of the training)
+
+        :input snapshot :                       (dict) Weights of each NN (name -> list of arrays, not modified afterwards)
+
+        :input shadow_models :                  (dict) Models with the architecture of each NN used to write the .h5 files (only accessed by the writing thread)
+
+        :input training_state :                 (dict) State to resume the training from the checkpoint (optimizers, loop index and, for a single instance of the process, RNGs), pickled in training_state_<step>.pkl
+        '''
+        if self.thread is None:
+            self.start()
+
+        self.queue.put((conf, folder, step, snapshot, shadow_models, training_state))
+
+    def run(self):
+        ''' Writing loop '''
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                self.write(*job)
+            except Exception as e:
+                print('WARNING: checkpoint {} of {} not written: {}'.format(job[2], job[1], e))
+            finally:
+                self.queue.task_done()
+
+    def write(self, conf, folder, step, snapshot, shadow_models, training_state):
+        ''' Write a checkpoint (NNs, then training state) and apply the retention policy to its folder '''
+        if conf.checkpoint_format == 'npz':
+            self.write_file(folder, 'checkpoint', '{}/checkpoint_{}.npz'.format(folder, step), snapshot, save_npz)
+        else:
+            for name, weights in snapshot.items():
+                model = shadow_models[name]
+                def save_h5(path, content):
+                    model.set_weights(content[name])
+                    model.save_weights(path)
+                self.write_file(folder, name, '{}/{}_{}.h5'.format(folder, name, step), {name: weights}, save_h5)
+
+        if training_state is not None:
+            path = '{}/training_state_{}.pkl'.format(folder, step)
+            with open(path + '.tmp', 'wb') as f:
+                pickle.dump(training_state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+
+        self.apply_retention(conf, folder)
+
+    def write_file(self, folder, kind, path, content, save):
+        ''' Write a file through a temporary one renamed in place (hard link of the previous file of the same kind if the weights did not change) '''
+        digest = weights_digest(content)
+        tmp = '{}.tmp{}'.format(*os.path.splitext(path))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+        last_digest, last_path = self.last_files.get((folder, kind), (None, None))
+        if digest == last_digest and os.path.exists(last_path):
+            try:
+                os.link(last_path, tmp)
+            except OSError:
+                shutil.copyfile(last_path, tmp)
+        else:
+            save(tmp, content)
+        os.replace(tmp, path)
+
+        self.last_files[(folder, kind)] = (digest, path)
+
+    def apply_retention(self, conf, folder):
+        ''' Delete the numbered checkpoints of folder other than the conf.checkpoint_keep_last most recent ones, one every conf.checkpoint_keep_every and the last resumable one ('final' is always kept) '''
+        if conf.checkpoint_keep_last <= 0:
+            return
+
+        files = checkpoint_files(folder)
+        steps = sorted(files)
+        keep = set(steps[-conf.checkpoint_keep_last:])
+        resumable = [step for step in steps if 'training_state_{}.pkl'.format(step) in files[step]]
+        if len(resumable) > 0:
+            keep.add(resumable[-1])
+        if conf.checkpoint_keep_every > 0:
+            keep |= {step for step in steps if int(step//conf.save_interval)%conf.checkpoint_keep_every == 0}
+
+        for step in steps:
+            if step not in keep:
+                for file in files[step]:
+                    os.remove(os.path.join(folder, file))
+
+    def flush(self):
+        ''' Wait until the queued checkpoints are written '''
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        ''' Write the queued checkpoints and stop the writing thread '''
+        if self.thread is not None:
+            atexit.unregister(self.close)
+            if self.queue.qsize() > 0:
+                print('Writing {} queued checkpoints'.format(self.queue.qsize()))
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+# Checkpoint writer of the process, shared by all the RL_AC instances
+checkpoints = CheckpointWriter()
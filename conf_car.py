@@ -20,6 +20,7 @@ MC = 0
 if not MC:
     UPDATE_RATE = 0.001                                                                                     # Homotopy rate to update the target critic network if TD(n) is used
     nsteps_TD_N = int(NSTEPS/4)                                                                             # Number of lookahed steps if TD(n) is used
+    TD_lambda = 0                                                                                           # λ of the λ-return bootstrapped with the target critic (0 -> n-step return)
 
 
 ### Savings parameters
@@ -200,4 +201,43 @@ fig_ax_lim = np.array([[-16, 16], [-16, 16]])
 
 
 
+### TO parameters
+TO_warm_start_duals = 0                                                                                     # Flag to warm-start the ipopt duals of the TO problems from the adjoint of their warm-start trajectory (actor rollout)
+TO_mu_init = 1e-6                                                                                           # Initial ipopt barrier parameter used when the duals are warm-started
+TO_shift_nodes = 0                                                                                          # Number of sub-problems re-solved from intermediate nodes of each TO solution (0 to disable)
+TO_shift_noise = 0.0                                                                                        # Perturbation of the sub-problems initial state (fraction of the initial-state range)
+TO_method = 'casadi'                                                                                        # TO backend - Either 'casadi' (ipopt) or 'ddp' (iLQR)
+DDP_max_iter = 200                                                                                          # Max number of iLQR iterations
+DDP_tol = 1e-6                                                                                              # Tolerance on the relative cost reduction to stop the iLQR iterations
+DDP_mu_init = 1e-6                                                                                          # Initial regularization of Q_uu
+DDP_mu_max = 1e10                                                                                           # Max regularization of Q_uu before declaring failure
+cache_path = './cache'                                                                                      # Folder of the on-disk caches keyed by the configuration hash (TO_DDP derivative functions), '' to disable. Clear it if the robot models change
+TO_batch_size = 1                                                                                           # Number of TO problems with the same horizon stacked in a single NLP (1 to solve them one by one)
+metrics_log_interval = 100                                                                                  # Number of updates between two logs of the training metrics (losses, TD errors, learning rates) if --tensorboard is used
+eval_log_interval = 10                                                                                      # Number of loops between two evaluations of the policy from init_states_sim (returns logged if --tensorboard is used)
+
+
+
+### Execution parameters (learner)
+learner_intra_op_threads = 0                                                                                # TF intra-op threads of the learner (0 -> TF default)
+learner_inter_op_threads = 0                                                                                # TF inter-op threads of the learner (0 -> TF default)
+learner_cores = 0                                                                                           # Physical cores reserved to the learner, the TO workers are pinned to the other ones (0 -> no pinning)
+critic_precision = 'float32'                                                                                # Precision of the critic computations - 'float32', 'mixed_bfloat16' (oneDNN bf16 kernels) or 'mixed_float16' (with loss scaling)
+
+
+
+### Large-batch training
+large_batch_factor = 1                                                                                      # Mini-batches of large_batch_factor*BATCH_SIZE transitions and large_batch_factor times fewer updates, LRs and intervals scaled accordingly (1 -> disabled)
+LR_scaling = 'sqrt'                                                                                         # Scaling of the LRs with large_batch_factor - Either 'linear' or 'sqrt'
+grad_accumulation_steps = 1                                                                                 # Number of micro-batches whose gradients are averaged before each optimizer step (1 -> no accumulation)
+
+
+
+### Checkpoints (NNs saved every save_interval updates, written in the background)
+checkpoint_format = 'h5'                                                                                    # Either 'h5' (actor, critic and target critic .h5 files) or 'npz' (single file per update step)
+checkpoint_keep_last = 0                                                                                    # Number of most recent checkpoints kept, the older ones are deleted (0 -> all kept)
+checkpoint_keep_every = 0                                                                                   # Also keep one checkpoint every checkpoint_keep_every (0 -> none)
+
+
+
 profile = 0                                                                                                 # Profile flag
\ No newline at end of file
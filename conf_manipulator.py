@@ -1,8 +1,7 @@
 import os
 import math
 import numpy as np
-import pinocchio.casadi as cpin
-from robot_utils import RobotWrapper, RobotSimulator
+from lazy_utils import lazy_conf_attributes, urdf_dimensions
 
 system_id = 'manipulator'
 
@@ -23,6 +22,7 @@ MC = 0
 if not MC:
     UPDATE_RATE = 0.001                                                                                    # Homotopy rate to update the target critic network
     nsteps_TD_N = int(NSTEPS/2)                                                                            # Number of lookahed steps if TD(n) is used
+    TD_lambda = 0                                                                                          # λ of the λ-return bootstrapped with the target critic (0 -> n-step return)
 
 
 ### Savings parameters
@@ -156,13 +156,8 @@ env_RL = 0
 ### Robot upload data
 URDF_FILENAME = "planar_manipulator_3dof.urdf" 
 modelPath = os.getcwd()+"/urdf/" + URDF_FILENAME  
-robot = RobotWrapper.BuildFromURDF(modelPath, [modelPath])
-nq = robot.nq
-nv = robot.nv
+nq, nv, na = urdf_dimensions(modelPath)                                                                     # Robot dimensions read from the URDF
 nx = nq + nv
-na = robot.na
-cmodel = cpin.Model(robot.model)
-cdata = cmodel.createData()
 end_effector_frame_id = 'EE'
 
 ### Dynamics parameters
@@ -170,18 +165,17 @@ dt = 0.05
 
 simulate_coulomb_friction = 0                                                                               # To simulate friction
 simulation_type = 'euler'                                                                                   # Either 'timestepping' or 'euler'
-tau_coulomb_max = 0*np.ones(robot.na)                                                                       # Expressed as percentage of torque max
+tau_coulomb_max = 0*np.ones(na)                                                                             # Expressed as percentage of torque max
 integration_scheme = 'E-Euler'                                                                              # TO integration scheme - Either 'E-Euler' or 'SI-Euler'
 
-q_init, v_init = np.array([math.pi, math.pi, math.pi]), np.zeros(robot.nv)
-simu = RobotSimulator(robot, q_init, v_init, simulation_type, tau_coulomb_max)
+q_init, v_init = np.array([math.pi, math.pi, math.pi]), np.zeros(nv)
 
 ### System configuration parameters
 x_base = -7.0                                                                                               # x coord base
 y_base = 0.0                                                                                                # y coord base
 
 ### State parameters 
-nb_state = robot.nq + robot.nv + 1                                                                          # State size (robot state size +1)
+nb_state = nq + nv + 1                                                                                      # State size (robot state size +1)
 x_min = np.array([-np.inf, -np.inf, -np.inf, -np.inf, -np.inf, -np.inf, 0])                                 # State lower bound vector
 x_init_min = np.array([-math.pi, -math.pi, -math.pi, -math.pi/4, -math.pi/4, -math.pi/4, 0])                # State lower bound initial configuration vector
 x_max = np.array([ np.inf,  np.inf,  np.inf,  np.inf,  np.inf,  np.inf, np.inf])                            # State upper bound vector
@@ -208,7 +202,7 @@ init_states_sim = [np.array([math.pi/4,    -math.pi/8, -math.pi/8, 0.0, 0.0, 0.0
                    #np.array([ 1.05348883, -1.9057266 ,  0.61849459, 0., 0., 0., 0. ])]
 
 ### Action parameters
-nb_action = robot.na                                                                                        # Action size
+nb_action = na                                                                                              # Action size
 tau_lower_bound = -200                                                                                      # Action lower bound
 tau_upper_bound = 200                                                                                       # Action upper bound
 u_min = tau_lower_bound*np.ones(nb_action)                                                                  # Action lower bound vector
@@ -221,5 +215,59 @@ w_b = 1/w_u
 fig_ax_lim = np.array([[-41, 31], [-35, 35]])                                                               # Figure axis limit [x_min, x_max, y_min, y_max]
 
 
+### Heavy objects, built on first access (importing the configuration does not import Pinocchio)
+def build_robot():
+    ''' Build the Pinocchio robot, its casadi model and the simulator '''
+    import pinocchio.casadi as cpin
+    from robot_utils import RobotWrapper, RobotSimulator
+
+    robot = RobotWrapper.BuildFromURDF(modelPath, [modelPath])
+    cmodel = cpin.Model(robot.model)
+    simu = RobotSimulator(robot, q_init, v_init, simulation_type, tau_coulomb_max)
+
+    return {'robot': robot, 'cmodel': cmodel, 'cdata': cmodel.createData(), 'simu': simu}
+
+__getattr__ = lazy_conf_attributes(globals(), build_robot, ['robot', 'cmodel', 'cdata', 'simu'])
+
+
+
+### TO parameters
+TO_warm_start_duals = 0                                                                                     # Flag to warm-start the ipopt duals of the TO problems from the adjoint of their warm-start trajectory (actor rollout)
+TO_mu_init = 1e-6                                                                                           # Initial ipopt barrier parameter used when the duals are warm-started
+TO_shift_nodes = 0                                                                                          # Number of sub-problems re-solved from intermediate nodes of each TO solution (0 to disable)
+TO_shift_noise = 0.0                                                                                        # Perturbation of the sub-problems initial state (fraction of the initial-state range)
+TO_method = 'casadi'                                                                                        # TO backend - Either 'casadi' (ipopt) or 'ddp' (iLQR)
+DDP_max_iter = 200                                                                                          # Max number of iLQR iterations
+DDP_tol = 1e-6                                                                                              # Tolerance on the relative cost reduction to stop the iLQR iterations
+DDP_mu_init = 1e-6                                                                                          # Initial regularization of Q_uu
+DDP_mu_max = 1e10                                                                                           # Max regularization of Q_uu before declaring failure
+cache_path = './cache'                                                                                      # Folder of the on-disk caches keyed by the configuration hash (TO_DDP derivative functions), '' to disable. Clear it if the robot models change
+TO_batch_size = 1                                                                                           # Number of TO problems with the same horizon stacked in a single NLP (1 to solve them one by one)
+metrics_log_interval = 100                                                                                  # Number of updates between two logs of the training metrics (losses, TD errors, learning rates) if --tensorboard is used
+eval_log_interval = 10                                                                                      # Number of loops between two evaluations of the policy from init_states_sim (returns logged if --tensorboard is used)
+
+
+
+### Execution parameters (learner)
+learner_intra_op_threads = 0                                                                                # TF intra-op threads of the learner (0 -> TF default)
+learner_inter_op_threads = 0                                                                                # TF inter-op threads of the learner (0 -> TF default)
+learner_cores = 0                                                                                           # Physical cores reserved to the learner, the TO workers are pinned to the other ones (0 -> no pinning)
+critic_precision = 'float32'                                                                                # Precision of the critic computations - 'float32', 'mixed_bfloat16' (oneDNN bf16 kernels) or 'mixed_float16' (with loss scaling)
+
+
+
+### Large-batch training
+large_batch_factor = 1                                                                                      # Mini-batches of large_batch_factor*BATCH_SIZE transitions and large_batch_factor times fewer updates, LRs and intervals scaled accordingly (1 -> disabled)
+LR_scaling = 'sqrt'                                                                                         # Scaling of the LRs with large_batch_factor - Either 'linear' or 'sqrt'
+grad_accumulation_steps = 1                                                                                 # Number of micro-batches whose gradients are averaged before each optimizer step (1 -> no accumulation)
+
+
+
+### Checkpoints (NNs saved every save_interval updates, written in the background)
+checkpoint_format = 'h5'                                                                                    # Either 'h5' (actor, critic and target critic .h5 files) or 'npz' (single file per update step)
+checkpoint_keep_last = 0                                                                                    # Number of most recent checkpoints kept, the older ones are deleted (0 -> all kept)
+checkpoint_keep_every = 0                                                                                   # Also keep one checkpoint every checkpoint_keep_every (0 -> none)
+
+
 
 profile = 0                                                                                                 # Profile flag
\ No newline at end of file
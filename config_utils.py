@@ -0,0 +1,130 @@
+import os
+import ast
+import json
+import hashlib
+import importlib
+import numpy as np
+
+# Configuration module, environment class and CAMS class of each system
+system_map = {
+    'single_integrator': ('conf_single_integrator', 'SingleIntegrator', 'SingleIntegrator_CAMS'),
+    'double_integrator': ('conf_double_integrator', 'DoubleIntegrator', 'DoubleIntegrator_CAMS'),
+    'car':               ('conf_car', 'Car', 'Car_CAMS'),
+    'car_park':          ('conf_car_park', 'CarPark', 'CarPark_CAMS'),
+    'manipulator':       ('conf_manipulator', 'Manipulator', 'Manipulator_CAMS'),
+    'ur5':               ('conf_ur5', 'UR5', 'UR5_CAMS')
+}
+
+# Types of the configuration parameters stored in a Config (anything else, e.g. the robot models, is read from the module)
+PARAM_TYPES = (bool, int, float, str, type(None), np.ndarray, np.number, np.bool_, list, tuple, dict)
+
+def is_param(value):
+    ''' True if value is a plain configuration parameter (also nested in lists, tuples and dicts) '''
+    if isinstance(value, (list, tuple)):
+        return all(is_param(x) for x in value)
+    if isinstance(value, dict):
+        return all(isinstance(k, str) and is_param(x) for k, x in value.items())
+
+    return isinstance(value, PARAM_TYPES)
+
+def encode_param(value):
+    ''' Canonical JSON-serializable encoding of a parameter, used to compute the configuration hash '''
+    if isinstance(value, np.ndarray):
+        return {'dtype': str(value.dtype), 'shape': list(value.shape), 'data': hashlib.sha256(np.ascontiguousarray(value).tobytes()).hexdigest()}
+    if isinstance(value, (np.number, np.bool_)):
+        return encode_param(value.item())
+    if isinstance(value, float):
+        return repr(value)                      # inf and nan are not valid JSON, repr is exact
+    if isinstance(value, (list, tuple)):
+        return [encode_param(x) for x in value]
+    if isinstance(value, dict):
+        return {k: encode_param(x) for k, x in value.items()}
+
+    return value
+
+def parse_overrides(items):
+    ''' Parse NAME=VALUE configuration overrides, VALUE being a Python literal (e.g. 4, 1e-3, 'mixed_bfloat16', [1, 2]) '''
+    return {name: ast.literal_eval(value) for name, value in (item.split('=', 1) for item in items)}
+
+class Config:
+    def __init__(self, module_name, params):
+        '''
+        Typed, read-only snapshot of the parameters of a configuration module with a stable content hash. It is cheap to
+        pickle (only the parameters are sent) and the heavy objects of the module (robot models, simulator) are read from the
+        module on first access, in the process where they are needed
+
+        :input module_name :                    (str) Name of the configuration module
+        :input params :                         (dict) Parameters (name -> value)
+        '''
+        self.__dict__.update(params)
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_types'] = {name: type(value) for name, value in params.items()}
+        self.__dict__['_hash'] = None
+
+    @classmethod
+    def from_module(cls, module):
+        ''' Create the Config of a configuration module '''
+        params = {name: value for name, value in vars(module).items() if not name.startswith('_') and is_param(value)}
+
+        return cls(module.__name__, params)
+
+    def __getattr__(self, name):
+        # Heavy or lazily built attributes (e.g. robot, cmodel, simu) are read from the module
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(importlib.import_module(self._module_name), name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Config is read-only, use replace() to change {}'.format(name))
+
+    def __getstate__(self):
+        return self._module_name, self.params()
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __repr__(self):
+        return 'Config({}, {})'.format(self._module_name, self.hash())
+
+    def params(self):
+        ''' Return the parameters (name -> value) '''
+        return {name: self.__dict__[name] for name in self._types}
+
+    def items(self):
+        ''' Return the (name, value) pairs of the parameters sorted by name '''
+        return sorted(self.params().items())
+
+    def replace(self, **changes):
+        ''' Return a copy of the Config with some parameters changed (the type of existing parameters is checked) '''
+        for name, value in changes.items():
+            if name in self._types:
+                expected = self._types[name]
+                if not (isinstance(value, expected) or (expected is float and isinstance(value, int)) or value is None or self.__dict__[name] is None):
+                    raise TypeError('{} must be {}, got {}'.format(name, expected.__name__, type(value).__name__))
+        params = self.params()
+        params.update(changes)
+
+        return Config(self._module_name, params)
+
+    def hash(self, names=None):
+        ''' Stable SHA-256 of the parameters (or of the subset names), used to key the on-disk caches (cache_dir) and recorded in the configuration dump '''
+        if names is None and self._hash is not None:
+            return self._hash
+
+        params = self.params() if names is None else {name: self.__dict__[name] for name in names}
+        digest = hashlib.sha256(json.dumps(encode_param(params), sort_keys=True).encode()).hexdigest()
+        if names is None:
+            self.__dict__['_hash'] = digest
+
+        return digest
+
+    def cache_dir(self, kind, names=None):
+        ''' Directory of an on-disk cache of artifacts derived from the configuration (e.g. the TO_DDP casadi functions) in conf.cache_path, keyed by the configuration hash (None if conf.cache_path is '') '''
+        if not self.__dict__.get('cache_path'):
+            return None
+
+        path = os.path.join(self.cache_path, kind, '{}_{}'.format(self._module_name, self.hash(names)[:16]))
+        os.makedirs(path, exist_ok=True)
+
+        return path
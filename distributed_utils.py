@@ -0,0 +1,269 @@
+import time
+import uuid
+import socket
+import secrets
+import threading
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+class JobBroker:
+    def __init__(self, lease_timeout=600, max_retries=3):
+        '''
+        Queue of TO jobs shared by the trainer and the TO workers. A job leased to a worker is re-queued if the worker does
+        not send back its result (or a heartbeat) within lease_timeout seconds, and it is dropped after max_retries attempts.
+
+        :input lease_timeout :                  (float) Seconds after which a job leased to a silent worker is re-queued
+        :input max_retries :                    (int) Max number of times a job is sent to a worker
+        '''
+        self.lease_timeout = lease_timeout
+        self.max_retries = max_retries
+
+        self.lock = threading.Lock()
+        self.queue = deque()                    # job ids waiting for a worker
+        self.payloads = {}                      # job id -> payload
+        self.attempts = {}                      # job id -> number of times the job has been leased
+        self.leases = {}                        # job id -> (worker id, deadline)
+        self.results = {}                       # job id -> result (None if the job failed max_retries times)
+        self.actor_weights = {}                 # version -> actor weights
+        self.closed = False
+
+    def submit(self, payloads):
+        ''' Add jobs to the queue and return their ids '''
+        with self.lock:
+            job_ids = []
+            for payload in payloads:
+                job_id = uuid.uuid4().hex
+                self.payloads[job_id] = payload
+                self.attempts[job_id] = 0
+                self.queue.append(job_id)
+                job_ids.append(job_id)
+
+        return job_ids
+
+    def set_actor_weights(self, version, weights):
+        ''' Publish the actor weights used by the workers to warm-start the jobs of a given version (older versions are dropped) '''
+        with self.lock:
+            self.actor_weights = {version: weights}
+
+    def get_actor_weights(self, version):
+        ''' Return the actor weights of a given version '''
+        with self.lock:
+            return self.actor_weights.get(version)
+
+    def retry_or_drop(self, job_id):
+        ''' Re-queue a job whose lease ended without result, or drop it (result None) if it reached max_retries '''
+        del self.leases[job_id]
+        if self.attempts[job_id] < self.max_retries:
+            self.queue.append(job_id)
+        else:
+            print('TO job {} dropped after {} attempts'.format(job_id, self.attempts[job_id]))
+            self.results[job_id] = None
+            del self.payloads[job_id]
+
+    def requeue_expired(self):
+        ''' Re-queue the jobs of lost workers (expired leases), or drop them if they reached max_retries '''
+        now = time.time()
+        for job_id, (worker_id, deadline) in list(self.leases.items()):
+            if deadline < now:
+                self.retry_or_drop(job_id)
+
+    def get_job(self, worker_id):
+        ''' Lease a job to a worker. Return (job id, payload), None if the queue is empty or 'closed' if the broker is shutting down '''
+        with self.lock:
+            if self.closed:
+                return 'closed'
+            self.requeue_expired()
+            if len(self.queue) == 0:
+                return None
+            job_id = self.queue.popleft()
+            self.attempts[job_id] += 1
+            self.leases[job_id] = (worker_id, time.time() + self.lease_timeout)
+
+            return job_id, self.payloads[job_id]
+
+    def heartbeat(self, worker_id, job_id):
+        ''' Extend the lease of the job a worker is running (the leases of its previous jobs are left to expire) '''
+        with self.lock:
+            if self.leases.get(job_id, (None,))[0] == worker_id:
+                self.leases[job_id] = (worker_id, time.time() + self.lease_timeout)
+
+    def fail_job(self, worker_id, job_id):
+        ''' Report a job that raised in a worker: it is re-queued at once, or dropped (result None) if it reached max_retries '''
+        with self.lock:
+            if self.leases.get(job_id, (None,))[0] == worker_id:
+                self.retry_or_drop(job_id)
+
+    def put_result(self, worker_id, job_id, result):
+        ''' Store the result of a job (results of re-queued jobs that arrive late are kept if the job is still pending) '''
+        with self.lock:
+            if job_id not in self.payloads:
+                return
+            self.results[job_id] = result
+            self.leases.pop(job_id, None)
+            if job_id in self.queue:
+                self.queue.remove(job_id)
+            del self.payloads[job_id]
+
+    def pop_results(self, job_ids):
+        ''' Remove and return the available results of the given jobs '''
+        with self.lock:
+            self.requeue_expired()
+            return {job_id: self.results.pop(job_id) for job_id in job_ids if job_id in self.results}
+
+    def close(self):
+        ''' Tell the workers to stop '''
+        with self.lock:
+            self.closed = True
+
+class LocalJobQueue(JobBroker):
+    def __init__(self, worker_fun, lease_timeout=600, max_retries=3):
+        '''
+        In-process stand-in of the TO job distribution: the jobs are run by the trainer itself (for testing and single-host debugging)
+
+        :input worker_fun :                     (function) Function computing the result of a job payload
+        '''
+        super().__init__(lease_timeout, max_retries)
+
+        self.worker_fun = worker_fun
+
+    def pop_results(self, job_ids):
+        ''' Run a queued job in-process and return the available results '''
+        job = self.get_job('local')
+        if job not in [None, 'closed']:
+            job_id, payload = job
+            try:
+                result = self.worker_fun(payload)
+            except Exception as e:
+                print('TO job {} failed: {}'.format(job_id, e))
+                self.fail_job('local', job_id)
+            else:
+                self.put_result('local', job_id, result)
+
+        return super().pop_results(job_ids)
+
+# Broker served through TCP by a multiprocessing manager
+broker = None
+
+def get_broker():
+    return broker
+
+class BrokerManager(BaseManager):
+    pass
+
+BrokerManager.register('get_broker', callable=get_broker)
+
+def parse_address(address):
+    ''' Convert 'host:port' into (host, port) '''
+    host, port = address.rsplit(':', 1)
+
+    return host, int(port)
+
+def is_loopback(host):
+    ''' Whether a host name resolves to a loopback address only '''
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except socket.gaierror:
+        return False
+
+    return len(addresses) > 0 and all(address.startswith('127.') or address == '::1' for address in addresses)
+
+def broker_authkey(address, authkey):
+    '''
+    Authentication key of a TCP broker. The manager unpickles the data it receives, so an explicit key is required to serve
+    the jobs on a non-loopback address; on a loopback one a random key is generated (and printed for the local workers)
+    '''
+    if authkey:
+        return authkey
+    if not is_loopback(parse_address(address)[0]):
+        raise ValueError('the TO broker at {} is reachable from other hosts: pass a secret --TO-authkey (shared with the TO workers)'.format(address))
+
+    authkey = secrets.token_hex(16)
+    print('TO broker authentication key (pass it to the TO workers with --TO-authkey): {}'.format(authkey))
+
+    return authkey
+
+def start_TCP_broker(address, authkey, lease_timeout=600, max_retries=3):
+    ''' Serve a JobBroker at address ('host:port') and return (manager, broker proxy) '''
+    global broker
+    broker = JobBroker(lease_timeout, max_retries)
+
+    manager = BrokerManager(address=parse_address(address), authkey=authkey.encode())
+    manager.start()
+
+    return manager, manager.get_broker()
+
+def connect_TCP_broker(address, authkey):
+    ''' Connect to the JobBroker served at address ('host:port') and return its proxy '''
+    manager = BrokerManager(address=parse_address(address), authkey=authkey.encode())
+    manager.connect()
+
+    return manager.get_broker()
+
+def run_TO_jobs(broker, payloads, poll_interval=0.05):
+    ''' Publish jobs and wait for all of them to be completed or dropped. Results are returned in the same order as payloads '''
+    job_ids = broker.submit(payloads)
+    results = {}
+    while len(results) < len(job_ids):
+        new_results = broker.pop_results([job_id for job_id in job_ids if job_id not in results])
+        results.update(new_results)
+        if len(new_results) == 0:
+            time.sleep(poll_interval)
+
+    return [results[job_id] for job_id in job_ids]
+
+def run_TO_worker(broker, worker_fun, set_actor_weights, poll_interval=0.5, heartbeat_period=10):
+    ''' Pull jobs (ep, ICS, actor-weights version) from the broker, compute them and push back the results until the broker is closed or lost '''
+    worker_id = uuid.uuid4().hex
+    actor_weights_version = None
+
+    # Keep the lease of the running job alive while the TO problem is being solved
+    stop = threading.Event()
+    running_job = [None]
+    def send_heartbeats():
+        while not stop.wait(heartbeat_period):
+            job_id = running_job[0]
+            if job_id is None:
+                continue
+            try:
+                broker.heartbeat(worker_id, job_id)
+            except (EOFError, OSError):
+                return
+    threading.Thread(target=send_heartbeats, daemon=True).start()
+
+    try:
+        while True:
+            job = broker.get_job(worker_id)
+            if job == 'closed':
+                break
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+
+            job_id, payload = job
+            version = payload[2]
+            if version != actor_weights_version:
+                weights = broker.get_actor_weights(version)
+                if weights is None:
+                    # Weights not published yet (or replaced by a newer version): give the job back rather than solving it with stale weights
+                    print('TO worker {}: no actor weights of version {} for job {}'.format(worker_id, version, job_id))
+                    broker.fail_job(worker_id, job_id)
+                    time.sleep(poll_interval)
+                    continue
+                set_actor_weights(weights)
+                actor_weights_version = version
+
+            running_job[0] = job_id
+            try:
+                result = worker_fun(payload)
+            except Exception as e:
+                # The broker re-queues the job (for another worker) or drops it after max_retries attempts
+                print('TO worker {}: job {} failed: {}'.format(worker_id, job_id, e))
+                broker.fail_job(worker_id, job_id)
+                continue
+            finally:
+                running_job[0] = None
+            broker.put_result(worker_id, job_id, result)
+    except (EOFError, OSError, ConnectionError):
+        print('TO worker {}: broker lost, stopping'.format(worker_id))
+    finally:
+        stop.set()
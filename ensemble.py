@@ -0,0 +1,140 @@
+import numpy as np
+import tensorflow as tf
+from telemetry_utils import telemetry
+from metrics_utils import metrics
+from RL import rng_state
+
+class RL_AC_Ensemble:
+    def __init__(self, members, NN, conf):
+        '''
+        Ensemble of independent actor-critic pairs (RL_AC instances with their own seed, replay buffer and N_try) trained in the
+        same process. At each update the critic steps and the target-critic updates of all the members are run in a single TF
+        graph (independent sub-graphs, executed concurrently by the inter-op thread pool), while the dynamics and reward terms of
+        the actor gradients are computed in a single batch over the members. Each member saves its weights and metrics in its
+        own N_try folder and TensorBoard run, as a single training would
+
+        :input members :                        (list of RL_AC instances, with the NN models already set up)
+
+        :input NN :                             (NN instance)
+
+        :input conf :                           (Configuration file)
+
+            :param UPDATE_LOOPS :               (int array) Number of updates of both critic and actor performed every EP_UPDATE episodes
+            :param grad_accumulation_steps :    (int) Number of micro-batches whose gradients are averaged (> 1 -> the members are updated one at a time)
+            :param prioritized_replay_alpha :   (float) α determines how much prioritization is used
+            :param MC :                         (bool) Flag to use MC or TD(n)
+            :param UPDATE_RATE :                (float) Homotopy rate to update the target critic network if TD(n) is used
+            :param save_interval :              (int) save NNs interval
+            :param metrics_log_interval :       (int) Number of updates between two logs of the training metrics
+            :param Log_path :                   (str) Log path
+        '''
+        self.members = members
+        self.NN = NN
+        self.conf = conf
+
+        return
+
+    def metrics_logdir(self, member):
+        ''' TensorBoard run of a member (the one of a single training with N_try = member.N_try) '''
+        return self.conf.Log_path + '/tensorboard{}'.format(member.N_try)
+
+    @tf.function
+    def critic_steps(self, batches):
+        ''' Update the critics of all the members (one batch each) in a single graph. Return the critic targets, critic and target-critic values and loss of each member '''
+        outputs = []
+        for member, (state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch) in zip(self.members, batches):
+            critic_grad, reward_to_go_batch, critic_value, target_critic_value, critic_loss = self.NN.compute_critic_grad(member.critic_model, member.target_critic, state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch, member.critic_loss_scaler)
+            member.critic_optimizer.apply_gradients(zip(critic_grad, member.critic_model.trainable_variables))
+            outputs.append((reward_to_go_batch, critic_value, target_critic_value, critic_loss))
+
+        return outputs
+
+    def actor_steps(self, state_batches, term_batches):
+        ''' Update the actors of all the members (one batch each), computing the dynamics and reward terms of their gradients in a single batch. Return the actor surrogate loss of each member '''
+        actions = [self.NN.eval(member.actor_model, state_batch) for member, state_batch in zip(self.members, state_batches)]
+        dynamics = self.NN.compute_actor_dynamics(tf.concat(state_batches, 0), tf.concat(actions, 0), np.concatenate(term_batches))
+
+        # Split the terms of the members
+        batch_sizes = [state_batch.shape[0] for state_batch in state_batches]
+        member_dynamics = zip(*[tf.split(x, batch_sizes) for x in dynamics])
+
+        actor_surrogate_losses = []
+        for member, state_batch, term_batch, batch_size, dynamics in zip(self.members, state_batches, term_batches, batch_sizes, member_dynamics):
+            actor_grad, actor_surrogate_loss = self.NN.compute_actor_grad(member.actor_model, member.critic_model, state_batch, term_batch, batch_size, dynamics)
+            member.actor_optimizer.apply_gradients(zip(actor_grad, member.actor_model.trainable_variables))
+            actor_surrogate_losses.append(actor_surrogate_loss)
+
+        return actor_surrogate_losses
+
+    @tf.function
+    def update_targets(self):
+        ''' Update the target critics of all the members in a single graph '''
+        tau = self.conf.UPDATE_RATE
+        for member in self.members:
+            for (a, b) in zip(member.target_critic.variables, member.critic_model.variables):
+                a.assign(b * tau + a * (1 - tau))
+
+    def update(self, batches):
+        ''' Update both critic and actor of all the members (one batch sampled from its buffer each). Return the outputs of RL_AC.update of each member '''
+        if self.conf.grad_accumulation_steps > 1:
+            outputs = []
+            for member, (state_batch, partial_reward_to_go_batch, state_next_rollout_batch, dVdx_batch, d_batch, term_batch, weights_batch, _) in zip(self.members, batches):
+                outputs.append(member.update(state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, term_batch, weights_batch))
+
+            return outputs
+
+        # Update the critics backpropagating the gradients
+        with telemetry.phase('critic_step'):
+            critic_outputs = self.critic_steps([(state_batch, state_next_rollout_batch, partial_reward_to_go_batch, dVdx_batch, d_batch, weights_batch) for state_batch, partial_reward_to_go_batch, state_next_rollout_batch, dVdx_batch, d_batch, _, weights_batch, _ in batches])
+
+        # Update the actors backpropagating the gradients
+        with telemetry.phase('actor_step'):
+            actor_surrogate_losses = self.actor_steps([batch[0] for batch in batches], [batch[5] for batch in batches])
+
+        return [critic_output + (actor_surrogate_loss,) for critic_output, actor_surrogate_loss in zip(critic_outputs, actor_surrogate_losses)]
+
+    def learn_and_update(self, update_step_counter, buffers, ep):
+        ''' Sample experience from the buffer of each member and update buffer priorities and NNs '''
+        start_step = update_step_counter
+        nb_updates = int(self.conf.UPDATE_LOOPS[ep])
+        for i in range(nb_updates):
+            # Sample batch of transitions from the buffers
+            with telemetry.phase('sampling'):
+                batches = [buffer.sample() for buffer in buffers]
+
+            # Update both critics and actors
+            outputs = self.update(batches)
+
+            # Update buffer priorities
+            if self.conf.prioritized_replay_alpha != 0:
+                for buffer, batch, (reward_to_go_batch, critic_value, target_critic_value, _, _) in zip(buffers, batches, outputs):
+                    buffer.update_priorities(batch[7], reward_to_go_batch, critic_value, target_critic_value)
+
+            # Update target critics
+            if not self.conf.MC:
+                with telemetry.phase('target_update'):
+                    self.update_targets()
+
+            update_step_counter += 1
+
+            # Log the training metrics of each member every conf.metrics_log_interval updates
+            if metrics.enabled and update_step_counter%self.conf.metrics_log_interval == 0:
+                for member, (reward_to_go_batch, critic_value, _, critic_loss, actor_surrogate_loss) in zip(self.members, outputs):
+                    member.log_metrics(update_step_counter, reward_to_go_batch, critic_value, critic_loss, actor_surrogate_loss, self.metrics_logdir(member))
+
+            # Save the NNs every conf.save_interval updates (at the end of the loop they are saved with the training states)
+            if update_step_counter%self.conf.save_interval == 0 and i < nb_updates-1:
+                with telemetry.phase('checkpoint'):
+                    self.RL_save_weights(update_step_counter)
+
+        # Resumable checkpoints (NNs and training states) at the end of a loop in which conf.save_interval updates were reached
+        if update_step_counter//self.conf.save_interval > start_step//self.conf.save_interval:
+            with telemetry.phase('checkpoint'):
+                self.RL_save_weights(update_step_counter, ep+1, buffers)
+
+        return update_step_counter
+
+    def RL_save_weights(self, update_step_counter='final', next_ep=None, buffers=None):
+        ''' Save NN weights (and, if next_ep is given, the training states with the content of the buffers) of all the members. The RNG states, shared by the members, are saved once with the first one '''
+        for i, member in enumerate(self.members):
+            member.RL_save_weights(update_step_counter, next_ep, rng_state() if i == 0 and next_ep is not None else None, buffers[i] if buffers is not None else None)
@@ -1,11 +1,14 @@
 import math
-import mpmath
 import random
 import numpy as np
-import tensorflow as tf
-import pinocchio as pin
 
 from utils import *
+from lazy_utils import lazy_import
+
+# Imported on first use
+tf = lazy_import('tensorflow')
+pin = lazy_import('pinocchio')
+mpmath = lazy_import('mpmath')
 
 class Env:
     def __init__(self, conf):
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import importlib
+import subprocess
+from config_utils import Config, system_map, parse_overrides
+from parallel_utils import cpus_by_core
+from checkpoint_utils import complete_checkpoints, resumable_checkpoints
+
+# Folder of main.py, the runs are executed there (the results paths of the configurations are relative to it)
+CACTO_path = os.path.dirname(os.path.abspath(__file__))
+
+def parse_args():
+    ''' Parse the arguments of the CACTO experiment runner '''
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--system-id',                      type=str,   default=['car'], nargs='+',
+                        choices=list(system_map),
+                        help="Systems of the sweep")
+
+    parser.add_argument('--seeds',                          type=int,   default=[29556, 5280, 739, 92, 10, 7298, 14, 264, 22135, 342], nargs='+',
+                        help="Seeds of the sweep")
+
+    parser.add_argument('--w-S',                            type=float, default=[0], nargs='+',
+                        help="Sobolev training weights of the sweep")
+
+    parser.add_argument('--test-n-start',                   type=int,   default=1,
+                        help="test-n of the first run of each system (the runs of a system are numbered consecutively)")
+
+    parser.add_argument('--cpus',                           type=int,   default=0,
+                        help="Physical cores shared by the runs (0 -> all the available ones)")
+
+    parser.add_argument('--parallel',                       type=int,   default=0,
+                        help="Max number of runs executed at the same time, each one pinned to an equal share of the cores (0 -> one run every 4 cores)")
+
+    parser.add_argument('--max-restarts',                   type=int,   default=2,
+                        help="Max number of restarts of a failed run (from its last saved NNs, if any)")
+
+    parser.add_argument('--set',                            type=str,   default=[], nargs='+', metavar='NAME=VALUE',
+                        help="Configuration overrides passed to all the runs (see main.py --set)")
+
+    parser.add_argument('--main-args',                      type=str,   default='',
+                        help="Other arguments passed to all the runs, e.g. --main-args='--TO-chunksize=2 --tensorboard'")
+
+    parser.add_argument('--out-dir',                        type=str,   default='./experiments',
+                        help="Folder of the run logs and of the index of the sweep (index.json)")
+
+    parser.add_argument('--resume',                         action='store_true',
+                        help="Skip the runs already completed in the index of out-dir and resume the other ones from their last checkpoint (without it, runs whose N_try folder already has checkpoints are refused)")
+
+    parser.add_argument('--poll-interval',                  type=float, default=5,
+                        help="Seconds between two checks of the running processes")
+
+    args = parser.parse_args()
+    dict_args = vars(args)
+
+    return dict_args
+
+def split_cores(cores, nb_slots):
+    ''' Split a list of physical cores (lists of logical CPUs) in nb_slots contiguous groups of (almost) equal size. Return the logical CPUs of each group '''
+    nb_slots = max(1, min(nb_slots, len(cores)))
+    slots, start = [], 0
+    for i in range(nb_slots):
+        size = len(cores)//nb_slots + (1 if i < len(cores)%nb_slots else 0)
+        slots.append([cpu for core in cores[start:start+size] for cpu in core])
+        start += size
+
+    return slots
+
+def cpus_by_core_of(cpus):
+    ''' Physical cores (lists of logical CPUs) of a set of logical CPUs '''
+    return [core for core in cpus_by_core() if set(core) <= set(cpus)]
+
+def last_checkpoint(NNs_path, N_try):
+    ''' Highest update step saved with a training state or, if there is none, whose NNs were all saved (None if there is none) '''
+    folder = '{}/N_try_{}'.format(NNs_path, N_try)
+    steps = resumable_checkpoints(folder) or complete_checkpoints(folder)
+
+    return steps[-1] if len(steps) > 0 else None
+
+class ExperimentRunner:
+    def __init__(self, runs, slots, max_restarts, main_args, out_dir, poll_interval=5, resume=False):
+        '''
+        Run a sweep of CACTO trainings (main.py processes) sharing a CPU budget. The budget is split in equal slots of physical
+        cores and each run is pinned to a free slot with one TO worker per core of the slot (the affinity is inherited by its
+        pools), so that concurrent runs never compete for the same cores. The queued runs take the slots in turn as the running
+        ones end. A failed run is restarted from the last checkpoint it saved (recover training) up to max_restarts times. The first
+        attempt of a run starts from scratch, unless resume is set. The status, paths and checkpoints of all the runs are kept in
+        out_dir/index.json
+
+        :input runs :                           (list of dict) Runs of the sweep (system_id, seed, w_S, test_n, NNs_path, ...)
+
+        :input slots :                          (list of lists) Logical CPUs of each slot
+
+        :input max_restarts :                   (int) Max number of restarts of a failed run
+
+        :input main_args :                      (list of str) Arguments passed to all the runs
+
+        :input out_dir :                        (str) Folder of the logs and of the index
+
+        :input poll_interval :                  (float) Seconds between two checks of the running processes
+
+        :input resume :                         (bool) Resume also the first attempt of the runs from their last checkpoint
+        '''
+        self.runs = runs
+        self.slots = slots
+        self.max_restarts = max_restarts
+        self.main_args = main_args
+        self.out_dir = out_dir
+        self.poll_interval = poll_interval
+        self.resume = resume
+
+        self.logs_path = os.path.join(out_dir, 'logs')
+        os.makedirs(self.logs_path, exist_ok=True)
+
+        self.processes = {}                     # slot index -> (run, process, log file)
+
+        return
+
+    def command(self, run, slot):
+        ''' Command line of a run (recovering the training from the last checkpoint, if given) '''
+        cmd = [sys.executable, '-u', 'main.py', '--system-id={}'.format(run['system_id']), '--test-n={}'.format(run['test_n']),
+               '--seed={}'.format(run['seed']), '--w-S={}'.format(run['w_S']), '--nb-cpus={}'.format(len(cpus_by_core_of(slot)))] + self.main_args
+
+        overrides = list(run['set'])
+        if run['last_checkpoint'] is not None:
+            cmd.append('--recover-training-flag=True')
+            overrides += ['NNs_path_rec={!r}'.format(run['NNs_path']), 'N_try_rec={}'.format(run['test_n']), 'update_step_counter_rec={}'.format(run['last_checkpoint'])]
+        if len(overrides) > 0:
+            cmd += ['--set'] + overrides
+
+        return cmd
+
+    def launch(self, run, slot_idx):
+        ''' Start a run pinned to the CPUs of a slot '''
+        slot = self.slots[slot_idx]
+        run['attempts'] += 1
+        # Checkpoints of an earlier sweep in the same folder are only used if resuming
+        run['last_checkpoint'] = last_checkpoint(os.path.join(CACTO_path, run['NNs_path']), run['test_n']) if run['attempts'] > 1 or self.resume else None
+        run['log'] = os.path.join(self.logs_path, '{}_{}.txt'.format(run['name'], run['attempts']))
+        run['cpus'] = slot
+        run['status'] = 'running'
+        run['start_time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+        log = open(run['log'], 'w')
+        process = subprocess.Popen(self.command(run, slot), stdout=log, stderr=subprocess.STDOUT, cwd=CACTO_path,
+                                   preexec_fn=(lambda: os.sched_setaffinity(0, slot)) if hasattr(os, 'sched_setaffinity') else None)
+        self.processes[slot_idx] = (run, process, log)
+        print('{} started on CPUs {} (attempt {}{})'.format(run['name'], slot, run['attempts'], ', recovered from update {}'.format(run['last_checkpoint']) if run['last_checkpoint'] is not None else ''))
+
+    def finish(self, slot_idx, returncode, queue):
+        ''' Record the end of the run of a slot, requeueing it (first) if it failed and can be restarted '''
+        run, _, log = self.processes.pop(slot_idx)
+        log.close()
+        run['returncode'] = returncode
+        run['end_time'] = time.strftime('%Y-%m-%d %H:%M:%S')
+        run['last_checkpoint'] = last_checkpoint(os.path.join(CACTO_path, run['NNs_path']), run['test_n'])
+
+        if returncode == 0:
+            run['status'] = 'done'
+        elif run['attempts'] <= self.max_restarts:
+            run['status'] = 'queued'
+            queue.insert(0, run)
+        else:
+            run['status'] = 'failed'
+        print('{} ended with code {} -> {}'.format(run['name'], returncode, run['status']))
+
+    def write_index(self):
+        ''' Write the index of the sweep (atomic replace) '''
+        path = os.path.join(self.out_dir, 'index.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'updated': time.strftime('%Y-%m-%d %H:%M:%S'), 'runs': self.runs}, f, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def run(self):
+        ''' Execute the queued runs of the sweep until all of them are done or failed '''
+        queue = [run for run in self.runs if run['status'] == 'queued']
+        try:
+            while len(queue) > 0 or len(self.processes) > 0:
+                for slot_idx in range(len(self.slots)):
+                    if slot_idx not in self.processes and len(queue) > 0:
+                        self.launch(queue.pop(0), slot_idx)
+                        self.write_index()
+
+                time.sleep(self.poll_interval)
+
+                for slot_idx, (run, process, _) in list(self.processes.items()):
+                    returncode = process.poll()
+                    if returncode is not None:
+                        self.finish(slot_idx, returncode, queue)
+                        self.write_index()
+        except KeyboardInterrupt:
+            for run, process, log in self.processes.values():
+                process.terminate()
+                process.wait()
+                log.close()
+                run['status'] = 'interrupted'
+            self.processes = {}
+            self.write_index()
+            raise
+
+def create_runs(system_ids, seeds, w_S_list, test_n_start, overrides):
+    ''' Runs of the sweep (all the combinations of systems, w_S values and seeds), numbered from test_n_start for each system '''
+    runs = []
+    for system_id in system_ids:
+        conf = Config.from_module(importlib.import_module(system_map[system_id][0])).replace(**parse_overrides(overrides))
+        for test_n, (w_S, seed) in enumerate(itertools.product(w_S_list, seeds), test_n_start):
+            runs.append({'name': '{}_{}'.format(system_id, test_n), 'system_id': system_id, 'seed': seed, 'w_S': w_S, 'test_n': test_n, 'set': overrides,
+                         'status': 'queued', 'attempts': 0, 'returncode': None, 'start_time': None, 'end_time': None, 'cpus': None, 'log': None,
+                         'NNs_path': conf.NNs_path, 'Fig_path': '{}/N_try_{}'.format(conf.Fig_path, test_n), 'config': '{}/config{}.txt'.format(conf.Config_path, test_n),
+                         'last_checkpoint': None})
+
+    return runs
+
+if __name__ == '__main__':
+
+    args = parse_args()
+
+    # CPU budget, split in slots of physical cores
+    cores = cpus_by_core()
+    if args['cpus'] > 0:
+        cores = cores[:args['cpus']]
+    runs = create_runs(args['system_id'], args['seeds'], args['w_S'], args['test_n_start'], args['set'])
+    parallel = args['parallel'] if args['parallel'] > 0 else max(1, len(cores)//4)
+    slots = split_cores(cores, min(parallel, len(runs)))
+
+    # Runs already completed in a previous execution of the sweep
+    index_path = os.path.join(args['out_dir'], 'index.json')
+    if args['resume'] and os.path.exists(index_path):
+        with open(index_path) as f:
+            done = {run['name']: run for run in json.load(f)['runs'] if run['status'] == 'done'}
+        runs = [done.get(run['name'], run) for run in runs]
+
+    # Refuse to overwrite (or silently resume) the checkpoints of an earlier sweep
+    if not args['resume']:
+        stale = [run['name'] for run in runs if run['status'] == 'queued' and last_checkpoint(os.path.join(CACTO_path, run['NNs_path']), run['test_n']) is not None]
+        if len(stale) > 0:
+            sys.exit('Checkpoints of an earlier sweep found for {}: use --resume, another --test-n-start or clear their N_try folders'.format(', '.join(stale)))
+
+    print('{} runs, {} at a time on {} physical cores ({} per run)'.format(len(runs), len(slots), len(cores), [len(cpus_by_core_of(slot)) for slot in slots]))
+
+    runner = ExperimentRunner(runs, slots, args['max_restarts'], args['main_args'].split(), args['out_dir'], args['poll_interval'], args['resume'])
+    runner.run()
+
+    print('Runs done: {}, failed: {}. Index: {}'.format(sum(run['status'] == 'done' for run in runs), sum(run['status'] == 'failed' for run in runs), index_path))
@@ -0,0 +1,69 @@
+import sys
+import time
+import importlib
+import importlib.util
+import xml.etree.ElementTree as ET
+
+# Time spent importing the heavy modules and building the deferred objects (name -> seconds), reported by print_import_report
+import_times = {}
+process_start = time.perf_counter()
+
+# Configuration (nq, nv) of each type of URDF joint
+URDF_JOINT_DIMENSIONS = {'fixed': (0, 0), 'revolute': (1, 1), 'continuous': (2, 1), 'prismatic': (1, 1), 'planar': (4, 3), 'floating': (7, 6)}
+
+def timed_import(name):
+    ''' Import a module recording its import time '''
+    if name in sys.modules:
+        return sys.modules[name]
+
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    import_times[name] = time.perf_counter() - start
+
+    return module
+
+class LazyModule:
+    def __init__(self, name):
+        ''' Module imported (and timed) on the first access to one of its attributes '''
+        self.__dict__['name'] = name
+
+    def __getattr__(self, attr):
+        return getattr(timed_import(self.name), attr)
+
+def lazy_import(name):
+    ''' Return the module if already imported, otherwise a LazyModule '''
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return LazyModule(name)
+
+def lazy_conf_attributes(module_globals, builder, names):
+    ''' Return a module __getattr__ (PEP 562) building the heavy attributes names of a configuration module with builder (returning a dict) on first access '''
+    def __getattr__(name):
+        if name not in names:
+            raise AttributeError("module '{}' has no attribute '{}'".format(module_globals['__name__'], name))
+
+        start = time.perf_counter()
+        module_globals.update(builder())
+        import_times['{}.{}'.format(module_globals['__name__'], builder.__name__)] = time.perf_counter() - start
+
+        return module_globals[name]
+
+    return __getattr__
+
+def urdf_dimensions(path):
+    ''' Return nq, nv, na of a fixed-base robot reading its URDF (without building the Pinocchio model) '''
+    nq, nv = 0, 0
+    for joint in ET.parse(path).getroot().iter('joint'):
+        joint_nq, joint_nv = URDF_JOINT_DIMENSIONS[joint.get('type')]
+        nq += joint_nq
+        nv += joint_nv
+
+    return nq, nv, nv
+
+def print_import_report(budget=1.0):
+    ''' Print the time spent importing heavy modules and building deferred objects, and the startup time against budget (s) '''
+    elapsed = time.perf_counter() - process_start
+    print('Startup time: {:.3f} s ({} the {:.1f} s budget)'.format(elapsed, 'within' if elapsed <= budget else 'over', budget))
+    for name, t in sorted(import_times.items(), key=lambda x: -x[1]):
+        print('    {:<50} {:.3f} s'.format(name, t))
@@ -2,18 +2,29 @@ import os
 import sys
 import time
 import shutil
+import signal
 import random
 import argparse
 import importlib
 import numpy as np
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3' # {'0' -> show all logs, '1' -> filter out info, '2' -> filter out warnings}
-import tensorflow as tf
 from multiprocessing import Pool
-from RL import RL_AC 
-from TO import TO_Casadi 
-from plot_utils import PLOT
+from lazy_utils import timed_import, print_import_report
+from config_utils import Config, system_map, parse_overrides
+from telemetry_utils import telemetry
+from profile_utils import sampler
+from metrics_utils import metrics
+from checkpoint_utils import checkpoints
+tf = timed_import('tensorflow')
+timed_import('casadi')
+from RL import RL_AC, large_batch_conf, restore_rng_state
+from ensemble import RL_AC_Ensemble
+from TO import TO_Casadi, TO_DDP
+from plot_utils import PLOT, PlotService
+from parallel_utils import init_TO_worker, resolve_nb_cpus, schedule_TO_jobs, TO_difficulty, set_learner_execution
+from distributed_utils import LocalJobQueue, broker_authkey, start_TCP_broker, connect_TCP_broker, run_TO_jobs, run_TO_worker
 from NeuralNetwork import NN
-from replay_buffer import PrioritizedReplayBuffer, ReplayBuffer
+from replay_buffer import PrioritizedReplayBuffer, ReplayBuffer, EpisodeStaging, pack_record, unpack_record
 
 def parse_args():
     ''' Parse the arguments for CACTO training '''
@@ -29,7 +40,7 @@ def parse_args():
                         choices=["single_integrator", "double_integrator", "car", "car_park", "manipulator", "ur5"],
                         help="System-id (single_integrator, double_integrator, car, manipulator, ur5")
 
-    parser.add_argument('--recover-training-flag',          type=bool,  default=False,
+    parser.add_argument('--recover-training-flag',          type=str,   default="False",
                         choices=["True", "False"],
                         help="Flag to recover training")
     ### Not tested ###
@@ -38,8 +49,42 @@ def parse_args():
     #                    help="Flag to use GPU")
     
     parser.add_argument('--nb-cpus',                        type=int,   default=10,
-                        help="Number of TO problems solved in parallel")
+                        help="Number of TO problems solved in parallel (0 -> number of physical cores)")
+
+    parser.add_argument('--TO-chunksize',                   type=int,   default=0,
+                        help="Number of TO problems sent to a worker at a time (0 -> adaptive)")
+
+    parser.add_argument('--TO-broker',                      type=str,   default='',
+                        help="TO jobs distribution: '' -> local pool of nb-cpus workers, 'local' -> in-process stand-in, 'host:port' -> serve the jobs to TO workers over TCP")
+
+    parser.add_argument('--TO-worker-of',                   type=str,   default='',
+                        help="Run nb-cpus TO workers pulling jobs from the broker at 'host:port' (no training)")
+
+    parser.add_argument('--TO-authkey',                     type=str,   default='',
+                        help="Secret authentication key of the TO broker, required by the TO workers and by a broker on a non-loopback address ('' -> random key printed by a loopback broker)")
     
+    parser.add_argument('--import-report',                  action='store_true',
+                        help="Print the time spent importing modules and building the robot models at startup")
+
+    parser.add_argument('--telemetry',                      type=str,   default='',
+                        choices=['', 'csv', 'jsonl'],
+                        help="Write per-loop timings of the training phases in Log_path/telemetry<test-n>.<csv|jsonl> ('' -> disabled)")
+
+    parser.add_argument('--profile-interval',               type=float, default=0,
+                        help="Sampling interval (ms) of the stack profiler of the trainer and of the local TO workers, collapsed stacks of each loop written in Log_path/profile<test-n>/ (0 -> disabled)")
+
+    parser.add_argument('--tensorboard',                    action='store_true',
+                        help="Write losses, TD errors, learning rates, buffer fill, TO success rate and policy evaluation returns in TensorBoard event files in Log_path/tensorboard<test-n>/")
+
+    parser.add_argument('--metrics-flush-interval',         type=float, default=10,
+                        help="Seconds between two writes of the buffered TensorBoard metrics")
+
+    parser.add_argument('--set',                            type=str,   default=[], nargs='+', metavar='NAME=VALUE',
+                        help="Override configuration parameters, e.g. --set NNs_path_rec='./Results Car/Results set 1/NNs' N_try_rec=1 update_step_counter_rec=4000")
+
+    parser.add_argument('--ensemble-size',                  type=int,   default=1,
+                        help="Number of actor-critic pairs trained together sharing the TO workers, member i with test-n+i and seed+i (the TO workers of a broker need the same value)")
+
     parser.add_argument('--w-S',                            type=float, default=0,
                         help="Sobolev training - weight of the value related error")
     
@@ -67,7 +112,7 @@ if __name__ == '__main__':
 
     system_id = args['system_id'] 
 
-    recover_training_flag = args['recover_training_flag']
+    recover_training_flag = args['recover_training_flag'] == "True"
     
     ### Not tested ###
     #GPU_flag = args['GPU_flag'] 
@@ -75,110 +120,212 @@ if __name__ == '__main__':
     #    os.environ["CUDA_VISIBLE_DEVICES"]="-1" 
     #print(tf.config.experimental.list_physical_devices('GPU'))
     
-    nb_cpus = args['nb_cpus']
+    nb_cpus = resolve_nb_cpus(args['nb_cpus'])
+
+    TO_chunksize = args['TO_chunksize']
+
+    TO_broker = args['TO_broker']
+    TO_worker_of = args['TO_worker_of']
+    TO_authkey = args['TO_authkey']
+    if TO_worker_of and not TO_authkey:
+        sys.exit('--TO-worker-of requires the --TO-authkey of the broker')
+    if TO_broker not in ['', 'local']:
+        TO_authkey = broker_authkey(TO_broker, TO_authkey)
 
     w_S = args['w_S']
+
+    # Ensemble members (N_try and seed of each one)
+    ensemble_size = args['ensemble_size']
+    N_tries = [N_try + i for i in range(ensemble_size)]
+    seeds = [seed + i for i in range(ensemble_size)]
     #########################################################
 
 
 
     # Import configuration file and environment file
-    system_map = {
-        'single_integrator': ('conf_single_integrator', 'SingleIntegrator', 'SingleIntegrator_CAMS'),
-        'double_integrator': ('conf_double_integrator', 'DoubleIntegrator', 'DoubleIntegrator_CAMS'),
-        'car':               ('conf_car', 'Car', 'Car_CAMS'),
-        'car_park':          ('conf_car_park', 'CarPark', 'CarPark_CAMS'),
-        'manipulator':       ('conf_manipulator', 'Manipulator', 'Manipulator_CAMS'),
-        'ur5':               ('conf_ur5', 'UR5', 'UR5_CAMS')
-    }
     try:
         conf_module, env_class, env_TO_class = system_map[system_id]
-        conf = importlib.import_module(conf_module)
-        Environment = getattr(importlib.import_module('environment'), env_class)
-        Environment_TO = getattr(importlib.import_module('environment_TO'), env_TO_class)
+        conf = Config.from_module(timed_import(conf_module)).replace(**parse_overrides(args['set']))
+        Environment = getattr(timed_import('environment'), env_class)
+        Environment_TO = getattr(timed_import('environment_TO'), env_TO_class)
     except KeyError:
         print('System {} not found'.format(system_id))
         sys.exit()
 
-    # Create folders to store the results and the trained NNs
-    for path in conf.path_list:
-        os.makedirs(path + '/N_try_{}'.format(N_try), exist_ok=True)
-    os.makedirs(conf.Config_path, exist_ok=True)
+    # Large-batch mode: larger mini-batches, fewer updates, LRs and intervals scaled (unchanged if conf.large_batch_factor = 1)
+    conf = large_batch_conf(conf)
+
+    # Results, configuration and code are stored by the trainer only (not by the TO workers)
+    if not TO_worker_of:
+        # Create folders to store the results and the trained NNs, save configuration and code (of each ensemble member)
+        for member_N_try, member_seed in zip(N_tries, seeds):
+            for path in conf.path_list:
+                os.makedirs(path + '/N_try_{}'.format(member_N_try), exist_ok=True)
+            os.makedirs(conf.Config_path, exist_ok=True)
 
-    # Save configuration
-    params = [p for p in conf.__dict__ if not p.startswith("__")]
-    with open(conf.Config_path + '/config{}.txt'.format(N_try), 'w') as f:
-        for p in params:
-            f.write('{} = {}\n'.format(p, conf.__dict__[p]))
-        f.write('Seed = {}\n'.format(seed))
-        f.write('w_S = {}'.format(w_S))
+            # Save configuration
+            with open(conf.Config_path + '/config{}.txt'.format(member_N_try), 'w') as f:
+                for p, value in conf.items():
+                    f.write('{} = {}\n'.format(p, value))
+                f.write('Config hash = {}\n'.format(conf.hash()))
+                f.write('Seed = {}\n'.format(member_seed))
+                f.write('w_S = {}'.format(w_S))
 
-    shutil.copy('{}.py'.format(conf_module), conf.Config_path + '/' + conf_module + '_{}.py'.format(N_try))
-    with open(conf.Config_path + '/' + conf_module + '_{}.py'.format(N_try), 'a') as f:
-        f.write('\n\n# {}'.format(args))
+            shutil.copy('{}.py'.format(conf_module), conf.Config_path + '/' + conf_module + '_{}.py'.format(member_N_try))
+            with open(conf.Config_path + '/' + conf_module + '_{}.py'.format(member_N_try), 'a') as f:
+                f.write('\n\n# {}'.format(args))
 
-    # Copy all file with .py extension from /mydir to /mydestdir
-    for file in os.listdir("./"):
-        if file.endswith(".py"):
-            shutil.copy(os.path.join("./", file), os.path.join(conf.Code_path + '/N_try_{}'.format(N_try), file))
+            # Copy all file with .py extension from /mydir to /mydestdir
+            for file in os.listdir("./"):
+                if file.endswith(".py"):
+                    shutil.copy(os.path.join("./", file), os.path.join(conf.Code_path + '/N_try_{}'.format(member_N_try), file))
 
-    # Create empty txt file in Log_path to store the test info
-    open(conf.Log_path + '/info.txt', 'a').close()
+        # Create empty txt file in Log_path to store the test info
+        open(conf.Log_path + '/info.txt', 'a').close()
 
 
 
+    # TF thread pools of the learner and cores reserved to it (before the TF runtime is initialized)
+    if not TO_worker_of:
+        TO_cores = set_learner_execution(conf, args['nb_cpus'])
+
+        # Without an explicit --nb-cpus, one TO worker per core left to the workers
+        if args['nb_cpus'] <= 0:
+            nb_cpus = TO_cores
+
     ### Create instances of the used classes ###
     env = Environment(conf)                                                                                 # Create environment instances
     env_TO = Environment_TO
     NN_inst = NN(env, conf, w_S)                                                                            # Create NN instance
-    TrOp = TO_Casadi(env, conf, env_TO, w_S)                                                                # Create TO instance
-    RLAC = RL_AC(env, NN_inst, conf, N_try)                                                                 # Create RL instance
-    buffer = ReplayBuffer(conf) if conf.prioritized_replay_alpha == 0 else PrioritizedReplayBuffer(conf)    # Create an empty (prioritized) replay buffer
-    plot_fun = PLOT(N_try, env, NN_inst, conf)                                                              # Create PLOT instance
-
-    # Set initial weights of the NNs, initialize the counter of the updates and setup NN models
-    if recover_training_flag:
-        recover_training = np.array([conf.NNs_path_rec, conf.N_try_rec, conf.update_step_counter_rec])
-        update_step_counter = conf.update_step_counter_rec
-
-        RLAC.setup_model(recover_training)
-    else:
-        update_step_counter = 0
-
-        RLAC.setup_model()
-
-    # Save initial weights of the NNs
-    RLAC.RL_save_weights(update_step_counter)
-
-    # Plot initial rollouts
-    plot_fun.plot_traj_from_ICS(np.array(conf.init_states_sim), TrOp, RLAC, update_step_counter=update_step_counter,steps=conf.NSTEPS, init=0)
-
-    # Initialize arrays to store the reward history of each episode and the average reward history of last 100 episodes
-    ep_arr_idx = 0
-    ep_reward_arr = np.zeros(conf.NEPISODES-ep_arr_idx)*np.nan                                                                                     
+    TrOp = TO_DDP(env, conf, env_TO, w_S) if conf.TO_method == 'ddp' else TO_Casadi(env, conf, env_TO, w_S) # Create TO instance (iLQR or ipopt backend)
+    RLACs = [RL_AC(env, NN_inst, conf, member_N_try) for member_N_try in N_tries]                          # Create RL instances (one per ensemble member)
+    buffers = [ReplayBuffer(conf) if conf.prioritized_replay_alpha == 0 else PrioritizedReplayBuffer(conf) for _ in N_tries] # Create empty (prioritized) replay buffers
+    plot_fun = PLOT(N_try, env, NN_inst, conf, env_TO)                                                      # Create PLOT instance
+    RLAC, buffer = RLACs[0], buffers[0]
+    ensemble = RL_AC_Ensemble(RLACs, NN_inst, conf) if ensemble_size > 1 else None
+
+    # Shared-memory staging area of the trajectory records computed by the local TO workers (not used by remote workers)
+    staging = EpisodeStaging(conf, ensemble_size*conf.EP_UPDATE*(1+conf.TO_shift_nodes)) if not (TO_broker or TO_worker_of) else None
+
+    # Set initial weights of the NNs, initialize the counter of the updates and setup NN models (the weights of the other ensemble members are initialized with their own seed)
+    update_step_counter = conf.update_step_counter_rec if recover_training_flag else 0
+    for i, member in enumerate(RLACs):
+        if i > 0:
+            tf.random.set_seed(seeds[i])
+
+        if recover_training_flag:
+            recover_training = np.array([conf.NNs_path_rec, conf.N_try_rec + i, conf.update_step_counter_rec])
+
+            member.setup_model(recover_training)
+        else:
+            member.setup_model()
+
+    # Restore the replay buffers and, once, the RNG states of the process (saved with the first member) after all the members are set up
+    for member, member_buffer in zip(RLACs, buffers):
+        if member.resume_buffer_state is not None:
+            member_buffer.set_state(member.resume_buffer_state)
+            member.resume_buffer_state = None
+    if RLAC.resume_rng_state is not None:
+        restore_rng_state(RLAC.resume_rng_state)
+
+    if args['import_report']:
+        print_import_report()
+
+    # Initialize arrays to store the reward history of each episode and the average reward history of last 100 episodes (of each ensemble member)
+    ep_arr_idx = [0]*ensemble_size
+    ep_reward_arr = [np.zeros(conf.NEPISODES*(1+conf.TO_shift_nodes))*np.nan for _ in N_tries]                                                                                     
 
     def compute_sample(args):
-        ''' Create samples solving TO problems starting from given ICS '''
+        ''' Create samples solving TO problems starting from given ICS (and, if conf.TO_shift_nodes > 0, from intermediate nodes of the solution) with the NNs of an ensemble member '''
         ep = args[0]
         ICS = args[1]
+        RLAC = RLACs[int(args[2])]
+        samples = []
 
         # Create initial TO #
-        init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH, success_init_flag = RLAC.create_TO_init(ep, ICS)
+        with telemetry.phase('warm_start_rollout'):
+            init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH, success_init_flag = RLAC.create_TO_init(ep, ICS)
         if success_init_flag == 0:
-            return None
+            return samples
             
         # Solve TO problem #
         TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx = TrOp.TO_Solve(init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH)
         if success_flag == 0:
-            return None
+            return samples
         
         # Collect experiences 
-        state_arr, partial_reward_to_go_arr, total_reward_to_go_arr, state_next_rollout_arr, done_arr, rwrd_arr, term_arr, ep_return, RL_ee_pos_arr  = RLAC.RL_Solve(TO_controls, TO_states, TO_step_cost)
+        samples.append(collect_sample(RLAC, NSTEPS_SH, TO_controls, TO_states, TO_ee_pos_arr, TO_step_cost, dVdx))
+
+        # Re-solve the sub-problems starting at intermediate nodes warm-started from the shifted solution (tail of an optimal trajectory)
+        TO_lam_g = TrOp.TO_lam_g
+        full_TO_states, full_TO_controls = TO_states, TO_controls
+        for k in np.unique(np.linspace(0, NSTEPS_SH, conf.TO_shift_nodes+2, dtype=int)[1:-1]):
+            if k == 0:
+                continue
+            init_shift_state, init_TO_states, init_TO_controls, NSTEPS_SH_k, success_init_flag = RLAC.create_TO_shift_init(full_TO_states, full_TO_controls, k)
+            if success_init_flag == 0:
+                continue
 
-        if conf.env_RL == 0:
-            RL_ee_pos_arr = TO_ee_pos_arr
+            TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx = TrOp.TO_Solve(init_shift_state, init_TO_states, init_TO_controls, NSTEPS_SH_k, TrOp.shift_duals(TO_lam_g, k))
+            if success_flag == 0:
+                continue
 
-        return NSTEPS_SH, TO_controls, TO_ee_pos_arr, dVdx, state_arr.tolist(), partial_reward_to_go_arr, state_next_rollout_arr, done_arr, rwrd_arr, term_arr, ep_return, RL_ee_pos_arr
+            samples.append(collect_sample(RLAC, NSTEPS_SH_k, TO_controls, TO_states, TO_ee_pos_arr, TO_step_cost, dVdx))
+
+        return samples
+
+    def compute_sample_batch(args):
+        ''' Create samples solving k TO problems with the same horizon (starting from the given ICS) in a single NLP with the NNs of an ensemble member '''
+        ep = args[0]
+        ICS_batch = args[1]
+        RLAC = RLACs[int(args[2])]
+        samples = []
+
+        # Create initial TOs, storing the RL arrays of each problem (RLAC keeps only those of the last one)
+        init_list = []
+        for ICS in ICS_batch:
+            with telemetry.phase('warm_start_rollout'):
+                init_rand_state, init_TO_states, init_TO_controls, NSTEPS_SH, success_init_flag = RLAC.create_TO_init(ep, ICS)
+            if success_init_flag:
+                init_list.append((init_rand_state, init_TO_states, init_TO_controls, np.copy(RLAC.state_arr), np.copy(RLAC.ee_pos_arr)))
+        if len(init_list) == 0:
+            return samples
+        init_rand_states, init_TO_states, init_TO_controls, RL_state_arrs, RL_ee_pos_arrs = zip(*init_list)
+
+        # Solve TO problems #
+        TO_solutions = TrOp.TO_Solve_batch(init_rand_states, init_TO_states, init_TO_controls, NSTEPS_SH)
+
+        # Collect experiences 
+        for j, (TO_controls, TO_states, success_flag, TO_ee_pos_arr, TO_step_cost, dVdx) in enumerate(TO_solutions):
+            if success_flag == 0:
+                continue
+            RLAC.NSTEPS_SH, RLAC.state_arr, RLAC.ee_pos_arr = NSTEPS_SH, RL_state_arrs[j], RL_ee_pos_arrs[j]
+            samples.append(collect_sample(RLAC, NSTEPS_SH, TO_controls, TO_states, TO_ee_pos_arr, TO_step_cost, dVdx))
+
+        return samples
+
+    def create_TO_batches(init_rand_state):
+        ''' Group the ICS with the same TO horizon (same initial time) in batches of conf.TO_batch_size problems '''
+        horizons = {}
+        for ICS in init_rand_state:
+            horizons.setdefault(conf.NSTEPS - int(ICS[-1]/conf.dt), []).append(ICS)
+
+        batches = []
+        for ICS_list in horizons.values():
+            for i in range(0, len(ICS_list), conf.TO_batch_size):
+                batches.append(ICS_list[i:i+conf.TO_batch_size])
+
+        return batches
+
+    def collect_sample(RLAC, NSTEPS_SH, TO_controls, TO_states, TO_ee_pos_arr, TO_step_cost, dVdx):
+        ''' Collect the experiences of a solved TO problem in a compact trajectory record (written in the shared staging area if available, otherwise sent to the parent as a single float32 buffer) '''
+        with telemetry.phase('RL_solve'):
+            state_arr, partial_reward_to_go_arr, total_reward_to_go_arr, state_next_rollout_arr, done_arr, rwrd_arr, term_arr, ep_return, RL_ee_pos_arr  = RLAC.RL_Solve(TO_controls, TO_states, TO_step_cost)
+
+        if staging is not None:
+            return staging.put(NSTEPS_SH, ep_return, state_arr, partial_reward_to_go_arr, state_next_rollout_arr, dVdx, done_arr, term_arr)
+
+        return pack_record(conf, NSTEPS_SH, ep_return, state_arr, partial_reward_to_go_arr, state_next_rollout_arr, dVdx, done_arr, term_arr)
 
     def create_unif_TO_init(n_UICS=1):
         ''' Create n uniformely distributed ICS '''
@@ -189,6 +336,57 @@ if __name__ == '__main__':
     
 
 
+    def member_TO_job(args):
+        ''' Compute the samples of a TO job (ep, ICS or batch of ICS, ensemble member). Return them with the member, as the local pool returns the results unordered '''
+        if conf.TO_batch_size > 1:
+            return int(args[2]), compute_sample_batch(args)
+
+        return int(args[2]), compute_sample(args)
+
+    def TO_job(payload):
+        ''' Compute the samples of a distributed TO job (ep, ICS or batch of ICS, actor-weights version, ensemble member) '''
+        return member_TO_job((payload[0], payload[1], payload[3]))
+
+    def set_NNs_weights(weights):
+        ''' Set the weights of the actors (TO warm-start) and of the target critics (λ-return) of the ensemble members published by the trainer '''
+        for member, (actor_weights, target_critic_weights) in zip(RLACs, weights):
+            member.actor_model.set_weights(actor_weights)
+            member.target_critic.set_weights(target_critic_weights)
+
+    ### TO WORKERS ###
+    if TO_worker_of:
+        def TO_worker_loop(worker_idx):
+            ''' Pull TO jobs from the broker until training ends '''
+            broker = connect_TCP_broker(TO_worker_of, TO_authkey)
+            run_TO_worker(broker, TO_job, set_NNs_weights)
+
+        with Pool(nb_cpus, initializer=init_TO_worker, initargs=(1, seed)) as p:
+            p.map(TO_worker_loop, range(nb_cpus))
+        sys.exit()
+
+    # Create the TO jobs broker
+    if TO_broker == 'local':
+        broker = LocalJobQueue(TO_job)
+    elif TO_broker:
+        broker_manager, broker = start_TCP_broker(TO_broker, TO_authkey)
+
+    # Save initial weights of the NNs
+    for member in RLACs:
+        member.RL_save_weights(update_step_counter)
+
+    # Stopped with SIGTERM (e.g. by the experiment runner): exit through SystemExit so that the queued checkpoints are written (the forked processes exit at once)
+    trainer_pid = os.getpid()
+    def stop_training(signum, frame):
+        if os.getpid() != trainer_pid:
+            os._exit(128 + signum)
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, stop_training)
+
+    # Start the plotting process and plot initial rollouts (no process is forked while the checkpoint writer is writing)
+    checkpoints.flush()
+    plot_service = PlotService(plot_fun, TrOp, RLAC, system_id, nb_cpus)
+    plot_service.submit(update_step_counter, init=0)
+
     ### START TRAINING ###
     if conf.profile:
         import cProfile, pstats
@@ -196,26 +394,86 @@ if __name__ == '__main__':
         profiler = cProfile.Profile()
         profiler.enable()
 
-    time_start = time.time()
+    # Per-phase timings (the TO workers forked from now on send theirs to the trainer)
+    if args['telemetry']:
+        telemetry.enable(conf.Log_path + '/telemetry{}.{}'.format(N_try, args['telemetry']))
 
-    for ep in range(conf.NLOOPS): 
-        # Generate and store conf.EP_UPDATE random-uniform ICS
-        with Pool(nb_cpus) as p: 
-            init_rand_state = p.map(create_unif_TO_init, range(conf.EP_UPDATE))
+    # TensorBoard metrics, written asynchronously
+    if args['tensorboard']:
+        metrics.enable(conf.Log_path + '/tensorboard{}'.format(N_try), args['metrics_flush_interval'])
 
-        # Generate samples
-        with Pool(nb_cpus) as p: 
-            tmp = p.map(compute_sample, zip(ep*np.ones(conf.EP_UPDATE), init_rand_state))
-            
-        # Remove unsuccessful TO problems and update EP_UPDATE
-        tmp = [x for x in tmp if x is not None]
-        NSTEPS_SH, TO_controls, ee_pos_arr_TO, dVdx, state_arr, partial_reward_to_go_arr, state_next_rollout_arr, done_arr, rwrd_arr, term_arr, ep_return, ee_pos_arr_RL = zip(*tmp)
+    # Sampling profiler of the trainer and of the TO workers (flame-graph stacks of each loop)
+    if args['profile_interval'] > 0:
+        sampler.enable(conf.Log_path + '/profile{}'.format(N_try), args['profile_interval']/1000)
 
-        # Update the buffer
-        buffer.add(state_arr, partial_reward_to_go_arr, state_next_rollout_arr, dVdx, done_arr, term_arr)
+    time_start = time.time()
+
+    # Resume from the loop following the recovered checkpoint (0 if the training state was not recovered)
+    for ep in range(RLAC.resume_ep, conf.NLOOPS): 
+        # The pools are forked once the checkpoint writer is idle (not holding h5py/TF locks in the middle of a write)
+        checkpoints.flush()
+
+        # Generate and store conf.EP_UPDATE random-uniform ICS (for each ensemble member)
+        with telemetry.phase('ICS_generation'), Pool(nb_cpus) as p: 
+            init_rand_state = p.map(create_unif_TO_init, range(ensemble_size*conf.EP_UPDATE))
+
+        # Create the TO jobs of each member (one ICS or a batch of conf.TO_batch_size ICS with the same horizon per job) and predict their difficulty
+        TO_jobs, TO_job_members = [], []
+        for member in range(ensemble_size):
+            member_ICS = init_rand_state[member*conf.EP_UPDATE:(member+1)*conf.EP_UPDATE]
+            member_jobs = create_TO_batches(member_ICS) if conf.TO_batch_size > 1 else member_ICS
+            TO_jobs += member_jobs
+            TO_job_members += [member]*len(member_jobs)
+        if conf.TO_batch_size > 1:
+            difficulties = [sum(TO_difficulty(conf, env, ICS) for ICS in ICS_batch) for ICS_batch in TO_jobs]
+        else:
+            difficulties = [TO_difficulty(conf, env, ICS) for ICS in TO_jobs]
+
+        # Generate samples, most difficult problems (of all the members) first
+        with telemetry.phase('TO_jobs'):
+            if TO_broker:
+                broker.set_actor_weights(ep, [[member.actor_model.get_weights(), member.target_critic.get_weights()] for member in RLACs])
+                order = np.argsort(-np.asarray(difficulties), kind='stable')
+                tmp = run_TO_jobs(broker, [(ep, TO_jobs[i], ep, TO_job_members[i]) for i in order])
+                tmp = [result if result is not None else (TO_job_members[i], []) for i, result in zip(order, tmp)]      # Jobs dropped after too many lost workers
+            else:
+                with Pool(nb_cpus, initializer=init_TO_worker, initargs=(1, [seed, ep])) as p: 
+                    tmp = schedule_TO_jobs(p, nb_cpus, member_TO_job, zip(ep*np.ones(len(TO_jobs)), TO_jobs, TO_job_members), difficulties, TO_chunksize)
+            
+        # Remove unsuccessful TO problems (flattening the samples of each ICS, by member) and update EP_UPDATE
+        member_records = [[] for _ in range(ensemble_size)]
+        for member, samples in tmp:
+            member_records[member] += samples
+        if staging is not None:
+            member_records = [[staging.get(record) for record in records] for records in member_records]
+        ep_returns = [[unpack_record(conf, record)[1] for record in records] for records in member_records]
+
+        # Update the buffers
+        with telemetry.phase('buffer_add'):
+            for member_buffer, records in zip(buffers, member_records):
+                member_buffer.add_records(records)
+
+        for member, member_buffer, records, ep_return in zip(RLACs, buffers, member_records, ep_returns):
+            logdir = conf.Log_path + '/tensorboard{}'.format(member.N_try)
+            metrics.scalar('TO/success_rate', len(records)/max(1, conf.EP_UPDATE*(1+conf.TO_shift_nodes)), update_step_counter, logdir)
+            metrics.scalar('buffer/fill', (conf.REPLAY_SIZE if member_buffer.full else member_buffer.next_idx)/conf.REPLAY_SIZE, update_step_counter, logdir)
+            if len(ep_return) > 0:
+                metrics.scalar('episode/mean_return', np.mean(ep_return), update_step_counter, logdir)
+                metrics.histogram('episode/returns', ep_return, update_step_counter, logdir)
+        if staging is not None:
+            staging.reset()
 
         # Update NNs
-        update_step_counter = RLAC.learn_and_update(update_step_counter, buffer, ep)
+        if ensemble is not None:
+            update_step_counter = ensemble.learn_and_update(update_step_counter, buffers, ep)
+        else:
+            update_step_counter = RLAC.learn_and_update(update_step_counter, buffer, ep)
+
+        # Evaluate the policies from conf.init_states_sim every conf.eval_log_interval loops
+        if metrics.enabled and (ep+1)%conf.eval_log_interval == 0:
+            with telemetry.phase('evaluation'):
+                for member in RLACs:
+                    member.log_eval_metrics(update_step_counter, plot_fun.evaluator, conf.Log_path + '/tensorboard{}'.format(member.N_try))
 
         # plot Critic value function
         #plot_fun.plot_Critic_Value_function(RLAC.critic_model, update_step_counter, system_id) ###
@@ -223,32 +481,48 @@ if __name__ == '__main__':
         # Plot rollouts and state and control trajectories
         if update_step_counter%conf.plot_rollout_interval_diff_loc == 0 or system_id == 'single_integrator' or system_id == 'double_integrator' or system_id == 'car_park' or system_id == 'car' or system_id == 'manipulator':
             print("System: {} - N_try = {}".format(conf.system_id, N_try))
-            plot_fun.plot_Critic_Value_function(RLAC.critic_model, update_step_counter, system_id)
-            plot_fun.plot_traj_from_ICS(np.array(conf.init_states_sim), TrOp, RLAC, update_step_counter=update_step_counter, ep=ep,steps=conf.NSTEPS, init=1)
+            with telemetry.phase('plotting'):
+                plot_service.submit(update_step_counter, ep)
 
         # Update arrays to store the reward history and its average
-        ep_reward_arr[ep_arr_idx:ep_arr_idx+len(tmp)] = ep_return
-        ep_arr_idx += len(tmp)
+        for member, ep_return in enumerate(ep_returns):
+            ep_reward_arr[member][ep_arr_idx[member]:ep_arr_idx[member]+len(ep_return)] = ep_return
+            ep_arr_idx[member] += len(ep_return)
 
-        for i in range(len(tmp)):
-            print("Episode  {}  --->   Return = {}".format(ep*len(tmp) + i, ep_return[i]))
+            for i in range(len(ep_return)):
+                print("Episode  {}  --->   Return = {}".format(ep*len(ep_return) + i, ep_return[i]))
+
+        telemetry.end_loop(ep, update_step_counter)
+        sampler.end_loop(ep)
 
         if update_step_counter > conf.NUPDATES:
             break
 
     time_end = time.time()
     print('Elapsed time: ', time_end-time_start)
+    sampler.stop()
+    metrics.close()
+
+    # Stop the TO workers
+    if TO_broker:
+        broker.close()
+    if staging is not None:
+        staging.close()
 
     if conf.profile:
         profiler.disable()
         stats = pstats.Stats(profiler).sort_stats('cumtime')
         stats.print_stats()
 
-    # Plot returns
-    plot_fun.plot_Return(ep_reward_arr)
+    # Plot returns, save networks at the end of the training and simulate the final policy (of each ensemble member)
+    plot_service.close()
+    for member, member_ep_reward_arr in zip(RLACs, ep_reward_arr):
+        member_plot_fun = plot_fun if member is RLAC else PLOT(member.N_try, env, NN_inst, conf, env_TO)
+        member_plot_fun.plot_Return(member_ep_reward_arr)
+
+        member.RL_save_weights()
 
-    # Save networks at the end of the training
-    RLAC.RL_save_weights()
+        member_plot_fun.rollout(update_step_counter, member.actor_model, conf.init_states_sim)
 
-    # Simulate the final policy
-    plot_fun.rollout(update_step_counter, RLAC.actor_model, conf.init_states_sim)
+    # Write the last checkpoints
+    checkpoints.close()
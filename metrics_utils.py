@@ -0,0 +1,79 @@
+import threading
+import numpy as np
+from lazy_utils import lazy_import
+
+# Imported on first use
+tf = lazy_import('tensorflow')
+
+class MetricsWriter:
+    def __init__(self):
+        '''
+        Asynchronous TensorBoard logging: scalars and histograms are buffered in memory (as numpy values) and written to TF
+        summary event files by a background thread every flush_interval seconds, so the training loop never waits for the
+        disk. Values can be sent to another run (logdir), e.g. one per ensemble member. Disabled by default, in that case
+        scalar() and histogram() return immediately.
+        '''
+        self.enabled = False
+
+    def enable(self, logdir, flush_interval=10):
+        ''' Start writing the event files in logdir every flush_interval seconds '''
+        self.logdir = logdir
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.pending = []                       # (logdir, kind, tag, step, value)
+        self.stop_event = threading.Event()
+        self.writers = {}                       # logdir -> summary writer
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.enabled = True
+
+    def scalar(self, tag, value, step, logdir=None):
+        ''' Buffer a scalar (of the run logdir, default the one given to enable) '''
+        if self.enabled:
+            with self.lock:
+                self.pending.append((logdir or self.logdir, 'scalar', tag, int(step), float(value)))
+
+    def histogram(self, tag, values, step, logdir=None):
+        ''' Buffer a histogram (a copy of values is stored) '''
+        if self.enabled:
+            with self.lock:
+                self.pending.append((logdir or self.logdir, 'histogram', tag, int(step), np.array(values, dtype=np.float32).ravel()))
+
+    def flush(self):
+        ''' Write the buffered values in the event files '''
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if len(pending) == 0:
+            return
+
+        for logdir, kind, tag, step, value in pending:
+            if logdir not in self.writers:
+                self.writers[logdir] = tf.summary.create_file_writer(logdir)
+            with self.writers[logdir].as_default():
+                if kind == 'scalar':
+                    tf.summary.scalar(tag, value, step=step)
+                else:
+                    tf.summary.histogram(tag, value, step=step)
+        for writer in self.writers.values():
+            writer.flush()
+
+    def run(self):
+        ''' Flushing loop '''
+        while not self.stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        ''' Write the remaining values and stop the background thread '''
+        if not self.enabled:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+        self.flush()
+        for writer in self.writers.values():
+            writer.close()
+        self.enabled = False
+
+# Metrics writer of the process, shared by all the modules (enabled by main.py with --tensorboard)
+metrics = MetricsWriter()
@@ -0,0 +1,186 @@
+import os
+import sys
+import math
+import random
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+from profile_utils import sampler, profiled_job
+
+# Environment variables controlling the size of the BLAS/OpenMP thread pools
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+# Logical CPUs the TO workers are pinned to (None -> no pinning), set by set_learner_execution
+TO_worker_cpus = None
+
+def cpus_by_core():
+    ''' Logical CPUs available to this process grouped by physical core '''
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+    # Group the available logical CPUs by (package, core) pair
+    cores = {}
+    for cpu in available:
+        topology = '/sys/devices/system/cpu/cpu{}/topology/'.format(cpu)
+        try:
+            with open(topology + 'physical_package_id') as f:
+                package_id = f.read().strip()
+            with open(topology + 'core_id') as f:
+                core_id = f.read().strip()
+        except OSError:
+            return [[cpu] for cpu in available]
+        cores.setdefault((package_id, core_id), []).append(cpu)
+
+    return list(cores.values())
+
+def physical_cpu_count():
+    ''' Number of physical cores available to this process (hyper-threads not counted) '''
+    return max(1, len(cpus_by_core()))
+
+def threads_per_worker():
+    ''' Max number of threads per BLAS/OpenMP pool explicitly requested in the environment (1 if none is set, the workers pin them to 1 anyway) '''
+    nb_threads = 1
+    for var in THREAD_ENV_VARS:
+        try:
+            nb_threads = max(nb_threads, int(os.environ.get(var, 1)))
+        except ValueError:
+            pass
+
+    return nb_threads
+
+def resolve_nb_cpus(nb_cpus):
+    ''' Return the number of TO workers (nb_cpus <= 0 -> one per physical core) and warn about oversubscription '''
+    nb_cores = physical_cpu_count()
+    if nb_cpus <= 0:
+        nb_cpus = nb_cores
+    elif nb_cpus > nb_cores:
+        print('WARNING: {} TO workers on {} physical cores'.format(nb_cpus, nb_cores))
+
+    # Only an explicit setting conflicts with the pinning of the worker threads (unset variables are overridden silently)
+    nb_threads = threads_per_worker()
+    if nb_threads > 1 and nb_cpus*nb_threads > nb_cores:
+        print('WARNING: {} TO workers x {} BLAS threads requested in the environment would oversubscribe {} physical cores: worker threads are pinned to 1'.format(nb_cpus, nb_threads, nb_cores))
+
+    return nb_cpus
+
+def set_learner_execution(conf, nb_cpus):
+    '''
+    Execution profile of the learner (to be called before the TF runtime is initialized): size of the TF thread pools and
+    physical cores reserved to the learner, the TO workers being pinned to the other ones. Return the number of cores left to
+    the TO workers (nb_cpus is the requested number of TO workers, <= 0 if it is the number of cores left)
+    '''
+    global TO_worker_cpus
+    tf = sys.modules.get('tensorflow')
+    if tf is not None:
+        try:
+            if conf.learner_intra_op_threads > 0:
+                tf.config.threading.set_intra_op_parallelism_threads(conf.learner_intra_op_threads)
+            if conf.learner_inter_op_threads > 0:
+                tf.config.threading.set_inter_op_parallelism_threads(conf.learner_inter_op_threads)
+        except RuntimeError:
+            print('WARNING: TF runtime already initialized, the learner thread pools cannot be resized')
+
+    cores = cpus_by_core()
+    if conf.learner_cores <= 0 or not hasattr(os, 'sched_setaffinity'):
+        return len(cores)
+    if conf.learner_cores >= len(cores):
+        print('WARNING: {} cores reserved to the learner out of {}, no core pinning'.format(conf.learner_cores, len(cores)))
+        return len(cores)
+
+    # The learner takes the first learner_cores physical cores (with their hyper-threads)
+    os.sched_setaffinity(0, [cpu for core in cores[:conf.learner_cores] for cpu in core])
+    TO_worker_cpus = [cpu for core in cores[conf.learner_cores:] for cpu in core]
+    if nb_cpus > len(cores) - conf.learner_cores:
+        print('WARNING: {} TO workers pinned to {} physical cores'.format(nb_cpus, len(cores) - conf.learner_cores))
+
+    return len(cores) - conf.learner_cores
+
+def init_TO_worker(nb_threads=1, seed=None):
+    '''
+    Pool initializer: pin the BLAS/OpenMP/TF thread pools of a TO worker to nb_threads threads (and the worker to the TO cores,
+    if the learner has reserved some). The forked workers inherit the numpy RNG state of the trainer, so they are reseeded from
+    seed (e.g. [seed, loop]) and their pid to draw different samples in each worker and loop
+    '''
+    if TO_worker_cpus is not None:
+        os.sched_setaffinity(0, TO_worker_cpus)
+
+    if seed is not None:
+        worker_seed = np.random.SeedSequence(list(np.atleast_1d(seed).astype(np.int64)) + [os.getpid()]).generate_state(1)[0]
+        np.random.seed(worker_seed)
+        random.seed(int(worker_seed))
+
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(nb_threads)
+
+    # Pools of already imported libraries (the workers are forked) are resized at runtime if threadpoolctl is available
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(nb_threads)
+    except ImportError:
+        pass
+
+    if 'tensorflow' in sys.modules:
+        tf = sys.modules['tensorflow']
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(nb_threads)
+            tf.config.threading.set_inter_op_parallelism_threads(nb_threads)
+        except RuntimeError:
+            # TF runtime already initialized in the parent, the setting cannot be changed anymore
+            pass
+
+def TO_difficulty(conf, env, ICS):
+    ''' Predicted cost of the TO problem starting from ICS: horizon length NSTEPS_SH weighted by the proximity of the end-effector to the obstacles (conf.obs_param: 3 ellipses/ellipsoids, planar or 3D) '''
+    NSTEPS_SH = conf.NSTEPS - int(ICS[-1]/conf.dt)
+    obs_param = np.asarray(getattr(conf, 'obs_param', []), dtype=np.float64)
+    if obs_param.size == 0 or obs_param.size%6 != 0:
+        return NSTEPS_SH
+
+    # Centers and axes of the obstacles, in as many dimensions as given (x, y and, for 3D obstacles, z)
+    nb_dims = obs_param.size//6
+    centers, axes = obs_param[:3*nb_dims].reshape(3, nb_dims), obs_param[3*nb_dims:].reshape(3, nb_dims)
+    p_ee = np.asarray(env.get_end_effector_position(ICS), dtype=np.float64)[:nb_dims]
+
+    # Normalized distance from the closest obstacle (1 on its boundary)
+    obs_dist = np.min(np.sqrt(np.sum(((p_ee - centers)/(axes/2))**2, axis=1)))
+
+    return NSTEPS_SH*(1 + 1/max(obs_dist, 1e-3))
+
+def schedule_TO_jobs(pool, nb_workers, fun, jobs, difficulties=None, chunksize=0):
+    ''' Run fun over jobs on the pool ordering them from the most to the least difficult. Jobs are dispatched one at a time (or in small adaptive chunks) so that idle workers take the remaining ones '''
+    jobs = list(jobs)
+    if difficulties is not None:
+        order = np.argsort(-np.asarray(difficulties), kind='stable')
+        jobs = [jobs[i] for i in order]
+
+    # Adaptive chunks: ~8 chunks per worker, so that the tail of the (sorted) queue is shared among the workers
+    if chunksize <= 0:
+        chunksize = max(1, len(jobs)//(8*nb_workers))
+
+    # Sample the stacks of the workers if the profiler is enabled
+    if sampler.enabled:
+        fun = partial(profiled_job, fun)
+
+    return list(pool.imap_unordered(fun, jobs, chunksize))
+
+# Function run by the workers of map_TO_workers, set by the pool initializer (the workers are forked, so it is not pickled)
+worker_fun = None
+
+def init_fun_worker(fun, nb_threads=1):
+    ''' Pool initializer: set the function run by the worker and pin its thread pools '''
+    global worker_fun
+    worker_fun = fun
+    init_TO_worker(nb_threads)
+
+def call_worker_fun(job):
+    ''' Run the function of the worker on an indexed job '''
+    idx, args = job
+
+    return idx, worker_fun(args)
+
+def map_TO_workers(nb_workers, fun, jobs, difficulties=None):
+    ''' Run fun (also closures and bound methods) over jobs on a pool of TO workers, most difficult jobs first. Results are returned in the order of jobs '''
+    jobs = list(jobs)
+    nb_workers = max(1, min(nb_workers, len(jobs)))
+    with Pool(nb_workers, initializer=init_fun_worker, initargs=(fun,)) as pool:
+        results = schedule_TO_jobs(pool, nb_workers, call_worker_fun, enumerate(jobs), difficulties, chunksize=1)
+
+    return [result for _, result in sorted(results, key=lambda x: x[0])]
@@ -1,19 +1,29 @@
 import math
+import queue
+import atexit
 import numpy as np
-import tensorflow as tf
-import matplotlib.pyplot as plt
-from matplotlib import cm, colors
-from matplotlib.patches import Ellipse, FancyBboxPatch, Rectangle
-from matplotlib.transforms import Affine2D
-import mpl_toolkits.mplot3d.art3d as art3d
+import multiprocessing
+from policy_eval import PolicyEvaluator
+from parallel_utils import map_TO_workers
+from lazy_utils import lazy_import
+
+# matplotlib is imported on first use
+mpl = lazy_import('matplotlib')
+plt = lazy_import('matplotlib.pyplot')
+cm = lazy_import('matplotlib.cm')
+colors = lazy_import('matplotlib.colors')
+patches = lazy_import('matplotlib.patches')
+transforms = lazy_import('matplotlib.transforms')
 
 class PLOT():
-    def __init__(self, N_try, env, NN, conf):
+    def __init__(self, N_try, env, NN, conf, env_TO=None):
         '''    
         :input N_try :                          (Test number)
 
         :input env :                            (Environment instance)
 
+        :input env_TO :                         (CAMS class of the selected system, used to simulate the rollouts in batch)
+
         :input conf :                           (Configuration file)
             :param fig_ax_lim :                 (float array) Figure axis limit [x_min, x_max, y_min, y_max]
             :param Fig_path :                   (str) Figure path
@@ -34,37 +44,39 @@ class PLOT():
 
         self.N_try = N_try
 
+        self.evaluator = PolicyEvaluator(env, NN, conf, env_TO)
+
         self.xlim = conf.fig_ax_lim[0].tolist()
         self.ylim = conf.fig_ax_lim[1].tolist()
 
         # Set the ticklabel font size globally
-        plt.rcParams['xtick.labelsize'] = 22
-        plt.rcParams['ytick.labelsize'] = 22
-        plt.rcParams.update({'font.size': 20})
+        mpl.rcParams['xtick.labelsize'] = 22
+        mpl.rcParams['ytick.labelsize'] = 22
+        mpl.rcParams.update({'font.size': 20})
 
         return 
 
     def plot_obstaces(self, a=1):
         if self.conf.system_id == 'car_park':
-            obs1 = Rectangle((self.conf.XC1-self.conf.A1/2, self.conf.YC1-self.conf.B1/2), self.conf.A1, self.conf.B1, 0.0,alpha=a)
+            obs1 = patches.Rectangle((self.conf.XC1-self.conf.A1/2, self.conf.YC1-self.conf.B1/2), self.conf.A1, self.conf.B1, 0.0,alpha=a)
             obs1.set_facecolor([30/255, 130/255, 76/255, 1])
-            obs2 = Rectangle((self.conf.XC2-self.conf.A2/2, self.conf.YC2-self.conf.B2/2), self.conf.A2, self.conf.B2, 0.0,alpha=a)
+            obs2 = patches.Rectangle((self.conf.XC2-self.conf.A2/2, self.conf.YC2-self.conf.B2/2), self.conf.A2, self.conf.B2, 0.0,alpha=a)
             obs2.set_facecolor([30/255, 130/255, 76/255, 1])
-            obs3 = Rectangle((self.conf.XC3-self.conf.A3/2, self.conf.YC3-self.conf.B3/2), self.conf.A3, self.conf.B3, 0.0,alpha=a)
+            obs3 = patches.Rectangle((self.conf.XC3-self.conf.A3/2, self.conf.YC3-self.conf.B3/2), self.conf.A3, self.conf.B3, 0.0,alpha=a)
             obs3.set_facecolor([30/255, 130/255, 76/255, 1])
 
-            #rec1 = FancyBboxPatch((self.conf.XC1-self.conf.A1/2, self.conf.YC1-self.conf.B1/2), self.conf.A1, self.conf.B1,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
+            #rec1 = patches.FancyBboxPatch((self.conf.XC1-self.conf.A1/2, self.conf.YC1-self.conf.B1/2), self.conf.A1, self.conf.B1,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
             #rec1.set_facecolor([30/255, 130/255, 76/255, 1])
-            #rec2 = FancyBboxPatch((self.conf.XC2-self.conf.A2/2, self.conf.YC2-self.conf.B2/2), self.conf.A2, self.conf.B2,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
+            #rec2 = patches.FancyBboxPatch((self.conf.XC2-self.conf.A2/2, self.conf.YC2-self.conf.B2/2), self.conf.A2, self.conf.B2,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
             #rec2.set_facecolor([30/255, 130/255, 76/255, 1])
-            #rec3 = FancyBboxPatch((self.conf.XC3-self.conf.A3/2, self.conf.YC3-self.conf.B3/2), self.conf.A3, self.conf.B3,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
+            #rec3 = patches.FancyBboxPatch((self.conf.XC3-self.conf.A3/2, self.conf.YC3-self.conf.B3/2), self.conf.A3, self.conf.B3,edgecolor='g', boxstyle='round,pad=0.1',alpha=a)
             #rec3.set_facecolor([30/255, 130/255, 76/255, 1])
         else:
-            obs1 = Ellipse((self.conf.XC1, self.conf.YC1), self.conf.A1, self.conf.B1, 0.0,alpha=a)
+            obs1 = patches.Ellipse((self.conf.XC1, self.conf.YC1), self.conf.A1, self.conf.B1, 0.0,alpha=a)
             obs1.set_facecolor([30/255, 130/255, 76/255, 1])
-            obs2 = Ellipse((self.conf.XC2, self.conf.YC2), self.conf.A2, self.conf.B2, 0.0,alpha=a)
+            obs2 = patches.Ellipse((self.conf.XC2, self.conf.YC2), self.conf.A2, self.conf.B2, 0.0,alpha=a)
             obs2.set_facecolor([30/255, 130/255, 76/255, 1])
-            obs3 = Ellipse((self.conf.XC3, self.conf.YC3), self.conf.A3, self.conf.B3, 0.0,alpha=a)
+            obs3 = patches.Ellipse((self.conf.XC3, self.conf.YC3), self.conf.A3, self.conf.B3, 0.0,alpha=a)
             obs3.set_facecolor([30/255, 130/255, 76/255, 1])
 
         return [obs1, obs2, obs3]
@@ -217,8 +229,8 @@ class PLOT():
             ax.plot(p_list[idx][0,0],p_list[idx][0,1],'ko',markersize=5)
             if self.conf.system_id == 'car_park':
                 theta = p_list[idx][-1,2]
-                fancybox = FancyBboxPatch((0 - self.conf.L/2, 0 - self.conf.W/2), self.conf.L, self.conf.W, edgecolor='none', alpha=0.5, boxstyle='round,pad=0')
-                fancybox.set_transform(Affine2D().rotate_deg(np.rad2deg(theta)).translate(p_list[idx][-1,0], p_list[idx][-1,1]) + ax.transData)
+                fancybox = patches.FancyBboxPatch((0 - self.conf.L/2, 0 - self.conf.W/2), self.conf.L, self.conf.W, edgecolor='none', alpha=0.5, boxstyle='round,pad=0')
+                fancybox.set_transform(transforms.Affine2D().rotate_deg(np.rad2deg(theta)).translate(p_list[idx][-1,0], p_list[idx][-1,1]) + ax.transData)
                 ax.add_patch(fancybox)
 
         obs_plot_list = self.plot_obstaces()
@@ -244,35 +256,14 @@ class PLOT():
 
     def rollout(self,update_step_cntr, actor_model, init_states_sim, diff_loc=0):
         ''' Plot rollout of the actor from some initial states. It generates the results and then calls plot_policy() and plot_policy_eval() '''
-        #tau_all_sim = []
-        p_ee_all_sim = []
-
-        returns = {}
-
-        for k in range(len(init_states_sim)):
-            rollout_controls = np.zeros((self.conf.NSTEPS,self.conf.nb_action))
-            rollout_states = np.zeros((self.conf.NSTEPS+1,self.conf.nb_state))
-            rollout_p_ee = np.zeros((self.conf.NSTEPS+1,3))
-            rollout_episodic_reward = 0
-
-            rollout_p_ee[0,:] = self.env.get_end_effector_position(init_states_sim[k])
-            rollout_states[0,:] = np.copy(init_states_sim[k])
-            
-            for i in range(self.conf.NSTEPS):
-                rollout_controls[i,:] = tf.squeeze(self.NN.eval(actor_model, np.array([rollout_states[i,:]]))).numpy()
-                rollout_states[i+1,:], rwrd_sim = self.env.step(self.conf.cost_weights_running, rollout_states[i,:],rollout_controls[i,:])
-                rollout_p_ee[i+1,:] = self.env.get_end_effector_position(rollout_states[i+1,:])
-                
-                rollout_p_ee[i+1,-1] = rollout_states[i+1,2] ### !!! ###
+        # Simulate all the rollouts in lock-step
+        rollout_returns, rollout_states, rollout_controls, rollout_p_ee = self.evaluator.evaluate(actor_model, init_states_sim)
+        rollout_p_ee[:,1:,-1] = rollout_states[:,1:,2] ### !!! ###
 
-                rollout_episodic_reward += rwrd_sim
+        print("N try = {}: Simulation Return @ N updates = {} ==> {}".format(self.N_try,update_step_cntr,rollout_returns[0]))
 
-            if k==0:
-                print("N try = {}: Simulation Return @ N updates = {} ==> {}".format(self.N_try,update_step_cntr,rollout_episodic_reward))
-                
-            p_ee_all_sim.append(rollout_p_ee)  
-
-            returns[init_states_sim[k][0],init_states_sim[k][1]] = rollout_episodic_reward
+        p_ee_all_sim = list(rollout_p_ee)
+        returns = {(init_states_sim[k][0],init_states_sim[k][1]): rollout_returns[k] for k in range(len(init_states_sim))}
 
         self.plot_policy_eval(p_ee_all_sim,update_step_cntr, diff_loc=diff_loc)
 
@@ -342,67 +333,68 @@ class PLOT():
         plt.savefig(self.conf.Fig_path+'/N_try_{}'.format(self.N_try)+'/EpReturn_{}'.format(self.N_try))
         plt.close()
 
-    def plot_Critic_Value_function(self, critic_model, n_update, sys_id, name='V'):
-        ''' Plot Value function as learned by the critic '''
+    def compute_Critic_Value_grid(self, critic_model, sys_id):
+        ''' Evaluate the critic on the grid of the Value function plot with a single batched call. Return the end-effector positions (manipulator) or the grid coordinates and the Values '''
         if sys_id == 'manipulator':
             N_discretization_x = 60 + 1  
             N_discretization_y = 60 + 1
 
-            plot_data = np.zeros(N_discretization_y*N_discretization_x)*np.nan
-            ee_pos = np.zeros((N_discretization_y*N_discretization_x,3))*np.nan
+            ICS_arr = np.array([self.env.reset() for _ in range(N_discretization_y*N_discretization_x)])
+            ICS_arr[:,-1] = 0
+            ee_pos = self.evaluator.end_effector_positions(ICS_arr)
+            plot_data = self.NN.eval(critic_model, ICS_arr).numpy()[:,0]
 
-            for k_x in range(N_discretization_x):
-                for k_y in range(N_discretization_y):
-                    ICS = self.env.reset()
-                    ICS[-1] = 0
-                    ee_pos[k_x*(N_discretization_y)+k_y,:] = self.env.get_end_effector_position(ICS)
-                    plot_data[k_x*(N_discretization_y)+k_y] = self.NN.eval(critic_model, np.array([ICS]))
+            return ee_pos, plot_data
 
-            fig = plt.figure(figsize=(8,8))
-            ax = fig.add_subplot()
-            plt.scatter(ee_pos[:,0], ee_pos[:,1], c=plot_data, cmap=cm.coolwarm, antialiased=False)
-            obs_plot_list = self.plot_obstaces(a=0.5)
-            for i in range(len(obs_plot_list)):
-                ax.add_patch(obs_plot_list[i])
-            plt.colorbar()
-            plt.title('N_try {} - n_update {}'.format(self.N_try, n_update))
-            ax.set_xlim(self.xlim)
-            ax.set_ylim(self.ylim)
-            ax.set_aspect('equal', 'box')
-            plt.savefig('{}/N_try_{}/{}_{}'.format(self.conf.Fig_path,self.N_try,name,int(n_update)))
-            plt.close()
+        N_discretization_x = 30 + 1  
+        N_discretization_y = 30 + 1
 
-        else:
-            N_discretization_x = 30 + 1  
-            N_discretization_y = 30 + 1
+        plot_data = np.zeros((N_discretization_y,N_discretization_x))*np.nan
 
-            plot_data = np.zeros((N_discretization_y,N_discretization_x))*np.nan
+        ee_x = np.linspace(-15, 15, N_discretization_x)
+        ee_y = np.linspace(-15, 15, N_discretization_y)
 
-            ee_x = np.linspace(-15, 15, N_discretization_x)
-            ee_y = np.linspace(-15, 15, N_discretization_y)
+        # Build the states of all the grid cells and evaluate them at once
+        ICS_list, idx_list = [], []
+        for k_y in range(N_discretization_y):
+            for k_x in range(N_discretization_x):
+                p_ee = np.array([ee_x[k_x], ee_y[k_y], 0])
+                ICS, continue_flag = self.compute_ICS(p_ee, sys_id, continue_flag=0)
+                if continue_flag:
+                    continue
+                ICS_list.append(ICS)
+                idx_list.append((k_x, k_y))
 
-            for k_y in range(N_discretization_y):
-                for k_x in range(N_discretization_x):
-                    p_ee = np.array([ee_x[k_x], ee_y[k_y], 0])
-                    ICS, continue_flag = self.compute_ICS(p_ee, sys_id, continue_flag=0)
-                    if continue_flag:
-                        continue
-                    plot_data[k_x,k_y] = self.NN.eval(critic_model, np.array([ICS]))
+        if len(ICS_list) > 0:
+            k_x_arr, k_y_arr = np.array(idx_list).T
+            plot_data[k_x_arr, k_y_arr] = self.NN.eval(critic_model, np.array(ICS_list)).numpy()[:,0]
 
-            fig = plt.figure(figsize=(8,8))
-            ax = fig.add_subplot()
-            plt.contourf(ee_x, ee_y, plot_data.T, cmap=cm.coolwarm, antialiased=False)
+        return (ee_x, ee_y), plot_data
 
-            obs_plot_list = self.plot_obstaces(a=0.5)
-            for i in range(len(obs_plot_list)):
-                ax.add_patch(obs_plot_list[i])
-            plt.colorbar()
-            plt.title('N_try {} - n_update {}'.format(self.N_try, n_update))
-            ax.set_xlim(self.xlim)
-            ax.set_ylim(self.ylim)
-            ax.set_aspect('equal', 'box')
-            plt.savefig('{}/N_try_{}/{}_{}'.format(self.conf.Fig_path,self.N_try,name,int(n_update)))
-            plt.close()
+    def render_Critic_Value_function(self, grid, plot_data, n_update, sys_id, name='V'):
+        ''' Plot the Value function computed by compute_Critic_Value_grid '''
+        fig = plt.figure(figsize=(8,8))
+        ax = fig.add_subplot()
+        if sys_id == 'manipulator':
+            plt.scatter(grid[:,0], grid[:,1], c=plot_data, cmap=cm.coolwarm, antialiased=False)
+        else:
+            plt.contourf(grid[0], grid[1], plot_data.T, cmap=cm.coolwarm, antialiased=False)
+
+        obs_plot_list = self.plot_obstaces(a=0.5)
+        for i in range(len(obs_plot_list)):
+            ax.add_patch(obs_plot_list[i])
+        plt.colorbar()
+        plt.title('N_try {} - n_update {}'.format(self.N_try, n_update))
+        ax.set_xlim(self.xlim)
+        ax.set_ylim(self.ylim)
+        ax.set_aspect('equal', 'box')
+        plt.savefig('{}/N_try_{}/{}_{}'.format(self.conf.Fig_path,self.N_try,name,int(n_update)))
+        plt.close()
+
+    def plot_Critic_Value_function(self, critic_model, n_update, sys_id, name='V'):
+        ''' Plot Value function as learned by the critic '''
+        grid, plot_data = self.compute_Critic_Value_grid(critic_model, sys_id)
+        self.render_Critic_Value_function(grid, plot_data, n_update, sys_id, name)
 
     def plot_Critic_Value_function_from_sample(self, n_update, NSTEPS_SH, state_arr, reward_arr):
         # Store transition after computing the (partial) cost-to go when using n-step TD (from 0 to Monte Carlo)
@@ -542,10 +534,26 @@ class PLOT():
             plt.savefig('{}/N_try_{}/ICS'.format(self.conf.Fig_path,self.N_try))
             plt.close(fig)
 
-    def plot_traj_from_ICS(self, init_state, TrOp, RLAC, update_step_counter=0,ep=0,steps=200, init=0,continue_flag=1):
-        ''' Plot results from TO and episode to check consistency '''
+    def solve_traj_from_ICS(self, ICS, TrOp, RLAC, steps, init):
+        ''' Solve the TO problem starting from ICS warm-started with zeros (init=0) or with the actor rollout (init=1). Return the warm-start and TO state trajectories (None if the warm-start failed) '''
+        _, init_TO_states, init_TO_controls, _, success_init_flag = RLAC.create_TO_init(init, ICS)
+        if not success_init_flag:
+            return None
+
+        _, _, TO_states, _, _, _  = TrOp.TO_System_Solve(ICS, init_TO_states, init_TO_controls, steps-1)
+
+        return init_TO_states, TO_states
+
+    def plot_traj_from_ICS(self, init_state, TrOp, RLAC, update_step_counter=0,ep=0,steps=200, init=0,continue_flag=1, nb_cpus=1):
+        ''' Plot results from TO and episode to check consistency (the TO problems are solved by nb_cpus TO workers) '''
         colors = cm.coolwarm(np.linspace(0.1,1,len(init_state)))
 
+        solve_fun = lambda ICS: self.solve_traj_from_ICS(ICS, TrOp, RLAC, steps, init)
+        if nb_cpus > 1:
+            solutions = map_TO_workers(nb_cpus, solve_fun, list(init_state))
+        else:
+            solutions = [solve_fun(ICS) for ICS in init_state]
+
         fig = plt.figure(figsize=(12,8))
         ax1 = fig.add_subplot(1,2,1)
         ax2 = fig.add_subplot(1,2,2)
@@ -555,17 +563,9 @@ class PLOT():
             ee_pos_TO = np.zeros((steps,3))
             ee_pos_RL = np.zeros((steps,3))
             
-            if init == 0:
-                # zeros
-                _, init_TO_states, init_TO_controls, _, success_init_flag = RLAC.create_TO_init(0, init_state[j,:])
-            elif init == 1:
-                # NN
-                _, init_TO_states, init_TO_controls, _, success_init_flag = RLAC.create_TO_init(1, init_state[j,:])
-
-            if success_init_flag:
-                _, _, TO_states, _, _, _  = TrOp.TO_System_Solve(init_state[j,:], init_TO_states, init_TO_controls, steps-1)
-            else:
+            if solutions[j] is None:
                 continue
+            init_TO_states, TO_states = solutions[j]
 
             try:
                 for i in range(steps):
@@ -611,7 +611,86 @@ class PLOT():
         plt.savefig('{}/N_try_{}/ee_traj_{}_{}'.format(self.conf.Fig_path,self.N_try,init,update_step_counter))
 
 
-        
+
+class PlotService():
+    def __init__(self, plot_fun, TrOp, RLAC, sys_id, nb_cpus=1):
+        '''
+        Plotting and evaluation consumer process decoupled from the training loop. The trainer submits snapshots of the actor and
+        critic weights; the consumer (forked from the trainer, with its own copies of the NNs and of the TO instance) draws the
+        figures with a non-interactive backend at its own pace, skipping the snapshots that became stale while it was busy
+
+        :input plot_fun :                       (PLOT instance)
+
+        :input TrOp :                           (TO instance used by plot_traj_from_ICS)
+
+        :input RLAC :                           (RL_AC instance, whose NNs are overwritten by the snapshots in the consumer)
+
+        :input sys_id :                         (str) System-id
+
+        :input nb_cpus :                        (int) Number of TO workers solving the TO problems of plot_traj_from_ICS
+        '''
+        self.plot_fun = plot_fun
+        self.TrOp = TrOp
+        self.RLAC = RLAC
+        self.sys_id = sys_id
+        self.nb_cpus = nb_cpus
+        self.conf = plot_fun.conf
+
+        # Not a daemon process, as it starts its own pool of TO workers: it is stopped at exit if close is not called
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=self.run)
+        self.process.start()
+        atexit.register(self.close)
+
+    def submit(self, update_step_counter, ep=0, init=1):
+        ''' Send a snapshot of the NNs to the consumer (never blocks) '''
+        self.queue.put((update_step_counter, ep, init, self.RLAC.actor_model.get_weights(), self.RLAC.critic_model.get_weights()))
+
+    def run(self):
+        ''' Consumer loop: plot the most recent snapshot, dropping the older pending ones '''
+        plt.switch_backend('Agg')
+
+        while True:
+            request = self.queue.get()
+            if request is None:
+                break
+
+            # Keep only the latest snapshot (the init=0 one is always plotted)
+            while True:
+                try:
+                    next_request = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if next_request is None:
+                    self.queue.put(None)
+                    break
+                if request[2] == 0:
+                    self.plot(*request)
+                else:
+                    print('Plot of update {} dropped (stale)'.format(request[0]))
+                request = next_request
+
+            self.plot(*request)
+
+    def plot(self, update_step_counter, ep, init, actor_weights, critic_weights):
+        ''' Plot the critic Value function and the TO trajectories warm-started by the actor of a snapshot '''
+        self.RLAC.actor_model.set_weights(actor_weights)
+        self.RLAC.critic_model.set_weights(critic_weights)
+
+        try:
+            if init:
+                self.plot_fun.plot_Critic_Value_function(self.RLAC.critic_model, update_step_counter, self.sys_id)
+            self.plot_fun.plot_traj_from_ICS(np.array(self.conf.init_states_sim), self.TrOp, self.RLAC, update_step_counter=update_step_counter, ep=ep, steps=self.conf.NSTEPS, init=init, nb_cpus=self.nb_cpus)
+        except Exception as e:
+            print('Plot of update {} failed: {}'.format(update_step_counter, e))
+        plt.close('all')
+
+    def close(self):
+        ''' Plot the latest pending snapshot and stop the consumer '''
+        if self.process.is_alive():
+            self.queue.put(None)
+            self.process.join()
+
 
 if __name__ == '__main__':
     import os
@@ -628,6 +707,7 @@ if __name__ == '__main__':
     from RL import RL_AC 
     from plot_utils import PLOT
     from NeuralNetwork import NN
+    from config_utils import Config
 
     ###           Input           ###
     N_try = 0
@@ -664,7 +744,7 @@ if __name__ == '__main__':
 
     try:
         conf_module, env_class = system_map[system_id]
-        conf = importlib.import_module(conf_module)
+        conf = Config.from_module(importlib.import_module(conf_module))
         Environment = getattr(importlib.import_module('environment'), env_class)
     except KeyError:
         print('System {} not found'.format(system_id))
@@ -677,10 +757,10 @@ if __name__ == '__main__':
         os.makedirs(path + '/N_try_{}'.format(N_try), exist_ok=True)
     os.makedirs(conf.Config_path, exist_ok=True)
 
-    params = [p for p in conf.__dict__ if not p.startswith("__")]
     with open(conf.Config_path + '/config{}.txt'.format(N_try), 'w') as f:
-        for p in params:
-            f.write('{} = {}\n'.format(p, conf.__dict__[p]))
+        for p, value in conf.items():
+            f.write('{} = {}\n'.format(p, value))
+        f.write('Config hash = {}\n'.format(conf.hash()))
         f.write('Seed = {}\n'.format(seed))
         f.write('w_S = {}'.format(w_S))
 
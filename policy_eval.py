@@ -0,0 +1,69 @@
+import numpy as np
+
+class PolicyEvaluator:
+    def __init__(self, env, NN, conf, env_TO=None):
+        '''
+        Headless evaluation of a policy from a set of initial states: all the rollouts are advanced in lock-step with one actor
+        call per time step. Dynamics and rewards come from the batched functions of env used by the actor updates
+        (simulate_batch, reward_batch), so the rollouts follow the same simulator as training (states and rewards are rounded to
+        float32 at each step, as in the updates). End-effector positions are evaluated in batch with the p_ee casadi function of
+        the running model of env_TO mapped over the rollouts or, if env_TO is None, state by state with env.
+
+        :input env :                            (Environment instance)
+
+        :input NN :                             (NN instance)
+
+        :input conf :                           (Configuration file)
+
+            :param NSTEPS :                     (int) Max episode length
+            :param nb_state :                   (int) State size (robot state size + 1)
+            :param nb_action :                  (int) Action size (robot action size)
+            :param cost_weights_running :       (float array) Running cost weights vector
+
+        :input env_TO :                         (CAMS class of the selected system)
+        '''
+        self.env = env
+        self.NN = NN
+        self.conf = conf
+
+        self.model = env_TO('running_model', conf) if env_TO is not None else None
+        self.mapped_p_ee = {}
+
+    def get_mapped_p_ee(self, n):
+        ''' Return the end-effector position function evaluating n states at once '''
+        if n not in self.mapped_p_ee:
+            self.mapped_p_ee[n] = self.model.p_ee.map(n)
+
+        return self.mapped_p_ee[n]
+
+    def end_effector_positions(self, states):
+        ''' Return the end-effector positions (n, 3) of a batch of states (n, nb_state) '''
+        states = np.asarray(states, dtype=np.float64)
+        if self.model is not None:
+            return np.array(self.get_mapped_p_ee(len(states))(states[:,:-1].T)).T
+
+        return np.array([self.env.get_end_effector_position(state) for state in states])
+
+    def evaluate(self, actor_model, init_states, steps=None):
+        ''' Simulate the policy from each initial state for steps (conf.NSTEPS) steps. Return the returns (n,) and the state (n, steps+1, nb_state), control (n, steps, nb_action) and end-effector (n, steps+1, 3) trajectories '''
+        if steps is None:
+            steps = self.conf.NSTEPS
+        init_states = np.array(init_states, dtype=np.float64)
+        n = len(init_states)
+        weights = np.tile(self.conf.cost_weights_running, (n, 1))
+
+        returns = np.zeros(n)
+        states = np.zeros((n, steps+1, self.conf.nb_state))
+        controls = np.zeros((n, steps, self.conf.nb_action))
+        p_ee = np.zeros((n, steps+1, 3))
+
+        states[:,0,:] = init_states
+        p_ee[:,0,:] = self.end_effector_positions(init_states)
+
+        for i in range(steps):
+            controls[:,i,:] = self.NN.eval(actor_model, states[:,i,:]).numpy()
+            states[:,i+1,:] = self.env.simulate_batch(states[:,i,:], controls[:,i,:]).numpy()
+            returns += self.env.reward_batch(weights, states[:,i,:], controls[:,i,:]).numpy().ravel()
+            p_ee[:,i+1,:] = self.end_effector_positions(states[:,i+1,:])
+
+        return returns, states, controls, p_ee
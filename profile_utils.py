@@ -0,0 +1,108 @@
+import os
+import sys
+import json
+import threading
+
+class StackSampler:
+    def __init__(self):
+        '''
+        Low-overhead sampling profiler: a daemon thread records the Python stack of the profiled thread every interval seconds.
+        The trainer and the local TO workers (forked after enable(), each running its own sampling thread) are profiled, the
+        stacks of all the processes are merged and written once per loop in the collapsed format of flamegraph.pl/speedscope
+        ('root;frame;...;frame count'), with root 'trainer' or 'TO_worker'. Remote TO workers are not profiled.
+        '''
+        self.enabled = False
+        self.pid = None
+
+    def enable(self, path, interval=0.005):
+        ''' Start profiling the calling thread, the collapsed stacks of each loop are written in path '''
+        self.path = path
+        self.interval = interval
+        self.workers_path = os.path.join(path, 'workers')
+        os.makedirs(self.workers_path, exist_ok=True)
+
+        self.enabled = True
+        self.start('trainer')
+
+    def start(self, root, base_code=None):
+        ''' Start the sampling thread of this process, profiling the calling thread (stacks are cut at the frame of base_code, e.g. to drop the frames inherited from the parent by a forked worker) '''
+        self.pid = os.getpid()
+        self.root = root
+        self.base_code = base_code
+        self.counts = {}                        # collapsed stack -> number of samples
+        self.labels = {}                        # code object -> frame label
+        self.lock = threading.Lock()
+        self.thread_id = threading.get_ident()
+        self.stop_event = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        ''' Sampling loop '''
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and frame.f_code is not self.base_code:
+                code = frame.f_code
+                label = self.labels.get(code)
+                if label is None:
+                    label = self.labels[code] = '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                stack.append(label)
+                frame = frame.f_back
+            if len(stack) == 0:
+                continue
+            stack.append(self.root)
+            key = ';'.join(reversed(stack))
+
+            with self.lock:
+                self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        ''' Stop the sampling thread of this process '''
+        if self.enabled:
+            self.stop_event.set()
+
+    def start_worker(self):
+        ''' Start the sampling thread of a forked TO worker (once per process) '''
+        if self.enabled and self.pid != os.getpid():
+            self.start('TO_worker', profiled_job.__code__)
+
+    def flush_worker(self):
+        ''' Write the stacks sampled so far by a TO worker, so that the trainer can merge them (atomic replace, a worker can be terminated at any time) '''
+        with self.lock:
+            counts = dict(self.counts)
+
+        path = os.path.join(self.workers_path, '{}.json'.format(self.pid))
+        with open(path + '.tmp', 'w') as f:
+            json.dump(counts, f)
+        os.replace(path + '.tmp', path)
+
+    def end_loop(self, loop):
+        ''' Merge the stacks of the trainer and of the TO workers sampled in the loop and write them in path/loop_<loop>.collapsed '''
+        if not self.enabled:
+            return
+
+        with self.lock:
+            counts, self.counts = self.counts, {}
+
+        for file in os.listdir(self.workers_path):
+            if not file.endswith('.json'):
+                continue
+            with open(os.path.join(self.workers_path, file)) as f:
+                for key, count in json.load(f).items():
+                    counts[key] = counts.get(key, 0) + count
+            os.remove(os.path.join(self.workers_path, file))
+
+        with open(os.path.join(self.path, 'loop_{}.collapsed'.format(loop)), 'w') as f:
+            for key, count in sorted(counts.items()):
+                f.write('{} {}\n'.format(key, count))
+
+def profiled_job(fun, job):
+    ''' Run a TO job in a worker sampling its stacks '''
+    sampler.start_worker()
+    try:
+        return fun(job)
+    finally:
+        sampler.flush_worker()
+
+# Sampling profiler of the process, shared by all the modules (enabled by main.py with --profile-interval)
+sampler = StackSampler()
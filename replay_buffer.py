@@ -1,8 +1,104 @@
 import math
 import random
 import numpy as np
-import tensorflow as tf
-from stable_baselines.common.segment_tree import SumSegmentTree, MinSegmentTree
+import multiprocessing
+from multiprocessing import shared_memory
+from lazy_utils import lazy_import
+
+# Imported on first use (the segment trees only by the prioritized buffer)
+tf = lazy_import('tensorflow')
+segment_tree = lazy_import('stable_baselines.common.segment_tree')
+
+# Compact trajectory record: one contiguous float32 buffer per episode made of a header (NSTEPS_SH, return) followed by
+# the NSTEPS_SH+1 transitions in the storage_mat layout (state, reward, next state, dVdx, done, term)
+RECORD_HEADER_SIZE = 2
+
+def transition_size(conf):
+    ''' Number of columns of a transition in the storage_mat layout '''
+    return conf.nb_state + 1 + conf.nb_state + conf.nb_state + 1 + 1
+
+def record_size(conf, NSTEPS_SH):
+    ''' Number of float32 of the record of an episode of NSTEPS_SH steps '''
+    return RECORD_HEADER_SIZE + (NSTEPS_SH+1)*transition_size(conf)
+
+def pack_record(conf, NSTEPS_SH, ep_return, obses_t, rewards, obses_t1, dVdxs, dones, terms, out=None):
+    ''' Write the transitions of an episode into a record (out, e.g. a slice of a preallocated staging area, or a new array) '''
+    if out is None:
+        out = np.empty(record_size(conf, NSTEPS_SH), dtype=np.float32)
+    out[0] = NSTEPS_SH
+    out[1] = ep_return
+
+    transitions = out[RECORD_HEADER_SIZE:].reshape(NSTEPS_SH+1, transition_size(conf))
+    transitions[:, :conf.nb_state] = obses_t
+    transitions[:, conf.nb_state] = rewards
+    transitions[:, conf.nb_state+1:conf.nb_state*2+1] = obses_t1
+    transitions[:, conf.nb_state*2+1:conf.nb_state*3+1] = dVdxs
+    transitions[:, conf.nb_state*3+1] = dones
+    transitions[:, conf.nb_state*3+2] = terms
+
+    return out
+
+def unpack_record(conf, record):
+    ''' Return NSTEPS_SH, return and transitions (view in the storage_mat layout) of a record '''
+    NSTEPS_SH = int(record[0])
+
+    return NSTEPS_SH, float(record[1]), record[RECORD_HEADER_SIZE:record_size(conf, NSTEPS_SH)].reshape(NSTEPS_SH+1, transition_size(conf))
+
+
+class EpisodeStaging(object):
+    def __init__(self, conf, nb_episodes):
+        '''
+        Shared-memory staging area for the trajectory records of an update loop. The TO workers (forked after its creation) write
+        their records straight into it and send back only (offset, size); the replay buffer then ingests the slices with one copy
+
+        :input conf :                           (Configuration file)
+
+            :param NSTEPS :                     (int) Max episode length
+            :param nb_state :                   (int) State size (robot state size + 1)
+
+        :input nb_episodes :                    (int) Max number of episodes of an update loop (e.g. EP_UPDATE)
+        '''
+
+        self.conf = conf
+        self.capacity = nb_episodes*record_size(conf, conf.NSTEPS)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.capacity*np.dtype(np.float32).itemsize)
+        self.data = np.ndarray(self.capacity, dtype=np.float32, buffer=self.shm.buf)
+        self.next_idx = multiprocessing.Value('l', 0)
+
+    def put(self, NSTEPS_SH, ep_return, obses_t, rewards, obses_t1, dVdxs, dones, terms):
+        ''' Write the record of an episode in the staging area and return its (offset, size), or the record itself if the area is full '''
+        size = record_size(self.conf, NSTEPS_SH)
+        with self.next_idx.get_lock():
+            start = self.next_idx.value
+            full = start + size > self.capacity
+            if not full:
+                self.next_idx.value = start + size
+
+        if full:
+            return pack_record(self.conf, NSTEPS_SH, ep_return, obses_t, rewards, obses_t1, dVdxs, dones, terms)
+
+        pack_record(self.conf, NSTEPS_SH, ep_return, obses_t, rewards, obses_t1, dVdxs, dones, terms, out=self.data[start:start+size])
+
+        return start, size
+
+    def get(self, record):
+        ''' Return the record (view of the staging area) referenced by put '''
+        if isinstance(record, tuple):
+            start, size = record
+            return self.data[start:start+size]
+
+        return record
+
+    def reset(self):
+        ''' Free the staging area once its records have been ingested '''
+        with self.next_idx.get_lock():
+            self.next_idx.value = 0
+
+    def close(self):
+        ''' Release the shared memory '''
+        del self.data
+        self.shm.close()
+        self.shm.unlink()
 
 
 class ReplayBuffer(object):
@@ -16,15 +112,22 @@ class ReplayBuffer(object):
         '''
 
         self.conf = conf
-        self.storage_mat = np.zeros((conf.REPLAY_SIZE, conf.nb_state + 1 + conf.nb_state + conf.nb_state + 1 + 1))
+        self.storage_mat = np.zeros((conf.REPLAY_SIZE, transition_size(conf)))
         self.next_idx = 0
         self.full = 0
         self.exp_counter = np.zeros(conf.REPLAY_SIZE)
 
     def add(self, obses_t, rewards, obses_t1, dVdxs, dones, terms):
         ''' Add transitions to the buffer '''
-        data = self.concatenate_sample(obses_t, rewards, obses_t1, dVdxs, dones, terms)
+        self.store(self.concatenate_sample(obses_t, rewards, obses_t1, dVdxs, dones, terms))
 
+    def add_records(self, records):
+        ''' Add the transitions of a list of trajectory records to the buffer (each record is copied once, straight into storage_mat) '''
+        for record in records:
+            self.store(unpack_record(self.conf, record)[2])
+
+    def store(self, data):
+        ''' Write transitions (in the storage_mat layout) in the buffer '''
         if len(data) + self.next_idx > self.conf.REPLAY_SIZE:
             self.storage_mat[self.next_idx:,:] = data[:self.conf.REPLAY_SIZE-self.next_idx,:]
             self.storage_mat[:self.next_idx+len(data)-self.conf.REPLAY_SIZE,:] = data[self.conf.REPLAY_SIZE-self.next_idx:,:]
@@ -34,6 +137,18 @@ class ReplayBuffer(object):
 
         self.next_idx = (self.next_idx + len(data)) % self.conf.REPLAY_SIZE
 
+    def get_state(self):
+        ''' Copy of the stored transitions and counters (to resume the training from a checkpoint) '''
+        size = self.conf.REPLAY_SIZE if self.full else self.next_idx
+
+        return {'storage_mat': self.storage_mat[:size].copy(), 'exp_counter': self.exp_counter[:size].copy(), 'next_idx': self.next_idx, 'full': self.full}
+
+    def set_state(self, state):
+        ''' Restore the content of the buffer saved with get_state '''
+        size = len(state['storage_mat'])
+        self.storage_mat[:size], self.exp_counter[:size] = state['storage_mat'], state['exp_counter']
+        self.next_idx, self.full = state['next_idx'], state['full']
+
     def sample(self):
         ''' Sample a batch of transitions '''
         # Select indexes of the batch elements
@@ -97,7 +212,7 @@ class PrioritizedReplayBuffer:
 
         self.conf = conf
 
-        self.storage_mat = np.zeros((conf.REPLAY_SIZE, conf.nb_state + 1 + conf.nb_state + conf.nb_state + 1 + 1))
+        self.storage_mat = np.zeros((conf.REPLAY_SIZE, transition_size(conf)))
         self.full = 0
         self.next_idx = 0
         self.exp_counter = np.zeros(self.conf.REPLAY_SIZE)
@@ -110,8 +225,8 @@ class PrioritizedReplayBuffer:
         while it_capacity < self.conf.REPLAY_SIZE:
             it_capacity *= 2
 
-        self._it_sum = SumSegmentTree(it_capacity)
-        self._it_min = MinSegmentTree(it_capacity)
+        self._it_sum = segment_tree.SumSegmentTree(it_capacity)
+        self._it_min = segment_tree.MinSegmentTree(it_capacity)
         self._max_priority = 1.0
 
         #self.RB_type = 'ReLO'
@@ -120,8 +235,15 @@ class PrioritizedReplayBuffer:
     
     def add(self, obses_t, rewards, obses_t1, dVdxs, dones, terms):
         ''' Add transitions to the buffer '''
-        data = self.concatenate_sample(obses_t, rewards, obses_t1, dVdxs, dones, terms)
+        self.store(self.concatenate_sample(obses_t, rewards, obses_t1, dVdxs, dones, terms))
 
+    def add_records(self, records):
+        ''' Add the transitions of a list of trajectory records to the buffer (each record is copied once, straight into storage_mat) '''
+        for record in records:
+            self.store(unpack_record(self.conf, record)[2])
+
+    def store(self, data):
+        ''' Write transitions (in the storage_mat layout) in the buffer '''
         if len(data) + self.next_idx > self.conf.REPLAY_SIZE:
             self.storage_mat[self.next_idx:,:] = data[:self.conf.REPLAY_SIZE-self.next_idx,:]
             self.storage_mat[:self.next_idx+len(data)-self.conf.REPLAY_SIZE,:] = data[self.conf.REPLAY_SIZE-self.next_idx:,:]
@@ -135,6 +257,24 @@ class PrioritizedReplayBuffer:
         
         self.next_idx = (self.next_idx + len(data)) % self.conf.REPLAY_SIZE
 
+    def get_state(self):
+        ''' Copy of the stored transitions, counters and priorities (to resume the training from a checkpoint) '''
+        size = self.conf.REPLAY_SIZE if self.full else self.next_idx
+        idxes = np.arange(size)
+
+        return {'storage_mat': self.storage_mat[:size].copy(), 'exp_counter': self.exp_counter[:size].copy(), 'next_idx': self.next_idx, 'full': self.full,
+                'priorities': self.priorities[:size].copy(), 'max_priority': self._max_priority,
+                'it_sum': np.array(self._it_sum[idxes]) if size > 0 else np.zeros(0), 'it_min': np.array(self._it_min[idxes]) if size > 0 else np.zeros(0)}
+
+    def set_state(self, state):
+        ''' Restore the content of the buffer saved with get_state '''
+        size = len(state['storage_mat'])
+        self.storage_mat[:size], self.exp_counter[:size], self.priorities[:size] = state['storage_mat'], state['exp_counter'], state['priorities']
+        self.next_idx, self.full, self._max_priority = state['next_idx'], state['full'], state['max_priority']
+        if size > 0:
+            self._it_sum[np.arange(size)] = state['it_sum']
+            self._it_min[np.arange(size)] = state['it_min']
+
     def _sample_proportional(self):
         ''' Sample a batch of transitions '''
         if self.full:
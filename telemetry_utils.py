@@ -0,0 +1,132 @@
+import os
+import csv
+import json
+import time
+import multiprocessing
+import numpy as np
+from contextlib import nullcontext
+
+# Phases of the training loop. The ones timed in the TO workers are sent to the trainer through a shared-memory area
+# (by phase index), so every phase must be listed here
+PHASES = ['loop', 'ICS_generation', 'TO_jobs', 'warm_start_rollout', 'TO_solve', 'backward_pass', 'RL_solve', 'buffer_add',
+          'sampling', 'critic_step', 'actor_step', 'target_update', 'checkpoint', 'plotting', 'evaluation']
+
+# Max number of durations the TO workers can record in a loop (the following ones are dropped)
+WORKER_CAPACITY = 2**16
+
+# Context manager returned when the telemetry is disabled (no timing at all)
+NO_PHASE = nullcontext()
+
+class Phase:
+    __slots__ = ('telemetry', 'name', 'start')
+
+    def __init__(self, telemetry, name):
+        ''' Context manager timing a phase '''
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc):
+        self.telemetry.add(self.name, time.perf_counter() - self.start)
+
+class Telemetry:
+    def __init__(self):
+        '''
+        Per-phase timing of the training loop: count, total time and percentiles of each phase are written once per loop in a
+        CSV or JSONL file. Disabled by default, in that case phase() returns a shared no-op context manager. The TO workers
+        forked after enable() send their durations to the trainer through shared memory (remote TO workers are not timed).
+        '''
+        self.enabled = False
+
+    def enable(self, path):
+        ''' Start recording, the results are appended to path (.csv or .jsonl) '''
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self.parent_pid = os.getpid()
+        self.times = {name: [] for name in PHASES}
+
+        # (phase index, duration) pairs recorded by the TO workers
+        self.worker_times = multiprocessing.RawArray('d', 2*WORKER_CAPACITY)
+        self.worker_count = multiprocessing.Value('i', 0)
+
+        if not self.jsonl:
+            with open(path, 'w', newline='') as f:
+                csv.writer(f).writerow(['loop', 'update_step_counter', 'phase', 'count', 'total_s', 'mean_s', 'p50_s', 'p95_s', 'max_s', 'per_s'])
+
+        self.loop_start = time.perf_counter()
+        self.enabled = True
+
+    def phase(self, name):
+        ''' Return a context manager timing the phase name '''
+        if not self.enabled:
+            return NO_PHASE
+
+        return Phase(self, name)
+
+    def add(self, name, duration):
+        ''' Record a duration (s) of the phase name '''
+        if not self.enabled:
+            return
+
+        if os.getpid() == self.parent_pid:
+            self.times[name].append(duration)
+            return
+
+        with self.worker_count.get_lock():
+            idx = self.worker_count.value
+            if idx >= WORKER_CAPACITY:
+                return
+            self.worker_count.value = idx + 1
+        self.worker_times[2*idx] = PHASES.index(name)
+        self.worker_times[2*idx+1] = duration
+
+    def collect_worker_times(self):
+        ''' Move the durations recorded by the TO workers to the ones of the trainer '''
+        with self.worker_count.get_lock():
+            n = min(self.worker_count.value, WORKER_CAPACITY)
+            self.worker_count.value = 0
+
+        for idx, duration in np.frombuffer(self.worker_times, count=2*n).reshape(n, 2):
+            self.times[PHASES[int(idx)]].append(duration)
+
+    def summary(self):
+        ''' Return the statistics of the phases recorded in the current loop '''
+        stats = {}
+        for name, times in self.times.items():
+            if len(times) == 0:
+                continue
+            times = np.asarray(times)
+            total = float(np.sum(times))
+            stats[name] = {'count': len(times), 'total_s': total, 'mean_s': total/len(times), 'p50_s': float(np.percentile(times, 50)),
+                           'p95_s': float(np.percentile(times, 95)), 'max_s': float(np.max(times)), 'per_s': len(times)/total if total > 0 else None}
+
+        return stats
+
+    def end_loop(self, loop, update_step_counter):
+        ''' Write the statistics of the loop and start a new one '''
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        self.add('loop', now - self.loop_start)
+        self.collect_worker_times()
+        stats = self.summary()
+
+        if self.jsonl:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'loop': loop, 'update_step_counter': update_step_counter, 'phases': stats}) + '\n')
+        else:
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                for name, s in stats.items():
+                    writer.writerow([loop, update_step_counter, name, s['count'], s['total_s'], s['mean_s'], s['p50_s'], s['p95_s'], s['max_s'], s['per_s']])
+
+        self.times = {name: [] for name in PHASES}
+        self.loop_start = time.perf_counter()
+
+# Telemetry of the process, shared by all the modules (enabled by main.py with --telemetry)
+telemetry = Telemetry()
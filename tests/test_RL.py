@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from config_utils import Config
+
+pytest.importorskip('tensorflow')
+from RL import large_batch_conf
+
+def make_conf(**params):
+    return Config('conf_test', dict({'BATCH_SIZE': 64, 'UPDATE_LOOPS': np.array([100, 200, 301]), 'NUPDATES': 1000, 'save_interval': 10,
+                                     'plot_rollout_interval': 5, 'plot_rollout_interval_diff_loc': 6, 'metrics_log_interval': 1,
+                                     'CRITIC_LEARNING_RATE': 1e-3, 'ACTOR_LEARNING_RATE': 1e-4,
+                                     'boundaries_schedule_LR_C': [400.], 'boundaries_schedule_LR_A': [800.],
+                                     'values_schedule_LR_C': [1e-3, 1e-4], 'values_schedule_LR_A': [1e-4, 1e-5],
+                                     'MC': 0, 'UPDATE_RATE': 0.001, 'large_batch_factor': 1, 'LR_scaling': 'linear', 'grad_accumulation_steps': 1}, **params))
+
+def test_disabled():
+    conf = make_conf()
+
+    assert large_batch_conf(conf) is conf
+
+def test_scaling():
+    conf = large_batch_conf(make_conf(large_batch_factor=4))
+
+    assert conf.BATCH_SIZE == 256
+    np.testing.assert_array_equal(conf.UPDATE_LOOPS, [25, 50, 76])
+    assert (conf.NUPDATES, conf.save_interval, conf.plot_rollout_interval, conf.metrics_log_interval) == (250, 3, 2, 1)
+    assert conf.boundaries_schedule_LR_C == [100.]
+    assert conf.values_schedule_LR_A == pytest.approx([4e-4, 4e-5])
+    assert conf.CRITIC_LEARNING_RATE == pytest.approx(4e-3)
+    assert (1 - conf.UPDATE_RATE) == pytest.approx((1 - 0.001)**4)
+
+def test_sqrt_scaling():
+    conf = large_batch_conf(make_conf(large_batch_factor=4, LR_scaling='sqrt'))
+
+    assert conf.CRITIC_LEARNING_RATE == pytest.approx(2e-3)
+
+def test_indivisible_accumulation():
+    with pytest.raises(ValueError):
+        large_batch_conf(make_conf(large_batch_factor=3, grad_accumulation_steps=5))
@@ -0,0 +1,62 @@
+import os
+import types
+import numpy as np
+from checkpoint_utils import CheckpointWriter, complete_checkpoints, resumable_checkpoints, load_checkpoint, load_training_state
+
+def make_conf(**params):
+    return types.SimpleNamespace(**dict({'checkpoint_format': 'npz', 'checkpoint_keep_last': 2, 'checkpoint_keep_every': 0, 'save_interval': 10}, **params))
+
+def snapshot(value):
+    return {name: [np.full((2, 2), value, dtype=np.float32)] for name in ['actor', 'critic', 'target_critic']}
+
+def write_checkpoints(writer, conf, folder, steps, resumable=()):
+    for i, step in enumerate(steps):
+        writer.write(conf, str(folder), step, snapshot(i), None, {'next_ep': step} if step in resumable else None)
+
+def test_round_trip(tmp_path):
+    CheckpointWriter().write(make_conf(), str(tmp_path), 10, snapshot(1.), None, {'next_ep': 3})
+
+    np.testing.assert_array_equal(load_checkpoint(str(tmp_path / 'checkpoint_10.npz'))['critic'][0], snapshot(1.)['critic'][0])
+    assert load_training_state(str(tmp_path / 'training_state_10.pkl')) == {'next_ep': 3}
+    assert not any(file.endswith('.tmp') or '.tmp.' in file for file in os.listdir(tmp_path))
+
+def test_keep_last(tmp_path):
+    write_checkpoints(CheckpointWriter(), make_conf(), tmp_path, [10, 20, 30, 40])
+
+    assert complete_checkpoints(str(tmp_path)) == [30, 40]
+
+def test_keep_all(tmp_path):
+    write_checkpoints(CheckpointWriter(), make_conf(checkpoint_keep_last=0), tmp_path, [10, 20, 30])
+
+    assert complete_checkpoints(str(tmp_path)) == [10, 20, 30]
+
+def test_keep_every(tmp_path):
+    write_checkpoints(CheckpointWriter(), make_conf(checkpoint_keep_every=2), tmp_path, [10, 20, 30, 40, 50, 60, 70])
+
+    assert complete_checkpoints(str(tmp_path)) == [20, 40, 60, 70]
+
+def test_last_resumable_kept(tmp_path):
+    write_checkpoints(CheckpointWriter(), make_conf(), tmp_path, [10, 20, 30, 40], resumable=[20])
+
+    assert complete_checkpoints(str(tmp_path)) == [20, 30, 40]
+    assert resumable_checkpoints(str(tmp_path)) == [20]
+
+def test_final_kept(tmp_path):
+    write_checkpoints(CheckpointWriter(), make_conf(checkpoint_keep_last=1), tmp_path, [10, 'final', 20])
+
+    assert sorted(os.listdir(tmp_path)) == ['checkpoint_20.npz', 'checkpoint_final.npz']
+
+def test_unchanged_weights_linked(tmp_path):
+    writer = CheckpointWriter()
+    writer.write(make_conf(), str(tmp_path), 10, snapshot(1.), None, None)
+    writer.write(make_conf(), str(tmp_path), 20, snapshot(1.), None, None)
+
+    assert os.path.samefile(tmp_path / 'checkpoint_10.npz', tmp_path / 'checkpoint_20.npz')
+
+def test_queued_checkpoints_written_on_close(tmp_path):
+    writer = CheckpointWriter()
+    for step in [10, 20]:
+        writer.submit(make_conf(checkpoint_keep_last=0), str(tmp_path), step, snapshot(step))
+    writer.close()
+
+    assert complete_checkpoints(str(tmp_path)) == [10, 20]
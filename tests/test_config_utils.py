@@ -0,0 +1,47 @@
+import pickle
+import numpy as np
+import pytest
+from config_utils import Config, parse_overrides
+
+def make_conf(**params):
+    return Config('conf_test', dict({'NSTEPS': 100, 'dt': 0.01, 'TO_method': 'casadi', 'x_init': np.zeros(3), 'cache_path': ''}, **params))
+
+def test_read_only():
+    with pytest.raises(AttributeError):
+        make_conf().NSTEPS = 10
+
+def test_replace():
+    conf = make_conf()
+    new_conf = conf.replace(NSTEPS=50, dt=1)
+
+    assert (new_conf.NSTEPS, new_conf.dt) == (50, 1)
+    assert conf.NSTEPS == 100
+    with pytest.raises(TypeError):
+        conf.replace(NSTEPS='50')
+
+def test_hash():
+    conf = make_conf()
+
+    assert conf.hash() == make_conf().hash()
+    assert conf.hash() != conf.replace(NSTEPS=50).hash()
+    assert conf.hash() != conf.replace(x_init=np.ones(3)).hash()
+    assert conf.hash(['dt']) == conf.replace(NSTEPS=50).hash(['dt'])
+
+def test_pickle():
+    conf = make_conf()
+    copy = pickle.loads(pickle.dumps(conf))
+
+    assert copy.params().keys() == conf.params().keys()
+    assert copy.hash() == conf.hash()
+
+def test_cache_dir(tmp_path):
+    assert make_conf().cache_dir('TO_DDP') is None
+
+    conf = make_conf(cache_path=str(tmp_path))
+    path = conf.cache_dir('TO_DDP')
+    assert path.startswith(str(tmp_path / 'TO_DDP' / 'conf_test_'))
+    assert path == conf.cache_dir('TO_DDP')
+    assert path != conf.replace(NSTEPS=50).cache_dir('TO_DDP')
+
+def test_parse_overrides():
+    assert parse_overrides(['a=4', "b='mixed_bfloat16'", 'c=[1, 2]']) == {'a': 4, 'b': 'mixed_bfloat16', 'c': [1, 2]}
@@ -0,0 +1,92 @@
+import time
+from distributed_utils import JobBroker, LocalJobQueue, run_TO_jobs
+
+def test_job_leased_once():
+    broker = JobBroker()
+    job_ids = broker.submit(['a', 'b'])
+
+    assert broker.get_job('w1') == (job_ids[0], 'a')
+    assert broker.get_job('w2') == (job_ids[1], 'b')
+    assert broker.get_job('w1') is None
+
+def test_result_popped_once():
+    broker = JobBroker()
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    broker.put_result('w1', job_id, 1)
+
+    assert broker.pop_results([job_id]) == {job_id: 1}
+    assert broker.pop_results([job_id]) == {}
+
+def test_expired_lease_requeued():
+    broker = JobBroker(lease_timeout=0.01)
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    time.sleep(0.02)
+
+    assert broker.get_job('w2') == (job_id, 'a')
+
+def test_heartbeat_extends_lease():
+    broker = JobBroker(lease_timeout=0.5)
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    time.sleep(0.3)
+    broker.heartbeat('w1', job_id)
+    time.sleep(0.3)
+
+    assert broker.get_job('w2') is None
+
+def test_heartbeat_of_other_worker_ignored():
+    broker = JobBroker(lease_timeout=0.5)
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    time.sleep(0.3)
+    broker.heartbeat('w2', job_id)
+    time.sleep(0.3)
+
+    assert broker.get_job('w2') == (job_id, 'a')
+
+def test_failed_job_retried_then_dropped():
+    broker = JobBroker(max_retries=2)
+    job_id, = broker.submit(['a'])
+    for _ in range(2):
+        assert broker.get_job('w1') == (job_id, 'a')
+        broker.fail_job('w1', job_id)
+
+    assert broker.get_job('w1') is None
+    assert broker.pop_results([job_id]) == {job_id: None}
+
+def test_late_result_of_requeued_job_kept():
+    broker = JobBroker(lease_timeout=0.01)
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    time.sleep(0.02)
+    broker.requeue_expired()
+    broker.put_result('w1', job_id, 1)
+
+    assert broker.get_job('w2') is None
+    assert broker.pop_results([job_id]) == {job_id: 1}
+
+def test_result_of_dropped_job_ignored():
+    broker = JobBroker(max_retries=1)
+    job_id, = broker.submit(['a'])
+    broker.get_job('w1')
+    broker.fail_job('w1', job_id)
+    broker.put_result('w1', job_id, 1)
+
+    assert broker.pop_results([job_id]) == {job_id: None}
+
+def test_closed_broker():
+    broker = JobBroker()
+    broker.submit(['a'])
+    broker.close()
+
+    assert broker.get_job('w1') == 'closed'
+
+def test_local_queue_keeps_order_and_drops_failures():
+    def worker_fun(x):
+        if x is None:
+            raise ValueError('bad payload')
+        return 10*x
+
+    assert run_TO_jobs(LocalJobQueue(worker_fun, max_retries=2), [0, None, 2], poll_interval=0) == [0, None, 20]
@@ -0,0 +1,41 @@
+import types
+import numpy as np
+from multiprocessing import get_context
+from parallel_utils import TO_difficulty, schedule_TO_jobs
+
+class Env:
+    def __init__(self, p_ee):
+        self.p_ee = np.asarray(p_ee)
+
+    def get_end_effector_position(self, state):
+        return self.p_ee
+
+def make_conf(**params):
+    return types.SimpleNamespace(**dict({'NSTEPS': 100, 'dt': 0.01}, **params))
+
+def test_difficulty_without_obstacles():
+    assert TO_difficulty(make_conf(), Env([0, 0]), np.array([0, 0, 0.5])) == 50
+
+def test_difficulty_planar_obstacles():
+    conf = make_conf(obs_param=np.array([0., 0., 5., 5., 5., 5., 2., 2., 2., 2., 2., 2.]))
+    ICS = np.array([0, 0, 0.])
+
+    assert TO_difficulty(conf, Env([2, 0]), ICS) == 150
+    assert TO_difficulty(conf, Env([3, 0]), ICS) < TO_difficulty(conf, Env([2, 0]), ICS) < TO_difficulty(conf, Env([1, 0]), ICS)
+
+def test_difficulty_3D_obstacles():
+    conf = make_conf(obs_param=np.array([0., 0., 0., 5., 5., 5., 5., 5., 5., 2., 2., 2., 2., 2., 2., 2., 2., 2.]))
+    ICS = np.array([0, 0, 0.])
+
+    # The z axis counts: same normalized distance along z as along x
+    assert TO_difficulty(conf, Env([0, 0, 2]), ICS) == TO_difficulty(conf, Env([2, 0, 0]), ICS) == 150
+    assert TO_difficulty(conf, Env([0, 0, 4]), ICS) < 150
+
+def square(x):
+    return x*x
+
+def test_schedule_TO_jobs():
+    with get_context('fork').Pool(2) as pool:
+        results = schedule_TO_jobs(pool, 2, square, range(10), difficulties=range(10))
+
+    assert sorted(results) == [x*x for x in range(10)]
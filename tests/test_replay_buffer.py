@@ -0,0 +1,119 @@
+import types
+import multiprocessing
+import numpy as np
+import pytest
+from replay_buffer import ReplayBuffer, EpisodeStaging, RECORD_HEADER_SIZE, transition_size, record_size, pack_record, unpack_record
+
+def make_conf(**params):
+    return types.SimpleNamespace(**dict({'nb_state': 3, 'NSTEPS': 10}, **params))
+
+def make_episode(conf, NSTEPS_SH, seed=0):
+    rng = np.random.default_rng(seed)
+    n = NSTEPS_SH + 1
+    return rng.random((n, conf.nb_state)), rng.random(n), rng.random((n, conf.nb_state)), rng.random((n, conf.nb_state)), np.zeros(n), np.arange(n) == n-1
+
+def test_record_size():
+    conf = make_conf()
+
+    assert transition_size(conf) == 3*conf.nb_state + 3
+    assert record_size(conf, 4) == RECORD_HEADER_SIZE + 5*transition_size(conf)
+
+def test_pack_unpack_round_trip():
+    conf = make_conf()
+    obses_t, rewards, obses_t1, dVdxs, dones, terms = make_episode(conf, 4)
+    record = pack_record(conf, 4, 2.5, obses_t, rewards, obses_t1, dVdxs, dones, terms)
+    NSTEPS_SH, ep_return, transitions = unpack_record(conf, record)
+
+    assert record.dtype == np.float32
+    assert (NSTEPS_SH, ep_return) == (4, 2.5)
+    n = conf.nb_state
+    np.testing.assert_allclose(transitions[:, :n], obses_t, rtol=1e-6)
+    np.testing.assert_allclose(transitions[:, n], rewards, rtol=1e-6)
+    np.testing.assert_allclose(transitions[:, n+1:2*n+1], obses_t1, rtol=1e-6)
+    np.testing.assert_allclose(transitions[:, 2*n+1:3*n+1], dVdxs, rtol=1e-6)
+    np.testing.assert_array_equal(transitions[:, 3*n+1], dones)
+    np.testing.assert_array_equal(transitions[:, 3*n+2], terms)
+
+def test_pack_into_slice_and_unpack_longer_buffer():
+    conf = make_conf()
+    area = np.full(2*record_size(conf, 4), -1, dtype=np.float32)
+    episode = make_episode(conf, 2)
+    pack_record(conf, 2, 1.0, *episode, out=area[:record_size(conf, 2)])
+
+    NSTEPS_SH, _, transitions = unpack_record(conf, area)
+    assert NSTEPS_SH == 2
+    assert transitions.shape == (3, transition_size(conf))
+    assert np.all(area[record_size(conf, 2):] == -1)
+
+def test_add_records_wraps_around():
+    conf = make_conf(REPLAY_SIZE=8)
+    buffer = ReplayBuffer(conf)
+    records = [pack_record(conf, NSTEPS_SH, 0.0, *make_episode(conf, NSTEPS_SH, seed)) for seed, NSTEPS_SH in enumerate([4, 5])]
+    buffer.add_records(records)
+
+    assert (buffer.next_idx, buffer.full) == (3, 1)
+    np.testing.assert_array_equal(buffer.storage_mat[3:5], unpack_record(conf, records[0])[2][3:5])
+    np.testing.assert_array_equal(buffer.storage_mat[5:], unpack_record(conf, records[1])[2][:3])
+    np.testing.assert_array_equal(buffer.storage_mat[:3], unpack_record(conf, records[1])[2][3:])
+
+def test_staging_put_get():
+    conf = make_conf()
+    staging = EpisodeStaging(conf, 2)
+    try:
+        episode = make_episode(conf, 4)
+        ref = staging.put(4, 1.5, *episode)
+
+        assert ref == (0, record_size(conf, 4))
+        np.testing.assert_array_equal(staging.get(ref), pack_record(conf, 4, 1.5, *episode))
+        assert staging.put(6, 0.0, *make_episode(conf, 6))[0] == record_size(conf, 4)
+    finally:
+        staging.close()
+
+def test_staging_full_returns_record():
+    conf = make_conf()
+    staging = EpisodeStaging(conf, 1)
+    try:
+        staging.put(conf.NSTEPS, 0.0, *make_episode(conf, conf.NSTEPS))
+        record = staging.put(2, 1.0, *make_episode(conf, 2))
+
+        assert isinstance(record, np.ndarray)
+        assert staging.get(record) is record
+        staging.reset()
+        assert staging.put(2, 1.0, *make_episode(conf, 2))[0] == 0
+    finally:
+        staging.close()
+
+# Staging area inherited by the forked workers (as in main)
+staging = None
+
+def put_episode(NSTEPS_SH):
+    return staging.put(NSTEPS_SH, float(NSTEPS_SH), *make_episode(staging.conf, NSTEPS_SH, NSTEPS_SH))
+
+def test_staging_written_by_forked_workers():
+    global staging
+    conf = make_conf()
+    staging = EpisodeStaging(conf, 4)
+    try:
+        with multiprocessing.get_context('fork').Pool(2) as pool:
+            refs = pool.map(put_episode, [1, 2, 3, 4])
+
+        assert sorted(start for start, _ in refs) == [0] + list(np.cumsum([size for _, size in sorted(refs)])[:-1])
+        for NSTEPS_SH, ref in zip([1, 2, 3, 4], refs):
+            np.testing.assert_array_equal(staging.get(ref), pack_record(conf, NSTEPS_SH, float(NSTEPS_SH), *make_episode(conf, NSTEPS_SH, NSTEPS_SH)))
+    finally:
+        staging.close()
+
+@pytest.mark.parametrize('NSTEPS_SH', [4, 9])
+def test_buffer_state_round_trip(NSTEPS_SH):
+    conf = make_conf(REPLAY_SIZE=8)
+    buffer = ReplayBuffer(conf)
+    buffer.add_records([pack_record(conf, NSTEPS_SH, 0.0, *make_episode(conf, NSTEPS_SH))])
+    buffer.exp_counter[:] = np.arange(8)
+    state = buffer.get_state()
+
+    restored = ReplayBuffer(conf)
+    restored.set_state(state)
+    assert (restored.next_idx, restored.full) == (buffer.next_idx, buffer.full)
+    size = 8 if buffer.full else buffer.next_idx
+    np.testing.assert_array_equal(restored.storage_mat[:size], buffer.storage_mat[:size])
+    np.testing.assert_array_equal(restored.exp_counter[:size], buffer.exp_counter[:size])
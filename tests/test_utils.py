@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from utils import reverse_cumsum, discounted_reverse_cumsum
+
+def discounted_reverse_cumsum_loop(x, gamma):
+    y, carry = np.empty(len(x)), 0.0
+    for i in reversed(range(len(x))):
+        carry = x[i] + gamma*carry
+        y[i] = carry
+    return y
+
+def test_reverse_cumsum():
+    np.testing.assert_array_equal(reverse_cumsum(np.array([1., 2., 3.])), [6., 5., 3.])
+
+@pytest.mark.parametrize('gamma', [0, 0.5, 0.99, 1])
+def test_discounted_reverse_cumsum(gamma):
+    x = np.random.default_rng(0).standard_normal(50)
+
+    np.testing.assert_allclose(discounted_reverse_cumsum(x, gamma), discounted_reverse_cumsum_loop(x, gamma), rtol=1e-10, atol=1e-12)
+
+def test_discounted_reverse_cumsum_long_horizon():
+    # Long enough for gamma**len(x) to underflow: the sums are computed on blocks
+    x = np.ones(5000)
+    y = discounted_reverse_cumsum(x, 0.5)
+
+    assert np.all(np.isfinite(y))
+    np.testing.assert_allclose(y, discounted_reverse_cumsum_loop(x, 0.5), rtol=1e-12)
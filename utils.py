@@ -1,5 +1,7 @@
-import tensorflow as tf
 import numpy as np
+from lazy_utils import lazy_import
+
+tf = lazy_import('tensorflow')
 
 def array2tensor(array):
     
@@ -23,6 +25,27 @@ def normalize_tensor(state, state_norm_arr):
 
     return state_norm
 
+def reverse_cumsum(x):
+    ''' y[i] = sum(x[i:]) '''
+    return np.cumsum(x[::-1], axis=0)[::-1]
+
+def discounted_reverse_cumsum(x, gamma):
+    ''' y[i] = sum_k gamma**(k-i) * x[k] for k >= i (gamma in [0,1]), computed with scaled reversed cumulative sums on blocks short enough to avoid underflows '''
+    x = np.asarray(x, dtype=np.float64)
+    if gamma == 0:
+        return np.copy(x)
+
+    y = np.empty_like(x)
+    block = len(x) if gamma == 1 else max(1, int(-100/np.log10(gamma)))     # gamma**block >= 1e-100
+    carry = 0.0
+    for end in range(len(x), 0, -block):
+        start = max(0, end-block)
+        powers = gamma**np.arange(end-start)
+        y[start:end] = reverse_cumsum(x[start:end]*powers)/powers + carry*gamma**(end-start-np.arange(end-start))
+        carry = y[start]
+
+    return y
+
 def de_normalize(state, state_norm_arr):
     ''' Retrieve state from normalized state '''
     state_not_norm  = np.empty_like(state)